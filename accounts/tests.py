@@ -1,3 +1,79 @@
-from django.test import TestCase
+import json
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import AsyncRequestFactory, TestCase
+from django.test.utils import override_settings
+
+from logs.models import AuditLog
+from logs.tests import TEST_SETTINGS
+
+from .views import alogin_view
+
+
+@override_settings(**TEST_SETTINGS, PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class LoginTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', 'alice@example.com', 'correct-horse')
+
+    def login(self, password, ip_address='10.0.0.1'):
+        return self.client.post(
+            '/api/auth/login/', {'username': 'alice', 'password': password},
+            content_type='application/json', REMOTE_ADDR=ip_address,
+        )
+
+    def test_login(self):
+        response = self.login('correct-horse')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('access', response.json())
+        self.assertTrue(AuditLog.objects.filter(action='LOGIN', user=self.user).exists())
+
+    def test_failed_login(self):
+        response = self.login('wrong')
+        self.assertEqual(response.status_code, 401)
+        log = AuditLog.objects.get(action='FAILED_LOGIN')
+        self.assertEqual(log.details['attempted_username'], 'alice')
+        self.assertEqual(log.ip_address, '10.0.0.1')
+
+    def test_failed_login_burst_is_detected(self):
+        # Keep the attempts in one window bucket
+        with mock.patch('logs.security.time') as clock, \
+                mock.patch('logs.tasks.report_detection.delay') as delay:
+            clock.time.return_value = 600.0
+            clock.perf_counter.side_effect = time.perf_counter
+            for _ in range(5):
+                self.login('wrong', '10.0.0.9')
+        self.assertEqual(
+            [call.kwargs['rule'] for call in delay.call_args_list], ['failed-logins-ip']
+        )
+
+
+@override_settings(**TEST_SETTINGS, PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class AsyncLoginTests(TestCase):
+    """alogin_view answers like login_view"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('bob', 'bob@example.com', 'correct-horse')
+
+    async def login(self, body):
+        request = AsyncRequestFactory().post('/api/auth/login/', body, content_type='application/json')
+        return await alogin_view(request)
+
+    async def test_login(self):
+        response = await self.login({'username': 'bob', 'password': 'correct-horse'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['user']['username'], 'bob')
+        self.assertTrue(await AuditLog.objects.filter(action='LOGIN', user=self.user).aexists())
+
+    async def test_failed_login(self):
+        response = await self.login({'username': 'bob', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 401)
+        self.assertTrue(await AuditLog.objects.filter(action='FAILED_LOGIN', resource_id='bob').aexists())
+
+    async def test_bad_requests(self):
+        self.assertEqual((await self.login({'username': 'bob'})).status_code, 400)
+        self.assertEqual((await self.login('{not json')).status_code, 400)
@@ -1,6 +1,7 @@
+from django.conf import settings
 from django.urls import path
-from .views import login_view
+from .views import alogin_view, login_view
 
 urlpatterns = [
-    path('api/auth/login/', login_view, name='login'),
+    path('api/auth/login/', alogin_view if settings.AUDIT_ASYNC_VIEWS else login_view, name='login'),
 ]
\ No newline at end of file
@@ -1,8 +1,14 @@
-from django.contrib.auth import authenticate
+from django.contrib.auth import aauthenticate, authenticate
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import ParseError
 from rest_framework.permissions import AllowAny
+from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework_simplejwt.tokens import RefreshToken
 from logs.models import AuditLog
 
@@ -29,12 +35,9 @@ def login_view(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    user = authenticate(username=username, password=password)
+    user = authenticate(request, username=username, password=password)
     
     if user:
-        # Generate JWT tokens
-        refresh = RefreshToken.for_user(user)
-        
         # Log successful login (handled by signal, but we can add extra details)
         AuditLog.log_action(
             user=user,
@@ -49,19 +52,68 @@ def login_view(request):
             }
         )
         
-        return Response({
-            'refresh': str(refresh),
-            'access': str(refresh.access_token),
-            'user': {
-                'id': user.id,
-                'username': user.username,
-                'email': user.email,
-                'is_staff': user.is_staff
-            }
-        })
+        # Generate JWT tokens
+        return Response(login_response_data(user))
     else:
         # Failed login is handled by signal
         return Response(
             {'error': 'Invalid credentials'}, 
             status=status.HTTP_401_UNAUTHORIZED
-        )
\ No newline at end of file
+        )
+
+def login_response_data(user):
+    refresh = RefreshToken.for_user(user)
+    return {
+        'refresh': str(refresh),
+        'access': str(refresh.access_token),
+        'user': {
+            'id': user.id,
+            'username': user.username,
+            'email': user.email,
+            'is_staff': user.is_staff
+        }
+    }
+
+@csrf_exempt
+@require_POST
+async def alogin_view(request):
+    """
+    Async login view with audit logging, used when AUDIT_ASYNC_VIEWS is on.
+    Same request and responses as login_view.
+    """
+    try:
+        data = Request(request, parsers=[parser() for parser in api_settings.DEFAULT_PARSER_CLASSES]).data
+    except ParseError as exc:
+        return JsonResponse({'detail': str(exc.detail)}, status=status.HTTP_400_BAD_REQUEST)
+    username = data.get('username')
+    password = data.get('password')
+    
+    if not username or not password:
+        return JsonResponse(
+            {'error': 'Username and password are required'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    # Failed attempts fire user_login_failed like authenticate() does
+    user = await aauthenticate(request, username=username, password=password)
+    
+    if not user:
+        return JsonResponse(
+            {'error': 'Invalid credentials'}, 
+            status=status.HTTP_401_UNAUTHORIZED
+        )
+    
+    await AuditLog.alog_action(
+        user=user,
+        action='LOGIN',
+        resource='User',
+        resource_id=str(user.id),
+        ip_address=get_client_ip(request),
+        user_agent=request.META.get('HTTP_USER_AGENT', ''),
+        details={
+            'login_method': 'api',
+            'token_generated': True
+        }
+    )
+    
+    return JsonResponse(login_response_data(user))
\ No newline at end of file
@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import worker_process_shutdown
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'audit_trail.settings')
@@ -15,4 +16,10 @@ app.autodiscover_tasks()
 
 @app.task(bind=True)
 def debug_task(self):
-    print(f'Request: {self.request!r}')
\ No newline at end of file
+    print(f'Request: {self.request!r}')
+
+@worker_process_shutdown.connect
+def flush_audit_writer(**kwargs):
+    # Prefork children exit without running atexit handlers.
+    from logs.writers import get_audit_writer
+    get_audit_writer().close()
\ No newline at end of file
@@ -18,6 +18,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     'rest_framework',
     'rest_framework_simplejwt',
     'corsheaders',
@@ -28,6 +29,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'logs.middleware.MetricsMiddleware',
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -126,13 +128,215 @@ SIMPLE_JWT = {
     'ROTATE_REFRESH_TOKENS': True,
 }
 
+# Cache (shared by web and worker processes)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': config('REDIS_URL', default='redis://localhost:6379/0'),
+    }
+}
+
 # Celery Configuration
+from celery.schedules import crontab
 CELERY_BROKER_URL = config('REDIS_URL', default='redis://localhost:6379/0')
 CELERY_RESULT_BACKEND = config('REDIS_URL', default='redis://localhost:6379/0')
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TIMEZONE = 'UTC'
+CELERY_BEAT_SCHEDULE = {
+    'maintain-audit-partitions': {
+        'task': 'logs.tasks.maintain_audit_partitions',
+        'schedule': crontab(hour=0, minute=30),
+    },
+    'update-audit-rollups': {
+        'task': 'logs.tasks.update_audit_rollups',
+        'schedule': 60.0,
+    },
+    'update-audit-sketches': {
+        'task': 'logs.tasks.update_audit_sketches',
+        'schedule': 60.0,
+    },
+    'seal-audit-chain': {
+        'task': 'logs.tasks.seal_audit_chain',
+        'schedule': 300.0,
+    },
+    'expire-audit-log-exports': {
+        'task': 'logs.tasks.expire_audit_log_exports',
+        'schedule': crontab(minute=15),
+    },
+}
+
+# Audit Log Writer
+# Entries passed to AuditLog.log_action are queued in-process and written
+# with bulk_create by a background thread. Use logs.writers.SyncAuditWriter
+# to write every entry on the request thread instead.
+AUDIT_LOG_WRITER = {
+    'BACKEND': config('AUDIT_LOG_WRITER', default='logs.writers.BufferedAuditWriter'),
+    'OPTIONS': {
+        'batch_size': config('AUDIT_LOG_BATCH_SIZE', default=500, cast=int),
+        'flush_interval': config('AUDIT_LOG_FLUSH_INTERVAL', default=1.0, cast=float),
+        'max_queue_size': config('AUDIT_LOG_MAX_QUEUE_SIZE', default=10000, cast=int),
+        'overflow_policy': config('AUDIT_LOG_OVERFLOW_POLICY', default='block'),
+        # Seconds a full queue may block a request before the entry is dropped
+        'block_timeout': config('AUDIT_LOG_BLOCK_TIMEOUT', default=5.0, cast=float),
+    },
+}
+
+# Audit Routing (see logs/routing.py)
+# AuditMiddleware logs a request with the first rule matching its URL name,
+# namespace, method and status. API writes are always logged; successful
+# reads are logged as VIEW events for a share AUDIT_VIEW_SAMPLE_RATE of
+# requests (0 = off, 1 = every read), e.g.
+#   {'url_name': 'invoice-detail', 'methods': ['GET'], 'action': 'VIEW', 'severity': 'MEDIUM'}
+# placed before the catch-all rules always logs reads of invoices.
+AUDIT_ROUTING_RULES = [
+    # The log API records its own events; admin is not audited
+    {'url_name': 'auditlog-*', 'log': False},
+    {'url_name': 'metrics', 'log': False},
+    {'namespace': 'admin', 'log': False},
+    {'methods': ['POST', 'PUT', 'PATCH', 'DELETE'], 'status': '<400'},
+    {'methods': ['GET'], 'status': '2xx',
+     'sample_rate': config('AUDIT_VIEW_SAMPLE_RATE', default=0.0, cast=float)},
+]
+
+# Async views for ASGI deployments (uvicorn audit_trail.asgi:application):
+# log list/retrieve/create and login run on the event loop. Leave off under
+# WSGI, where every async view would be run through its own event loop.
+AUDIT_ASYNC_VIEWS = config('AUDIT_ASYNC_VIEWS', default=False, cast=bool)
+
+# Bulk Ingestion (POST /api/logs/bulk/)
+AUDIT_BULK_INGEST_MAX_ITEMS = config('AUDIT_BULK_INGEST_MAX_ITEMS', default=10000, cast=int)
+AUDIT_BULK_INGEST_CHUNK_SIZE = config('AUDIT_BULK_INGEST_CHUNK_SIZE', default=1000, cast=int)
+AUDIT_BULK_INGEST_MODE = config('AUDIT_BULK_INGEST_MODE', default='partial')
+
+# Live Tail (server-sent events at /api/logs/live/)
+# PostgresBroker fans out with LISTEN/NOTIFY across processes;
+# logs.live.LocalBroker only reaches clients of the writing process.
+AUDIT_LIVE_TAIL = {
+    'BACKEND': config('AUDIT_LIVE_TAIL_BACKEND', default='logs.live.PostgresBroker'),
+    'OPTIONS': {
+        'channel': 'audit_logs',
+    },
+}
+AUDIT_LIVE_TAIL_HEARTBEAT = config('AUDIT_LIVE_TAIL_HEARTBEAT', default=15, cast=int)
+AUDIT_LIVE_TAIL_QUEUE_SIZE = config('AUDIT_LIVE_TAIL_QUEUE_SIZE', default=1000, cast=int)
+AUDIT_LIVE_TAIL_REPLAY_LIMIT = config('AUDIT_LIVE_TAIL_REPLAY_LIMIT', default=1000, cast=int)
+
+# IP Enrichment
+# Audit logs are tagged with the network class, country and blocklist status
+# of their IP from networks.csv, countries.csv and blocklist.txt in this
+# directory (see logs.enrichment). Changed files are reloaded within
+# CHECK_INTERVAL seconds; missing files are treated as empty.
+AUDIT_IP_DATA_DIR = config('AUDIT_IP_DATA_DIR', default=os.path.join(BASE_DIR, 'ipdata'))
+AUDIT_IP_DATA_CHECK_INTERVAL = config('AUDIT_IP_DATA_CHECK_INTERVAL', default=60, cast=int)
+AUDIT_IP_CACHE_SIZE = config('AUDIT_IP_CACHE_SIZE', default=65536, cast=int)
+
+# User Agents
+# Each distinct user agent string is stored once (see logs.agents); this
+# many strings and ids are cached per process on the write and read paths.
+AUDIT_USER_AGENT_CACHE_SIZE = config('AUDIT_USER_AGENT_CACHE_SIZE', default=10000, cast=int)
+
+# Background Exports (POST /api/logs/export-jobs/)
+# Exports are written in shards of SHARD_HOURS of logs (at most MAX_SHARDS,
+# widened to fit) by parallel Celery tasks, to the audit_exports storage:
+# this directory by default, or object storage with e.g.
+# AUDIT_EXPORT_STORAGE_BACKEND=storages.backends.s3.S3Storage, where the
+# directory is the key prefix. Exports are deleted after RETENTION_HOURS.
+AUDIT_EXPORT_STORAGE_BACKEND = config(
+    'AUDIT_EXPORT_STORAGE_BACKEND', default='django.core.files.storage.FileSystemStorage'
+)
+AUDIT_EXPORT_DIR = config('AUDIT_EXPORT_DIR', default=os.path.join(BASE_DIR, 'exports'))
+AUDIT_EXPORT_SHARD_HOURS = config('AUDIT_EXPORT_SHARD_HOURS', default=24, cast=int)
+AUDIT_EXPORT_MAX_SHARDS = config('AUDIT_EXPORT_MAX_SHARDS', default=64, cast=int)
+AUDIT_EXPORT_RETENTION_HOURS = config('AUDIT_EXPORT_RETENTION_HOURS', default=24, cast=int)
+
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    'audit_exports': {
+        'BACKEND': AUDIT_EXPORT_STORAGE_BACKEND,
+        'OPTIONS': {'location': AUDIT_EXPORT_DIR},
+    },
+}
+
+# Audit Log Partitioning (PostgreSQL)
+# Monthly partitions are created this many months ahead. Partitions older
+# than the retention period are dropped; 0 keeps everything.
+AUDIT_LOG_PARTITIONS_AHEAD = config('AUDIT_LOG_PARTITIONS_AHEAD', default=3, cast=int)
+AUDIT_LOG_RETENTION_MONTHS = config('AUDIT_LOG_RETENTION_MONTHS', default=0, cast=int)
+
+# Audit Log Rollups
+# Per-minute and per-hour statistics rollups are pruned after these many
+# days; per-day rollups are kept forever. Hourly sketches
+# follow the hourly rollups.
+AUDIT_ROLLUP_MINUTE_RETENTION_DAYS = config('AUDIT_ROLLUP_MINUTE_RETENTION_DAYS', default=2, cast=int)
+AUDIT_ROLLUP_HOUR_RETENTION_DAYS = config('AUDIT_ROLLUP_HOUR_RETENTION_DAYS', default=90, cast=int)
+
+# Detection
+# Sliding-window counters live in Redis so every process shares them; use
+# logs.counters.LocalCounterStore for tests and single-process setups.
+AUDIT_COUNTER_STORE = {
+    'BACKEND': config('AUDIT_COUNTER_STORE', default='logs.counters.RedisCounterStore'),
+    'OPTIONS': {
+        'url': config('REDIS_URL', default='redis://localhost:6379/0'),
+    },
+}
+# Each rule alerts once when `threshold` matching events (or distinct values
+# of `distinct`) for the same `group_by` value happen within `window`
+# seconds, then stays quiet for `cooldown` seconds. See logs.security.
+AUDIT_DETECTION_RULES = [
+    {
+        'name': 'failed-logins-ip', 'description': 'Failed logins from one IP',
+        'action': 'FAILED_LOGIN', 'group_by': 'ip_address',
+        'window': 60, 'threshold': 5, 'cooldown': 300,
+    },
+    {
+        'name': 'failed-logins-username', 'description': 'Failed logins for one username',
+        'action': 'FAILED_LOGIN', 'group_by': 'details.attempted_username',
+        'window': 300, 'threshold': 10, 'cooldown': 900,
+    },
+    {
+        'name': 'mass-delete', 'description': 'Mass deletion by one user',
+        'action': 'DELETE', 'group_by': 'user',
+        'window': 60, 'threshold': 20, 'cooldown': 600,
+    },
+    {
+        'name': 'export-burst', 'description': 'Burst of exports by one user',
+        'action': 'EXPORT', 'group_by': 'user',
+        'window': 300, 'threshold': 5, 'cooldown': 900,
+    },
+    {
+        'name': 'login-ip-spread', 'description': 'Logins to one account from many IPs',
+        'action': 'LOGIN', 'group_by': 'user', 'distinct': 'ip_address',
+        'window': 3600, 'threshold': 5, 'cooldown': 3600,
+    },
+]
+
+# Security Alert Delivery
+# Alerts for the same IP or username are mailed as one digest per window,
+# and at most MAX_DIGESTS_PER_WINDOW separate digests go out per window.
+AUDIT_ALERT_DIGEST_WINDOW = config('AUDIT_ALERT_DIGEST_WINDOW', default=300, cast=int)
+AUDIT_ALERT_MAX_DIGESTS_PER_WINDOW = config('AUDIT_ALERT_MAX_DIGESTS_PER_WINDOW', default=20, cast=int)
+AUDIT_ALERT_MAX_ITEMS_PER_DIGEST = config('AUDIT_ALERT_MAX_ITEMS_PER_DIGEST', default=100, cast=int)
+AUDIT_ALERT_RECIPIENTS_CACHE_TIMEOUT = config('AUDIT_ALERT_RECIPIENTS_CACHE_TIMEOUT', default=3600, cast=int)
+
+# Tamper Evidence
+# Key for the audit log entry and checkpoint HMACs. Keep it out of the
+# database: anyone holding it can forge hashes for edited rows.
+AUDIT_CHAIN_KEY = config('AUDIT_CHAIN_KEY', default=SECRET_KEY)
+AUDIT_CHAIN_CHECKPOINT_SIZE = config('AUDIT_CHAIN_CHECKPOINT_SIZE', default=10000, cast=int)
+
+# Metrics (Prometheus text format at /metrics)
+# Each process adds its counts to the counter store above every
+# FLUSH_INTERVAL seconds, so the endpoint reports totals over all web and
+# Celery processes. Set a token and give it to Prometheus as its bearer
+# token; without one only signed-in staff can read the endpoint. Set
+# AUDIT_METRICS_LOG_LEVEL to INFO to also log per-request and per-batch
+# values as key=value fields.
+AUDIT_METRICS_ENABLED = config('AUDIT_METRICS_ENABLED', default=True, cast=bool)
+AUDIT_METRICS_FLUSH_INTERVAL = config('AUDIT_METRICS_FLUSH_INTERVAL', default=10.0, cast=float)
+AUDIT_METRICS_TOKEN = config('AUDIT_METRICS_TOKEN', default='')
 
 # Email Configuration
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -178,4 +382,9 @@ LOGGING = {
         'handlers': ['console', 'file'],
         'level': 'INFO',
     },
+    'loggers': {
+        'logs.metrics': {
+            'level': config('AUDIT_METRICS_LOG_LEVEL', default='WARNING'),
+        },
+    },
 }
\ No newline at end of file
@@ -1,21 +1,28 @@
 from django.contrib import admin
-from .models import AuditLog
+from .models import TRIGRAM_SEARCH_FIELDS, AuditLog
 
 @admin.register(AuditLog)
 class AuditLogAdmin(admin.ModelAdmin):
-    list_display = ['id', 'user', 'action', 'resource', 'ip_address', 'timestamp', 'severity']
-    list_filter = ['action', 'severity', 'timestamp', 'resource']
-    search_fields = ['user__username', 'resource', 'ip_address', 'resource_id']
-    readonly_fields = ['id', 'timestamp']
+    list_display = ['id', 'actor_username', 'action', 'resource', 'ip_address', 'timestamp', 'severity']
+    list_filter = ['action', 'severity', 'timestamp', 'resource', 'actor_is_staff', 'ip_network', 'ip_blocklisted']
+    search_fields = TRIGRAM_SEARCH_FIELDS  # served by the pg_trgm indexes
+    readonly_fields = ['id', 'timestamp', 'user_agent']
+    raw_id_fields = ['user']
     ordering = ['-timestamp']
     
     fieldsets = (
         ('Basic Information', {
             'fields': ('user', 'action', 'resource', 'resource_id', 'severity')
         }),
+        ('Actor', {
+            'fields': ('actor_username', 'actor_email', 'actor_is_staff')
+        }),
         ('Request Details', {
             'fields': ('ip_address', 'user_agent', 'session_id')
         }),
+        ('Network', {
+            'fields': ('ip_network', 'ip_network_name', 'ip_country', 'ip_blocklisted')
+        }),
         ('Metadata', {
             'fields': ('timestamp', 'details')
         }),
@@ -0,0 +1,215 @@
+"""
+Dictionary encoding of user agent strings.
+
+An audit log stores the id of its user agent (``AuditLog.agent``) instead
+of the string. Most logs come from a few thousand distinct agents of 100
+to 300 bytes each, so ``UserAgent`` keeps every distinct string once,
+along with the browser, operating system and device parsed from it.
+``AuditLog.user_agent`` reads and sets the string as before.
+
+Writers call ``intern`` on the logs they store. It resolves known strings
+from an LRU cache of ``AUDIT_USER_AGENT_CACHE_SIZE`` entries and stores
+new ones with one ``INSERT ... ON CONFLICT DO NOTHING`` and one
+``SELECT`` per batch. Strings are only cached once that insert has
+committed, so a rolled back batch cannot leave ids of rows that do not
+exist in the cache. ``resolve`` maps ids back to strings, also cached:
+``UserAgent`` rows are never changed or reused.
+"""
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+
+DESKTOP = 'desktop'
+MOBILE = 'mobile'
+TABLET = 'tablet'
+BOT = 'bot'
+OTHER = 'other'
+
+# (name, pattern capturing the version); the first match wins, so browsers
+# built on Chrome come before it, and Chrome before Safari
+BROWSERS = [
+    ('Edge', r'Edg(?:e|A|iOS)?/(\d+)'),
+    ('Opera', r'(?:OPR|Opera)/(\d+)'),
+    ('Samsung Internet', r'SamsungBrowser/(\d+)'),
+    ('Firefox', r'(?:Firefox|FxiOS)/(\d+)'),
+    ('Chrome', r'(?:Chrome|CriOS)/(\d+)'),
+    ('Safari', r'Version/(\d+)[\d.]* (?:Mobile/\S+ )?Safari/'),
+    ('Internet Explorer', r'(?:MSIE |Trident/.*rv:)(\d+)'),
+    ('curl', r'^curl/(\d+)'),
+    ('Wget', r'^Wget/(\d+)'),
+    ('Python Requests', r'python-requests/(\d+)'),
+    ('Python', r'Python-urllib/(\d+)|aiohttp/(\d+)|httpx/(\d+)'),
+    ('Go', r'Go-http-client/(\d+)'),
+    ('Java', r'Java/(\d+)|Apache-HttpClient/(\d+)|okhttp/(\d+)'),
+    ('Node.js', r'node-fetch/(\d+)|axios/(\d+)'),
+    ('Postman', r'PostmanRuntime/(\d+)'),
+]
+
+OPERATING_SYSTEMS = [
+    ('iOS', r'(?:iPhone|iPad|iPod).*? OS (\d+)'),
+    ('Android', r'Android (\d+)'),
+    ('Windows', r'Windows NT (\d+)'),
+    ('macOS', r'Mac OS X (\d+)'),
+    ('ChromeOS', r'CrOS \S+ (\d+)'),
+    ('Linux', r'Linux()'),
+]
+
+_BROWSERS = [(name, re.compile(pattern)) for name, pattern in BROWSERS]
+_OPERATING_SYSTEMS = [(name, re.compile(pattern)) for name, pattern in OPERATING_SYSTEMS]
+_BOT_RE = re.compile(r'bot\b|crawl|spider|slurp|^curl/|^Wget/|python|Go-http-client|Java/|'
+                     r'HttpClient|okhttp|node-fetch|axios|PostmanRuntime', re.IGNORECASE)
+_TABLET_RE = re.compile(r'iPad|Tablet|Android(?!.*Mobile)')
+_MOBILE_RE = re.compile(r'Mobi|iPhone|iPod|Android')
+
+
+def _first_match(candidates, value):
+    for name, pattern in candidates:
+        match = pattern.search(value)
+        if match:
+            return name, next((group for group in match.groups() if group), '')
+    return '', ''
+
+
+def parse_user_agent(value):
+    """``UserAgent`` field values (browser, OS and device) parsed from a user agent string"""
+    browser, browser_version = _first_match(_BROWSERS, value)
+    os, os_version = _first_match(_OPERATING_SYSTEMS, value)
+    if _BOT_RE.search(value):
+        device = BOT
+    elif _TABLET_RE.search(value):
+        device = TABLET
+    elif _MOBILE_RE.search(value):
+        device = MOBILE
+    elif os:
+        device = DESKTOP
+    else:
+        device = OTHER
+    return {
+        'browser': browser,
+        'browser_version': browser_version[:20],
+        'os': os,
+        'os_version': os_version[:20],
+        'device': device,
+    }
+
+
+def digest(value):
+    """Unique key of a user agent string; the strings can be too long for a btree"""
+    return hashlib.md5(value.encode('utf-8'), usedforsecurity=False).hexdigest()
+
+
+class LRUCache:
+    """A thread-safe mapping keeping the ``size`` most recently used keys"""
+
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def update(self, items):
+        with self._lock:
+            for key, value in items:
+                self._data[key] = value
+                self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+
+class UserAgentCache:
+    """Ids of user agent strings and strings of ids, most recently used first"""
+
+    def __init__(self, size):
+        self.ids = LRUCache(size)
+        self.strings = LRUCache(size)
+
+
+_cache = None
+
+
+def get_user_agent_cache():
+    global _cache
+    if _cache is None:
+        _cache = UserAgentCache(settings.AUDIT_USER_AGENT_CACHE_SIZE)
+    return _cache
+
+
+def reset_user_agent_cache(**kwargs):
+    global _cache
+    if kwargs.get('setting') in (None, 'AUDIT_USER_AGENT_CACHE_SIZE'):
+        _cache = None
+
+
+setting_changed.connect(reset_user_agent_cache)
+
+
+def store(values):
+    """
+    ``{string: id}`` of the user agent strings ``values``, adding the
+    missing ones to ``UserAgent``
+    """
+    from .models import UserAgent
+
+    by_digest = {digest(value): value for value in values}
+    UserAgent.objects.bulk_create(
+        [UserAgent(digest=key, user_agent=value, **parse_user_agent(value)) for key, value in by_digest.items()],
+        ignore_conflicts=True,
+    )
+    ids = {
+        by_digest[key]: agent_id
+        for key, agent_id in UserAgent.objects.filter(digest__in=list(by_digest)).values_list('digest', 'id')
+    }
+    cache = get_user_agent_cache()
+    cache.strings.update((agent_id, value) for value, agent_id in ids.items())
+    transaction.on_commit(lambda: cache.ids.update(ids.items()))
+    return ids
+
+
+def intern(entries):
+    """Set ``agent_id`` of unsaved ``AuditLog`` entries from their ``user_agent`` string"""
+    cache = get_user_agent_cache().ids
+    missing = {}
+    for entry in entries:
+        value = entry.pending_user_agent
+        if value is None:
+            continue
+        agent_id = cache.get(value)
+        if agent_id is None:
+            missing.setdefault(value, []).append(entry)
+        else:
+            entry.agent_id = agent_id
+    if missing:
+        for value, agent_id in store(missing).items():
+            for entry in missing[value]:
+                entry.agent_id = agent_id
+
+
+def resolve(ids):
+    """``{id: string}`` of ``UserAgent`` ids"""
+    from .models import UserAgent
+
+    cache = get_user_agent_cache().strings
+    strings = {}
+    missing = []
+    for agent_id in ids:
+        value = cache.get(agent_id)
+        if value is None:
+            missing.append(agent_id)
+        else:
+            strings[agent_id] = value
+    if missing:
+        found = list(UserAgent.objects.filter(id__in=missing).values_list('id', 'user_agent'))
+        cache.update(found)
+        strings.update(found)
+    return strings
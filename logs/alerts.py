@@ -0,0 +1,184 @@
+"""
+Security alert delivery.
+
+Alerts are not mailed one by one. ``dispatch_alert`` appends them to a
+pending digest for their group (an IP address or username) and schedules a
+single ``send_security_alert_digest`` task for the end of the digest window.
+At most ``AUDIT_ALERT_MAX_DIGESTS_PER_WINDOW`` groups get their own digest
+per window; any further groups share one overflow digest, so the number of
+emails sent is bounded however many alerts are raised.
+"""
+import json
+import logging
+import threading
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
+from django.utils import timezone
+
+from . import metrics
+from .counters import get_counter_store
+
+logger = logging.getLogger(__name__)
+
+RECIPIENTS_CACHE_KEY = 'audit:alert_recipients'
+OVERFLOW_GROUP = 'overflow'
+
+STATS = ('alerts_received', 'digests_sent', 'digests_failed', 'emails_sent')
+
+_connection = None
+_connection_lock = threading.Lock()
+
+
+def get_alert_recipients():
+    """Emails of staff users, cached until a user's staff status or email changes"""
+    recipients = cache.get(RECIPIENTS_CACHE_KEY)
+    if recipients is None:
+        from django.contrib.auth.models import User
+        recipients = list(
+            User.objects.filter(is_staff=True, is_active=True, email__isnull=False)
+            .exclude(email='')
+            .values_list('email', flat=True)
+        )
+        cache.set(RECIPIENTS_CACHE_KEY, recipients, settings.AUDIT_ALERT_RECIPIENTS_CACHE_TIMEOUT)
+    return recipients
+
+
+def invalidate_alert_recipients():
+    cache.delete(RECIPIENTS_CACHE_KEY)
+
+
+def get_alert_stats():
+    store = get_counter_store()
+    counts = store.get_counts([f'alerts:stats:{name}' for name in STATS])
+    return {name: counts[f'alerts:stats:{name}'] for name in STATS}
+
+
+def dispatch_alert(group, alert):
+    """
+    Queue ``alert`` (a JSON-serialisable dict) for the digest of ``group``.
+    The first alert of a group in a window schedules its digest, or joins
+    the overflow digest once the per-window digest budget is used up.
+    """
+    from .tasks import send_security_alert_digest
+
+    store = get_counter_store()
+    window = settings.AUDIT_ALERT_DIGEST_WINDOW
+    alert = dict(alert, raised_at=timezone.now().isoformat())
+    store.incr('alerts:stats:alerts_received')
+    store.push(f'alerts:pending:{group}', json.dumps(alert), window * 2,
+               settings.AUDIT_ALERT_MAX_ITEMS_PER_DIGEST)
+
+    if not store.add_once(f'alerts:scheduled:{group}', window):
+        return  # a digest for this group is already on its way
+
+    if store.hit('alerts:digests', window) <= settings.AUDIT_ALERT_MAX_DIGESTS_PER_WINDOW:
+        send_security_alert_digest.apply_async(args=[group], countdown=window)
+        return
+
+    store.push('alerts:overflow_groups', group, window * 2,
+               settings.AUDIT_ALERT_MAX_ITEMS_PER_DIGEST)
+    if store.add_once(f'alerts:scheduled:{OVERFLOW_GROUP}', window):
+        send_security_alert_digest.apply_async(args=[OVERFLOW_GROUP], countdown=window)
+
+
+def _send(message):
+    """Send through a connection kept open across digests, reconnecting once if it went stale"""
+    global _connection
+    with _connection_lock:
+        for attempt in range(2):
+            if _connection is None:
+                _connection = get_connection(fail_silently=False)
+                _connection.open()
+            try:
+                return _connection.send_messages([message])
+            except Exception:
+                try:
+                    _connection.close()
+                except Exception:
+                    pass
+                _connection = None
+                if attempt:
+                    raise
+
+
+def format_digest(group, alerts, total):
+    lines = [
+        'Security Alert - Audit Trail System',
+        '',
+        f'{total} security alert(s) raised for {group} in the last '
+        f'{settings.AUDIT_ALERT_DIGEST_WINDOW} seconds:',
+        '',
+    ]
+    for alert in alerts:
+        lines.append(
+            f"- {alert.get('raised_at')}: {alert.get('description')}: "
+            f"{alert.get('count')} {alert.get('measure')} in {alert.get('timeframe')} "
+            f"(IP {alert.get('ip_address')}, username {alert.get('username')}"
+            + (f", group {alert['group']}" if 'group' in alert else '')
+            + ')'
+        )
+    if total > len(alerts):
+        lines.append(f'... and {total - len(alerts)} more')
+    lines += [
+        '',
+        'Please investigate this activity immediately.',
+        '',
+        'This is an automated security alert from the Audit Trail System.',
+    ]
+    return '\n'.join(lines)
+
+
+def send_digest(group):
+    """
+    Mail the pending alerts of ``group`` as one message and record the
+    delivery. Returns ``(alerts in digest, recipients)``.
+    """
+    store = get_counter_store()
+    if group == OVERFLOW_GROUP:
+        groups, _ = store.drain('alerts:overflow_groups')
+    else:
+        groups = [group]
+
+    alerts = []
+    total = 0
+    for pending_group in groups:
+        items, count = store.drain(f'alerts:pending:{pending_group}')
+        total += count
+        for item in items:
+            alert = json.loads(item)
+            if group == OVERFLOW_GROUP:
+                alert['group'] = pending_group
+            alerts.append(alert)
+    if not total:
+        return 0, 0
+    alerts = alerts[-settings.AUDIT_ALERT_MAX_ITEMS_PER_DIGEST:]
+
+    recipients = get_alert_recipients()
+    if not recipients:
+        logger.warning('Dropping %d security alert(s) for %s: no staff recipients', total, group)
+        return total, 0
+
+    message = EmailMessage(
+        subject=f'Security Alert: {total} alert(s) for {group}',
+        body=format_digest(group, alerts, total),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=recipients,
+    )
+    try:
+        _send(message)
+    except Exception:
+        store.incr('alerts:stats:digests_failed')
+        raise
+
+    store.incr('alerts:stats:digests_sent')
+    store.incr('alerts:stats:emails_sent', len(recipients))
+    sent_at = timezone.now()
+    for alert in alerts:
+        if alert.get('raised_at'):
+            metrics.ALERT_DELIVERY_SECONDS.observe(
+                (sent_at - datetime.fromisoformat(alert['raised_at'])).total_seconds()
+            )
+    return total, len(recipients)
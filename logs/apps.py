@@ -7,3 +7,7 @@ class LogsConfig(AppConfig):
     
     def ready(self):
         import logs.signals
+        from logs.security import get_detection_engine
+        
+        # Compile the detection rules now so configuration errors surface at startup
+        get_detection_engine()
@@ -0,0 +1,310 @@
+"""
+Benchmarks for the audit log endpoints, run in-process against the
+configured database (see ``manage.py benchmark_audit_logs``).
+
+Every scenario is timed over a number of iterations after a warm-up and
+reports p50/p95/p99 latency plus the number of SQL queries one iteration
+runs. Results are plain dicts so they can be saved as a JSON baseline and
+compared with a later run.
+"""
+import json
+import statistics
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_login_failed
+from django.db import connection
+from django.http import HttpResponse
+from django.test import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from .middleware import AuditMiddleware
+from .models import AuditLog
+from .pagination import KeysetPagination
+from .writers import get_audit_writer
+
+# Everything the request path would otherwise send to Redis, SMTP or Celery
+# stays in this process, so a benchmark only needs PostgreSQL.
+LOCAL_SETTINGS = {
+    'ALLOWED_HOSTS': ['testserver'],
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    'AUDIT_COUNTER_STORE': {'BACKEND': 'logs.counters.LocalCounterStore'},
+    'AUDIT_LIVE_TAIL': {'BACKEND': 'logs.live.LocalBroker'},
+    'EMAIL_BACKEND': 'django.core.mail.backends.locmem.EmailBackend',
+}
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(durations, queries):
+    durations = sorted(durations)
+    return {
+        'iterations': len(durations),
+        'mean_ms': round(statistics.fmean(durations) * 1000, 3),
+        'p50_ms': round(percentile(durations, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(durations, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(durations, 0.99) * 1000, 3),
+        'queries': queries,
+    }
+
+
+def measure(func, iterations, warmup=3):
+    """Time ``func`` ``iterations`` times, then count the queries of one more call"""
+    for _ in range(warmup):
+        func()
+    durations = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started)
+    with CaptureQueriesContext(connection) as captured:
+        func()
+    return summarize(durations, len(captured))
+
+
+class Scenario:
+    def __init__(self, name, func, description):
+        self.name = name
+        self.func = func
+        self.description = description
+
+
+class AuditBenchmark:
+    """
+    The benchmark scenarios, set up against the rows already in the
+    database (load some with ``manage.py seed_audit_logs`` first).
+    """
+
+    def __init__(self, iterations=50, page_depths=(1, 10, 100, 1000)):
+        self.iterations = iterations
+        self.page_depths = page_depths
+
+    def run(self, only=None, stdout=None):
+        results = {}
+        with ExitStack() as stack:
+            stack.enter_context(override_settings(**LOCAL_SETTINGS, REST_FRAMEWORK=self.rest_framework_settings()))
+            stack.enter_context(self.eager_celery())
+            self.setup()
+            for scenario in self.scenarios():
+                if only and not any(scenario.name.startswith(prefix) for prefix in only):
+                    continue
+                results[scenario.name] = measure(scenario.func, self.iterations)
+                results[scenario.name]['description'] = scenario.description
+                if stdout is not None:
+                    stdout.write(format_result(scenario.name, results[scenario.name]))
+            get_audit_writer().flush()
+        return {'meta': self.meta(), 'scenarios': results}
+
+    def rest_framework_settings(self):
+        from django.conf import settings
+
+        # Throttling would turn most iterations into 429s
+        return dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_CLASSES=[])
+
+    @contextmanager
+    def eager_celery(self):
+        from .tasks import report_detection
+
+        conf = report_detection.app.conf
+        previous = conf.task_always_eager
+        conf.task_always_eager = True
+        try:
+            yield
+        finally:
+            conf.task_always_eager = previous
+
+    def setup(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+
+        self.staff = User.objects.filter(is_staff=True, is_active=True).order_by('id').first()
+        if self.staff is None:
+            raise ValueError('The benchmark needs at least one active staff user')
+        self.client = Client(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.staff).access_token}')
+        self.factory = RequestFactory()
+
+        latest = AuditLog.objects.order_by('-timestamp').values('timestamp', 'actor_username').first()
+        if latest is None:
+            raise ValueError('The benchmark needs audit logs; run seed_audit_logs first')
+        self.latest = latest['timestamp']
+        self.username = (
+            AuditLog.objects.filter(actor_username__isnull=False)
+            .values_list('actor_username', flat=True).first()
+        )
+
+    def meta(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT version()')
+            server = cursor.fetchone()[0]
+        return {
+            'created_at': timezone.now().isoformat(),
+            'database': server,
+            'rows': estimated_rows(),
+            'iterations': self.iterations,
+        }
+
+    def get(self, path, **params):
+        def request():
+            response = self.client.get(path, params)
+            if response.status_code != 200:
+                raise AssertionError(f'GET {path} {params} returned {response.status_code}')
+            # Drain streaming responses so their cost is included
+            if response.streaming:
+                for _ in response.streaming_content:
+                    pass
+        return request
+
+    def scenarios(self):
+        day_ago = (self.latest - timedelta(days=1)).isoformat()
+        hour_ago = (self.latest - timedelta(hours=1)).isoformat()
+
+        yield Scenario('middleware.skipped', self.middleware('GET', '/api/orders/'),
+                       'AuditMiddleware on a request it does not log')
+        yield Scenario('middleware.logged', self.middleware('POST', '/api/orders/'),
+                       'AuditMiddleware building and submitting an entry to the configured writer')
+
+        pages = estimated_rows() // self.page_size()
+        for depth in self.page_depths:
+            if depth > pages:
+                continue
+            yield Scenario(f'list.page.{depth}', self.get('/api/logs/', page=depth),
+                           f'Page {depth} with page-number pagination (runs COUNT)')
+            yield Scenario(f'list.cursor.{depth}', self.cursor_page(depth),
+                           f'The page at depth {depth} with keyset pagination')
+
+        yield Scenario('filter.action_severity',
+                       self.get('/api/logs/', action='FAILED_LOGIN', severity='HIGH', pagination='cursor'),
+                       'Equality filters on indexed columns')
+        yield Scenario('filter.date_range',
+                       self.get('/api/logs/', start_date=day_ago, pagination='cursor'),
+                       'Last day of logs')
+        yield Scenario('filter.details',
+                       self.get('/api/logs/', **{'details.status_code__gte': 500, 'pagination': 'cursor'}),
+                       'Range filter on an indexed details key')
+        if self.username:
+            yield Scenario('search.identifier', self.get('/api/logs/', q=self.username, pagination='cursor'),
+                           'Search by username (substring match)')
+        yield Scenario('search.fulltext', self.get('/api/logs/', q='firefox', pagination='cursor'),
+                       'Full-text search in details and user agent')
+
+        yield Scenario('export.csv', self.get('/api/logs/export/', start_date=hour_ago),
+                       'CSV export of the last hour, fully streamed')
+        yield Scenario('export.ndjson_gzip',
+                       self.get('/api/logs/export/', start_date=hour_ago, export_format='ndjson', compress='gzip'),
+                       'Compressed NDJSON export of the last hour, fully streamed')
+        yield Scenario('statistics', self.get('/api/logs/statistics/'), 'Dashboard statistics')
+        yield Scenario('timeseries.day', self.get('/api/logs/timeseries/', start_date=day_ago),
+                       'Counts over the last day')
+        yield Scenario('failed_login.signal', self.failed_login(),
+                       'user_login_failed handling: lookup, log entry and detection rules')
+
+    def middleware(self, method, path):
+        middleware = AuditMiddleware(lambda request: HttpResponse(status=201))
+        factory = self.factory
+        staff = self.staff
+
+        def request():
+            request = factory.generic(method, path)
+            request.user = staff
+            request.session = mock.Mock(session_key=None)
+            middleware(request)
+        return request
+
+    def cursor_page(self, depth):
+        offset = (depth - 1) * self.page_size()
+        if not offset:
+            return self.get('/api/logs/', pagination='cursor')
+        # The last row of the previous page, as a client following "next" links would send it
+        timestamp, log_id = (
+            AuditLog.objects.order_by('-timestamp', '-id')
+            .values_list('timestamp', 'id')[offset - 1]
+        )
+        cursor = KeysetPagination.encode_values([timestamp.isoformat(), log_id], reverse=False)
+        return self.get('/api/logs/', cursor=cursor)
+
+    def page_size(self):
+        from django.conf import settings
+
+        return settings.REST_FRAMEWORK.get('PAGE_SIZE') or 50
+
+    def failed_login(self):
+        factory = self.factory
+        attempts = iter(range(10 ** 9))
+
+        def attempt():
+            # New addresses and usernames, so no detection rule reaches its
+            # threshold and the common path is what gets timed
+            number = next(attempts)
+            request = factory.post(
+                '/api/auth/login/', REMOTE_ADDR=f'10.{number >> 16 & 255}.{number >> 8 & 255}.{number & 255}'
+            )
+            user_login_failed.send(
+                sender=__name__,
+                credentials={'username': f'bench_missing_{number}'},
+                request=request,
+            )
+        return attempt
+
+
+def estimated_rows():
+    """Planner estimate of the audit log count; exact counts are too slow here"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT COALESCE(SUM(c.reltuples), 0)::bigint FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass",
+            [AuditLog._meta.db_table],
+        )
+        return cursor.fetchone()[0]
+
+
+def format_result(name, result, baseline=None):
+    line = (
+        f"{name:28} p50 {result['p50_ms']:9.2f}ms  p95 {result['p95_ms']:9.2f}ms  "
+        f"p99 {result['p99_ms']:9.2f}ms  queries {result['queries']:3}"
+    )
+    if baseline is not None:
+        line += (
+            f"  (p95 {change(baseline['p95_ms'], result['p95_ms']):+.0f}%, "
+            f"queries {result['queries'] - baseline['queries']:+d})"
+        )
+    return line
+
+
+def change(before, after):
+    return (after - before) / before * 100 if before else 0.0
+
+
+def compare(results, baseline, max_regression):
+    """
+    Scenarios whose p95 grew by more than ``max_regression`` percent, or
+    that now run more queries, compared with ``baseline``.
+    """
+    regressions = []
+    for name, result in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        if result['queries'] > before['queries']:
+            regressions.append(f"{name}: {before['queries']} -> {result['queries']} queries")
+        if change(before['p95_ms'], result['p95_ms']) > max_regression:
+            regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {result['p95_ms']}ms")
+    return regressions
+
+
+def load_results(path):
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def save_results(results, path):
+    with open(path, 'w') as handle:
+        json.dump(results, handle, indent=2, sort_keys=True)
+        handle.write('\n')
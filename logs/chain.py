@@ -0,0 +1,379 @@
+"""
+Tamper evidence for audit logs.
+
+Every log gets an ``entry_hash`` when it is written: an HMAC-SHA256, keyed
+with ``AUDIT_CHAIN_KEY``, over a canonical form of its content. Rows edited
+in the database no longer match their hash, and without the key a matching
+hash cannot be forged.
+
+``seal_chain`` periodically groups newly written logs, in id order, into
+checkpoints of at most ``AUDIT_CHAIN_CHECKPOINT_SIZE`` entries. A
+checkpoint stores the Merkle root of its entries, and its ``chain_hash``
+is an HMAC over the root and the previous checkpoint's ``chain_hash``.
+Deleting or inserting a sealed row therefore changes a root. Removing a
+checkpoint breaks the chain of checkpoints.
+
+The Merkle tree follows RFC 6962: leaves are ``SHA256(0x00 || id || entry
+hash)`` and nodes ``SHA256(0x01 || left || right)``. The id is an 8-byte
+big-endian integer and the entry hash its 32 raw bytes. A range is
+verified by rehashing only the checkpoints that overlap it. An inclusion
+proof is the ``log2(size)`` sibling hashes between a leaf and the root.
+
+Logs written before entry hashes existed were hashed by migration
+``0017_backfill_entry_hash``, so a log without one has been tampered with:
+it is sealed with ``MISSING_HASH`` rather than a hash of its current
+content, and reported by verification.
+"""
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+
+logger = logging.getLogger(__name__)
+
+HASHED_FIELDS = (
+    'timestamp', 'actor_username', 'actor_email', 'actor_is_staff', 'action',
+    'resource', 'resource_id', 'ip_address', 'user_agent', 'severity',
+    'details', 'session_id',
+)
+
+# What ``HASHED_FIELDS`` are read with; the user agent string is stored
+# once in ``UserAgent``, and hashed as the string
+HASHED_LOOKUPS = tuple('agent__user_agent' if field == 'user_agent' else field for field in HASHED_FIELDS)
+
+_IP_INDEX = HASHED_FIELDS.index('ip_address')
+_DETAILS_INDEX = HASHED_FIELDS.index('details')
+
+WATERMARK = 'chain'
+
+GENESIS_HASH = '0' * 64
+
+# Leaf content of a log whose entry hash was removed
+MISSING_HASH = '0' * 64
+
+
+_hmac_cache = {}
+
+
+def _hmac(message):
+    """HMAC-SHA256 under ``AUDIT_CHAIN_KEY``, reusing the keyed state"""
+    key = settings.AUDIT_CHAIN_KEY
+    base = _hmac_cache.get(key)
+    if base is None:
+        _hmac_cache.clear()
+        base = _hmac_cache[key] = hmac.new(key.encode('utf-8'), digestmod=hashlib.sha256)
+    mac = base.copy()
+    mac.update(message)
+    return mac.hexdigest()
+
+
+def _normalize(value):
+    """Make JSON values hash the same before and after a trip through jsonb"""
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+_encode = json.JSONEncoder(
+    sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str
+).encode
+
+
+def canonical_entry(values):
+    """Stable byte representation of the hashed fields of one log"""
+    row = [values[field] for field in HASHED_FIELDS]
+    row[0] = row[0].astimezone(dt_timezone.utc).isoformat(timespec='microseconds')
+    ip_address = row[_IP_INDEX]
+    if ip_address and ':' in ip_address:
+        row[_IP_INDEX] = ipaddress.ip_address(ip_address).compressed
+    row[_DETAILS_INDEX] = _normalize(row[_DETAILS_INDEX])
+    return _encode(row).encode('utf-8')
+
+
+def entry_hash(values):
+    """Hex HMAC of a log given ``{field: value}`` for ``HASHED_FIELDS``"""
+    return _hmac(canonical_entry(values))
+
+
+def leaf_hash(log_id, hex_hash):
+    return hashlib.sha256(b'\x00' + log_id.to_bytes(8, 'big') + bytes.fromhex(hex_hash)).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+
+def _split(size):
+    """Largest power of two smaller than ``size``"""
+    split = 1
+    while split * 2 < size:
+        split *= 2
+    return split
+
+
+def merkle_root(leaves):
+    if not leaves:
+        return hashlib.sha256(b'').digest()
+    level = list(leaves)
+    # Iterative form of the RFC 6962 tree: pair from the left and carry an
+    # odd node up unchanged, which yields the same root as the recursive split.
+    while len(level) > 1:
+        paired = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+    return level[0]
+
+
+def inclusion_proof(leaves, index):
+    """Sibling hashes from leaf ``index`` up to the root, bottom first"""
+    if len(leaves) <= 1:
+        return []
+    split = _split(len(leaves))
+    if index < split:
+        return inclusion_proof(leaves[:split], index) + [merkle_root(leaves[split:])]
+    return inclusion_proof(leaves[split:], index - split) + [merkle_root(leaves[:split])]
+
+
+def verify_inclusion(leaf, index, size, proof, root):
+    """Check an inclusion proof the way a client holding only the root would (RFC 9162)"""
+    if index >= size:
+        return False
+    node, last = index, size - 1
+    result = leaf
+    for sibling in proof:
+        if last == 0:
+            return False
+        if node % 2 or node == last:
+            result = node_hash(sibling, result)
+            while node % 2 == 0 and node != 0:
+                node //= 2
+                last //= 2
+        else:
+            result = node_hash(result, sibling)
+        node //= 2
+        last //= 2
+    return last == 0 and result == root
+
+
+def checkpoint_hash(previous_hash, first_id, last_id, size, root):
+    return _hmac(f'{previous_hash}:{first_id}:{last_id}:{size}:{root}'.encode('utf-8'))
+
+
+def _rows(first_id, last_id, first_timestamp=None, last_timestamp=None):
+    from .models import AuditLog
+
+    queryset = AuditLog.objects.filter(id__gte=first_id, id__lte=last_id)
+    # Timestamp bounds only let PostgreSQL skip partitions; a row moved
+    # outside them is reported as missing.
+    if first_timestamp is not None:
+        queryset = queryset.filter(timestamp__gte=first_timestamp)
+    if last_timestamp is not None:
+        queryset = queryset.filter(timestamp__lte=last_timestamp)
+    return queryset.order_by('id').values_list('id', 'entry_hash', *HASHED_LOOKUPS)
+
+
+def iter_entries(rows):
+    """Yield ``(id, stored entry hash, recomputed entry hash, timestamp)`` for ``_rows``"""
+    for log_id, stored, *values in rows:
+        values = dict(zip(HASHED_FIELDS, values))
+        yield log_id, stored, entry_hash(values), values['timestamp']
+
+
+def _leaves(checkpoint):
+    """``(id, leaf hash)`` of a checkpoint, from the hashes stored at write time"""
+    rows = _rows(checkpoint.first_id, checkpoint.last_id,
+                 checkpoint.first_timestamp, checkpoint.last_timestamp)
+    return [
+        (log_id, leaf_hash(log_id, stored or MISSING_HASH))
+        for log_id, stored, _, _ in iter_entries(rows.iterator(chunk_size=5000))
+    ]
+
+
+def seal_chain(max_size=None):
+    """
+    Seal logs written since the last run into checkpoints. Like the rollups,
+    only ids seen on the previous run are sealed so in-flight inserts with
+    lower ids can commit first. Returns the checkpoints created.
+    """
+    from .models import AuditChainCheckpoint, AuditLog, AuditLogWatermark
+
+    max_size = max_size or settings.AUDIT_CHAIN_CHECKPOINT_SIZE
+    AuditLogWatermark.objects.get_or_create(name=WATERMARK)
+    created = []
+
+    while True:
+        with transaction.atomic():
+            watermark = AuditLogWatermark.objects.select_for_update().get(name=WATERMARK)
+            if watermark.last_id >= watermark.pending_id:
+                break
+
+            entries = list(iter_entries(_rows(watermark.last_id + 1, watermark.pending_id)[:max_size]))
+            if not entries:
+                break
+            # Checkpoints cover contiguous id ranges, including ids never used
+            first_id = watermark.last_id + 1
+            last_id = entries[-1][0] if len(entries) == max_size else watermark.pending_id
+
+            missing = [log_id for log_id, stored, _, _ in entries if stored is None]
+            if missing:
+                logger.error('Sealing audit logs without an entry hash: %s', ', '.join(map(str, missing)))
+            leaves = [leaf_hash(log_id, stored or MISSING_HASH) for log_id, stored, _, _ in entries]
+            timestamps = [timestamp for _, _, _, timestamp in entries]
+            previous = AuditChainCheckpoint.objects.order_by('-last_id').first()
+            previous_hash = previous.chain_hash if previous else GENESIS_HASH
+            root = merkle_root(leaves).hex()
+
+            created.append(AuditChainCheckpoint.objects.create(
+                first_id=first_id,
+                last_id=last_id,
+                size=len(leaves),
+                first_timestamp=min(timestamps),
+                last_timestamp=max(timestamps),
+                merkle_root=root,
+                previous_hash=previous_hash,
+                chain_hash=checkpoint_hash(previous_hash, first_id, last_id, len(leaves), root),
+            ))
+            watermark.last_id = last_id
+            watermark.save(update_fields=['last_id', 'updated_at'])
+
+    with transaction.atomic():
+        watermark = AuditLogWatermark.objects.select_for_update().get(name=WATERMARK)
+        latest = AuditLog.objects.aggregate(latest=Max('id'))['latest'] or 0
+        watermark.pending_id = max(latest, watermark.pending_id)
+        watermark.save(update_fields=['pending_id', 'updated_at'])
+
+    return created
+
+
+def build_proof(log):
+    """
+    Inclusion proof of ``log`` in its checkpoint, or ``None`` while the log
+    has not been sealed yet or retention dropped part of its checkpoint.
+    """
+    from .models import AuditChainCheckpoint
+
+    checkpoint = AuditChainCheckpoint.objects.filter(first_id__lte=log.id, last_id__gte=log.id).first()
+    if checkpoint is None or checkpoint.expired_at is not None:
+        return None
+
+    leaves = _leaves(checkpoint)
+    ids = [log_id for log_id, _ in leaves]
+    if log.id not in ids:
+        return None
+    index = ids.index(log.id)
+    hashes = [leaf for _, leaf in leaves]
+    return {
+        'id': log.id,
+        'entry_hash': log.entry_hash,
+        'leaf_hash': hashes[index].hex(),
+        'leaf_index': index,
+        'tree_size': checkpoint.size,
+        'audit_path': [node.hex() for node in inclusion_proof(hashes, index)],
+        'checkpoint': {
+            'id': checkpoint.id,
+            'first_id': checkpoint.first_id,
+            'last_id': checkpoint.last_id,
+            'merkle_root': checkpoint.merkle_root,
+            'previous_hash': checkpoint.previous_hash,
+            'chain_hash': checkpoint.chain_hash,
+            'created_at': checkpoint.created_at,
+        },
+    }
+
+
+class VerificationResult:
+    def __init__(self):
+        self.checked = 0
+        self.unsealed = 0
+        self.checkpoints = 0
+        self.errors = []
+
+    @property
+    def ok(self):
+        return not self.errors
+
+
+def verify_range(start=None, end=None, batch_size=5000, on_checkpoint=None):
+    """
+    Verify the logs with timestamps in ``[start, end)``.
+
+    Only checkpoints overlapping the range are rehashed, each from a single
+    pass over its rows, and each is linked to its predecessor. Logs newer
+    than the last checkpoint are checked against their entry hash alone, as
+    are the remaining logs of checkpoints expired by partition retention.
+    """
+    from .models import AuditChainCheckpoint, AuditLog
+
+    result = VerificationResult()
+    checkpoints = AuditChainCheckpoint.objects.order_by('first_id')
+    if start is not None:
+        checkpoints = checkpoints.filter(last_timestamp__gte=start)
+    if end is not None:
+        checkpoints = checkpoints.filter(first_timestamp__lt=end)
+
+    previous = None
+    for checkpoint in checkpoints.iterator():
+        if previous is None or previous.last_id != checkpoint.first_id - 1:
+            previous = AuditChainCheckpoint.objects.filter(last_id__lt=checkpoint.first_id).order_by('-last_id').first()
+        expected_previous = previous.chain_hash if previous else GENESIS_HASH
+        expected_first = previous.last_id + 1 if previous else checkpoint.first_id
+
+        if checkpoint.previous_hash != expected_previous or checkpoint.first_id != expected_first:
+            result.errors.append(f'Checkpoint {checkpoint.id} does not follow checkpoint {previous.id if previous else "-"}')
+        if checkpoint.chain_hash != checkpoint_hash(
+            checkpoint.previous_hash, checkpoint.first_id, checkpoint.last_id, checkpoint.size, checkpoint.merkle_root
+        ):
+            result.errors.append(f'Checkpoint {checkpoint.id} has an invalid chain hash')
+
+        leaves = []
+        rows = _rows(checkpoint.first_id, checkpoint.last_id,
+                     checkpoint.first_timestamp, checkpoint.last_timestamp)
+        for log_id, stored, computed, _ in iter_entries(rows.iterator(chunk_size=batch_size)):
+            if stored is None:
+                result.errors.append(f'Audit log {log_id} has no entry hash')
+            elif stored != computed:
+                result.errors.append(f'Audit log {log_id} was modified')
+            leaves.append(leaf_hash(log_id, computed))
+            result.checked += 1
+        if checkpoint.expired_at is not None:
+            # Retention dropped part of the sealed logs; only the chain link
+            # and the remaining rows can still be checked
+            pass
+        elif len(leaves) != checkpoint.size:
+            result.errors.append(
+                f'Checkpoint {checkpoint.id} sealed {checkpoint.size} logs, found {len(leaves)}'
+            )
+        elif merkle_root(leaves).hex() != checkpoint.merkle_root:
+            result.errors.append(f'Checkpoint {checkpoint.id} Merkle root does not match its logs')
+
+        result.checkpoints += 1
+        previous = checkpoint
+        if on_checkpoint:
+            on_checkpoint(checkpoint, result)
+
+    sealed_until = AuditChainCheckpoint.objects.aggregate(last=Max('last_id'))['last'] or 0
+    tail = AuditLog.objects.filter(id__gt=sealed_until)
+    if start is not None:
+        tail = tail.filter(timestamp__gte=start)
+    if end is not None:
+        tail = tail.filter(timestamp__lt=end)
+    rows = tail.order_by('id').values_list('id', 'entry_hash', *HASHED_LOOKUPS)
+    for log_id, stored, computed, _ in iter_entries(rows.iterator(chunk_size=batch_size)):
+        if stored is None:
+            result.errors.append(f'Audit log {log_id} has no entry hash')
+        elif stored != computed:
+            result.errors.append(f'Audit log {log_id} was modified')
+        result.unsealed += 1
+
+    return result
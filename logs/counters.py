@@ -0,0 +1,297 @@
+"""
+Shared counters and buffers for security detection and alerting.
+
+Windows use the two-bucket approximation: a fixed bucket of ``window``
+seconds is counted exactly and the previous bucket is weighted by how much
+of it still overlaps the sliding window. Each update is O(1), and on Redis
+a single round-trip. Distinct counts keep when each member was last seen
+(a sorted set on Redis), bounded to ``max_members`` per key.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+
+def _sliding(previous, current, window, now):
+    elapsed = (now % window) / window
+    return previous * (1 - elapsed) + current
+
+
+class BaseCounterStore:
+    key_prefix = 'audit:'
+    # Members kept per key by add_members
+    max_members = 1000
+
+    def __init__(self, key_prefix=None, **options):
+        if key_prefix is not None:
+            self.key_prefix = key_prefix
+
+    def hit(self, key, window, amount=1, now=None):
+        """Add ``amount`` to ``key`` and return the sliding count over ``window`` seconds"""
+        raise NotImplementedError
+
+    def hit_many(self, hits, now=None):
+        """``hit`` for each ``(key, window, amount)``; returns the sliding counts in order"""
+        return [self.hit(key, window, amount, now) for key, window, amount in hits]
+
+    def add_members(self, key, members, window, now=None):
+        """
+        Note ``members`` as seen under ``key`` and return how many distinct
+        members were seen over the last ``window`` seconds (at most
+        ``max_members``, the newest of which are kept)
+        """
+        raise NotImplementedError
+
+    def add_members_many(self, updates, now=None):
+        """``add_members`` for each ``(key, members, window)``; returns the counts in order"""
+        return [self.add_members(key, members, window, now) for key, members, window in updates]
+
+    def add_once(self, key, ttl):
+        """Set ``key`` for ``ttl`` seconds unless already set; True if this call set it"""
+        raise NotImplementedError
+
+    def incr(self, key, amount=1):
+        """Add ``amount`` to a plain counter and return its new value"""
+        raise NotImplementedError
+
+    def get_counts(self, keys):
+        """Return ``{key: value}`` for plain counters, 0 when missing"""
+        raise NotImplementedError
+
+    def push(self, key, value, ttl, max_len):
+        """Append ``value`` to a list, keeping only the newest ``max_len`` items"""
+        raise NotImplementedError
+
+    def drain(self, key):
+        """Atomically remove a list; return ``(items, number of items ever pushed)``"""
+        raise NotImplementedError
+
+    def incr_fields(self, key, amounts):
+        """Add each of ``{field: amount}`` (floats allowed) to the fields of a hash"""
+        raise NotImplementedError
+
+    def get_fields(self, key):
+        """Return every ``{field: value}`` of a hash"""
+        raise NotImplementedError
+
+
+class LocalCounterStore(BaseCounterStore):
+    """In-process store for tests and single-process development"""
+
+    def __init__(self, max_keys=100000, **options):
+        super().__init__(**options)
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._flags = {}
+        self._counts = {}
+        self._lists = {}
+        self._hashes = {}
+        self._members = {}
+
+    def hit(self, key, window, amount=1, now=None):
+        now = time.time() if now is None else now
+        index = int(now // window)
+        key = (key, window)
+        with self._lock:
+            bucket, current, previous = self._buckets.get(key, (index, 0, 0))
+            if bucket != index:
+                previous = current if bucket == index - 1 else 0
+                current = 0
+            current += amount
+            self._buckets[key] = (index, current, previous)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+        return _sliding(previous, current, window, now)
+
+    def _prune(self, now):
+        self._buckets = {
+            (key, window): value for (key, window), value in self._buckets.items()
+            if value[0] >= int(now // window) - 1
+        }
+        monotonic = time.monotonic()
+        self._flags = {key: expiry for key, expiry in self._flags.items() if expiry > monotonic}
+        self._members = {
+            key: (window, seen) for key, (window, seen) in self._members.items()
+            if seen and max(seen.values()) > now - window
+        }
+
+    def add_members(self, key, members, window, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            _, seen = self._members.get(key, (window, {}))
+            for member in members:
+                seen[member] = now
+            seen = {member: at for member, at in seen.items() if at > now - window}
+            if len(seen) > self.max_members:
+                seen = dict(sorted(seen.items(), key=lambda item: item[1])[-self.max_members:])
+            self._members[key] = (window, seen)
+            if len(self._members) > self.max_keys:
+                self._prune(now)
+            return len(seen)
+
+    def add_once(self, key, ttl):
+        now = time.monotonic()
+        with self._lock:
+            if self._flags.get(key, 0) > now:
+                return False
+            self._flags[key] = now + ttl
+            return True
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + amount
+            return self._counts[key]
+
+    def get_counts(self, keys):
+        with self._lock:
+            return {key: self._counts.get(key, 0) for key in keys}
+
+    def push(self, key, value, ttl, max_len):
+        with self._lock:
+            items, total = self._lists.get(key, ([], 0))
+            items = (items + [value])[-max_len:]
+            self._lists[key] = (items, total + 1)
+
+    def drain(self, key):
+        with self._lock:
+            return self._lists.pop(key, ([], 0))
+
+    def incr_fields(self, key, amounts):
+        with self._lock:
+            fields = self._hashes.setdefault(key, {})
+            for field, amount in amounts.items():
+                fields[field] = fields.get(field, 0) + amount
+
+    def get_fields(self, key):
+        with self._lock:
+            return dict(self._hashes.get(key, {}))
+
+
+class RedisCounterStore(BaseCounterStore):
+    """Store shared by every web and worker process through Redis"""
+
+    def __init__(self, url='redis://localhost:6379/0', **options):
+        super().__init__(**options)
+        self.url = url
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    def hit(self, key, window, amount=1, now=None):
+        now = time.time() if now is None else now
+        index = int(now // window)
+        current_key = f'{self.key_prefix}{key}:{window}:{index}'
+        previous_key = f'{self.key_prefix}{key}:{window}:{index - 1}'
+
+        pipe = self.client.pipeline(transaction=False)
+        pipe.incrby(current_key, amount)
+        pipe.expire(current_key, window * 2)
+        pipe.get(previous_key)
+        current, _, previous = pipe.execute()
+        return _sliding(int(previous or 0), current, window, now)
+
+    def hit_many(self, hits, now=None):
+        now = time.time() if now is None else now
+        pipe = self.client.pipeline(transaction=False)
+        for key, window, amount in hits:
+            index = int(now // window)
+            current_key = f'{self.key_prefix}{key}:{window}:{index}'
+            pipe.incrby(current_key, amount)
+            pipe.expire(current_key, window * 2)
+            pipe.get(f'{self.key_prefix}{key}:{window}:{index - 1}')
+        results = pipe.execute()
+        return [
+            _sliding(int(results[i + 2] or 0), results[i], window, now)
+            for i, (_, window, _) in zip(range(0, len(results), 3), hits)
+        ]
+
+    def add_members(self, key, members, window, now=None):
+        return self.add_members_many([(key, members, window)], now)[0]
+
+    def add_members_many(self, updates, now=None):
+        # One sorted set per key, scored by when each member was last seen
+        now = time.time() if now is None else now
+        pipe = self.client.pipeline(transaction=False)
+        for key, members, window in updates:
+            set_key = f'{self.key_prefix}{key}'
+            pipe.zadd(set_key, {member: now for member in members})
+            pipe.zremrangebyscore(set_key, '-inf', now - window)
+            pipe.zremrangebyrank(set_key, 0, -self.max_members - 1)
+            pipe.zcard(set_key)
+            pipe.expire(set_key, int(window) + 1)
+        results = pipe.execute()
+        return results[3::5]
+
+    def add_once(self, key, ttl):
+        return bool(self.client.set(f'{self.key_prefix}{key}', 1, nx=True, ex=int(ttl)))
+
+    def incr(self, key, amount=1):
+        return self.client.incrby(f'{self.key_prefix}{key}', amount)
+
+    def get_counts(self, keys):
+        values = self.client.mget([f'{self.key_prefix}{key}' for key in keys])
+        return {key: int(value or 0) for key, value in zip(keys, values)}
+
+    def push(self, key, value, ttl, max_len):
+        list_key = f'{self.key_prefix}{key}'
+        pipe = self.client.pipeline(transaction=False)
+        pipe.rpush(list_key, value)
+        pipe.ltrim(list_key, -max_len, -1)
+        pipe.expire(list_key, int(ttl))
+        pipe.incr(f'{list_key}:total')
+        pipe.expire(f'{list_key}:total', int(ttl))
+        pipe.execute()
+
+    def drain(self, key):
+        list_key = f'{self.key_prefix}{key}'
+        pipe = self.client.pipeline(transaction=True)
+        pipe.lrange(list_key, 0, -1)
+        pipe.get(f'{list_key}:total')
+        pipe.delete(list_key, f'{list_key}:total')
+        items, total, _ = pipe.execute()
+        return [item.decode('utf-8') for item in items], int(total or 0)
+
+    def incr_fields(self, key, amounts):
+        hash_key = f'{self.key_prefix}{key}'
+        pipe = self.client.pipeline(transaction=False)
+        for field, amount in amounts.items():
+            pipe.hincrbyfloat(hash_key, field, amount)
+        pipe.execute()
+
+    def get_fields(self, key):
+        values = self.client.hgetall(f'{self.key_prefix}{key}')
+        return {field.decode('utf-8'): float(value) for field, value in values.items()}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_counter_store():
+    """Return the process-wide store configured by ``AUDIT_COUNTER_STORE``"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = getattr(settings, 'AUDIT_COUNTER_STORE', {})
+                backend = import_string(config.get('BACKEND', 'logs.counters.LocalCounterStore'))
+                _store = backend(**config.get('OPTIONS', {}))
+    return _store
+
+
+def reset_counter_store(**kwargs):
+    global _store
+    if kwargs.get('setting', 'AUDIT_COUNTER_STORE') == 'AUDIT_COUNTER_STORE':
+        _store = None
+
+
+setting_changed.connect(reset_counter_store)
@@ -0,0 +1,318 @@
+"""
+Network classification of the IP address of every audit log.
+
+Audit logs are tagged when they are written with
+
+- ``ip_network``: ``internal``, ``vpn``, ``cloud`` or any other class from
+  the networks file, ``public`` otherwise
+- ``ip_network_name``: the name given to that network, e.g. the provider
+- ``ip_country``: two-letter country code
+- ``ip_blocklisted``: whether the address is on the blocklist
+
+from CIDR files in ``AUDIT_IP_DATA_DIR``:
+
+- ``networks.csv``: ``cidr,class[,name]`` rows
+- ``blocklist.txt``: one CIDR per line
+- ``countries.csv``: ``cidr,country`` or ``first_ip,last_ip,country`` rows
+  (the DB-IP lite format)
+
+Blank lines and lines starting with ``#`` are skipped, and missing files
+are treated as empty. Private, loopback and link-local ranges are
+``internal`` unless the networks file says otherwise.
+
+Each file becomes an interval index: the ranges are flattened into
+disjoint intervals, the most specific range winning where they nest, and
+kept as sorted arrays of starts and ends per address family, so a lookup
+is one ``bisect`` per file. Lookups go through a bounded LRU cache, as
+logs come from comparatively few addresses. The files are checked every
+``AUDIT_IP_DATA_CHECK_INTERVAL`` seconds and reloaded in a background
+thread when they change, without restarting workers.
+"""
+import csv
+import logging
+import os
+import socket
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from functools import lru_cache
+from ipaddress import ip_network
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+logger = logging.getLogger(__name__)
+
+NETWORKS_FILE = 'networks.csv'
+BLOCKLIST_FILE = 'blocklist.txt'
+COUNTRIES_FILE = 'countries.csv'
+
+PUBLIC = 'public'
+INTERNAL = 'internal'
+
+INTERNAL_NETWORKS = [
+    '10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16', '127.0.0.0/8', '169.254.0.0/16',
+    '::1/128', 'fc00::/7', 'fe80::/10',
+]
+
+# Stored as AuditLog.ip_network, ip_network_name, ip_country and ip_blocklisted
+IPInfo = namedtuple('IPInfo', ['network', 'network_name', 'country', 'blocklisted'])
+
+
+def parse_ip(value):
+    """``(version, integer)`` of an IP address string, or None if it is not one"""
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, value), 'big')
+    except (OSError, TypeError):
+        pass
+    try:
+        number = int.from_bytes(socket.inet_pton(socket.AF_INET6, value.split('%', 1)[0]), 'big')
+    except (OSError, TypeError, AttributeError):
+        return None
+    if number >> 32 == 0xFFFF:
+        return 4, number & 0xFFFFFFFF  # IPv4-mapped
+    return 6, number
+
+
+class IntervalIndex:
+    """
+    Values of IP ranges, looked up by address. Add ``(first, last, value)``
+    ranges with ``add``, then ``build`` once; where ranges overlap, the one
+    starting later (the inner one, when they nest) wins, and among
+    identical ranges the last added.
+    """
+
+    def __init__(self):
+        self._ranges = {4: [], 6: []}
+        self._starts = {}
+        self._ends = {}
+        self._values = {}
+
+    def add(self, version, first, last, value):
+        self._ranges[version].append((first, last, value))
+
+    def add_network(self, network, value):
+        network = ip_network(network, strict=False)
+        self.add(network.version, int(network.network_address), int(network.broadcast_address), value)
+
+    def build(self):
+        for version, ranges in self._ranges.items():
+            # Sorted by start, outer ranges first; stable, so later duplicates come last
+            ranges.sort(key=lambda item: (item[0], -item[1]))
+            starts, ends, values = [], [], []
+
+            def emit(first, last, value):
+                if first > last:
+                    return
+                if values and values[-1] == value and ends[-1] + 1 == first:
+                    ends[-1] = last
+                else:
+                    starts.append(first)
+                    ends.append(last)
+                    values.append(value)
+
+            open_ranges = []  # (last, value) of the ranges containing the position
+            position = 0
+            for first, last, value in ranges:
+                while open_ranges and open_ranges[-1][0] < first:
+                    end, outer = open_ranges.pop()
+                    emit(position, end, outer)
+                    position = max(position, end + 1)
+                if open_ranges:
+                    emit(position, first - 1, open_ranges[-1][1])
+                open_ranges.append((last, value))
+                position = first
+            while open_ranges:
+                end, outer = open_ranges.pop()
+                emit(position, end, outer)
+                position = max(position, end + 1)
+
+            if version == 4:
+                self._starts[version] = array('I', starts)
+                self._ends[version] = array('I', ends)
+            else:
+                self._starts[version] = starts
+                self._ends[version] = ends
+            self._values[version] = values
+        self._ranges = None
+        return self
+
+    def __len__(self):
+        return sum(len(values) for values in self._values.values())
+
+    def get(self, version, number, default=None):
+        index = bisect_right(self._starts[version], number) - 1
+        if index >= 0 and number <= self._ends[version][index]:
+            return self._values[version][index]
+        return default
+
+
+def _rows(path):
+    try:
+        with open(path, newline='', encoding='utf-8') as f:
+            for line_number, row in enumerate(csv.reader(f), 1):
+                if not row or not row[0].strip() or row[0].lstrip().startswith('#'):
+                    continue
+                yield line_number, [column.strip() for column in row]
+    except FileNotFoundError:
+        return
+
+
+def _add_rows(index, path, parse):
+    for line_number, row in _rows(path):
+        try:
+            parse(index, row)
+        except (ValueError, IndexError) as e:
+            logger.warning('Skipping %s line %d: %s', path, line_number, e)
+
+
+def _parse_network(index, row):
+    index.add_network(row[0], (row[1].lower(), row[2] if len(row) > 2 and row[2] else None))
+
+
+def _parse_blocked(index, row):
+    index.add_network(row[0], True)
+
+
+def _parse_country(index, row):
+    if len(row) >= 3:
+        first, last = parse_ip(row[0]), parse_ip(row[1])
+        if first is None or last is None or first[0] != last[0] or first[1] > last[1]:
+            raise ValueError(f'invalid range {row[0]} - {row[1]}')
+        index.add(first[0], first[1], last[1], row[2].upper())
+    else:
+        index.add_network(row[0], row[1].upper())
+
+
+class IPEnricher:
+    """The indexes built from one version of the data files"""
+
+    def __init__(self, directory, cache_size):
+        self.networks = IntervalIndex()
+        for network in INTERNAL_NETWORKS:
+            self.networks.add_network(network, (INTERNAL, None))
+        _add_rows(self.networks, os.path.join(directory, NETWORKS_FILE), _parse_network)
+        self.networks.build()
+
+        self.blocklist = IntervalIndex()
+        _add_rows(self.blocklist, os.path.join(directory, BLOCKLIST_FILE), _parse_blocked)
+        self.blocklist.build()
+
+        self.countries = IntervalIndex()
+        _add_rows(self.countries, os.path.join(directory, COUNTRIES_FILE), _parse_country)
+        self.countries.build()
+
+        self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def _lookup(self, value):
+        """``IPInfo`` of an IP address (string), or None if it is not one"""
+        parsed = parse_ip(str(value)) if value else None
+        if parsed is None:
+            return None
+        version, number = parsed
+        network, network_name = self.networks.get(version, number, (PUBLIC, None))
+        return IPInfo(
+            network, network_name,
+            self.countries.get(version, number),
+            self.blocklist.get(version, number, False),
+        )
+
+    def enrich(self, entries):
+        """Set the IP columns of unsaved ``AuditLog`` entries not tagged yet"""
+        lookup = self.lookup
+        for entry in entries:
+            if entry.ip_network is not None:
+                continue
+            info = lookup(entry.ip_address)
+            if info is not None:
+                entry.ip_network, entry.ip_network_name, entry.ip_country, entry.ip_blocklisted = info
+
+
+def _signature(directory):
+    """What identifies the current version of the data files"""
+    signature = []
+    for name in (NETWORKS_FILE, BLOCKLIST_FILE, COUNTRIES_FILE):
+        try:
+            stat = os.stat(os.path.join(directory, name))
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+_enricher = None
+_signature_loaded = None
+_checked_at = 0.0
+_reloading = False
+_lock = threading.Lock()
+
+
+def _load(directory):
+    signature = _signature(directory)
+    started = time.perf_counter()
+    enricher = IPEnricher(directory, settings.AUDIT_IP_CACHE_SIZE)
+    logger.info(
+        'Loaded IP data from %s in %.2fs: %d network, %d blocklist and %d country ranges',
+        directory, time.perf_counter() - started,
+        len(enricher.networks), len(enricher.blocklist), len(enricher.countries),
+    )
+    return enricher, signature
+
+
+def _reload(directory):
+    global _enricher, _signature_loaded, _reloading
+    try:
+        enricher, signature = _load(directory)
+        with _lock:
+            _enricher, _signature_loaded = enricher, signature
+    except Exception:
+        logger.exception('Reloading IP data from %s failed; keeping the previous data', directory)
+    finally:
+        _reloading = False
+
+
+def get_ip_enricher():
+    """
+    Return the enricher for the current data files. Changed files are
+    reloaded in the background while the previous data keeps serving.
+    """
+    global _enricher, _signature_loaded, _checked_at, _reloading
+    directory = settings.AUDIT_IP_DATA_DIR
+    if _enricher is None:
+        with _lock:
+            if _enricher is None:
+                _enricher, _signature_loaded = _load(directory)
+                _checked_at = time.monotonic()
+        return _enricher
+
+    now = time.monotonic()
+    if now - _checked_at >= settings.AUDIT_IP_DATA_CHECK_INTERVAL:
+        with _lock:
+            if now - _checked_at >= settings.AUDIT_IP_DATA_CHECK_INTERVAL:
+                _checked_at = now
+                if not _reloading and _signature(directory) != _signature_loaded:
+                    _reloading = True
+                    threading.Thread(
+                        target=_reload, args=(directory,), name='audit-ip-data-reload', daemon=True
+                    ).start()
+    return _enricher
+
+
+def enrich(entries):
+    """Tag ``entries`` with the classification of their IP address"""
+    try:
+        get_ip_enricher().enrich(entries)
+    except Exception:
+        # A broken data file must not stop audit logs from being written
+        logger.exception('IP enrichment failed for %d audit log(s)', len(entries))
+
+
+def reset_ip_enricher(**kwargs):
+    global _enricher
+    if kwargs.get('setting') in (None, 'AUDIT_IP_DATA_DIR', 'AUDIT_IP_CACHE_SIZE'):
+        _enricher = None
+
+
+setting_changed.connect(reset_ip_enricher)
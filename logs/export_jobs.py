@@ -0,0 +1,315 @@
+"""
+Background exports of audit logs.
+
+``create_job`` records an ``AuditLogExport`` for the filters of a request
+and queues one ``export_audit_log_shard`` task per shard: the requested
+time range cut into slices of ``AUDIT_EXPORT_SHARD_HOURS`` (at most
+``AUDIT_EXPORT_MAX_SHARDS`` of them). Workers write the shards in
+parallel, each to its own file in the ``audit_exports`` storage, so an
+export is bounded by the number of workers rather than by one HTTP
+request. The worker storing the last shard completes the job.
+
+A CSV or NDJSON export is its shards concatenated in order: only the
+first CSV shard has a header, and each compressed shard is a complete
+gzip member, which gzip readers take in sequence. Downloads stream the
+shards one after the other, without a merge step, and serve byte ranges
+across them so an interrupted download resumes where it stopped. Parquet
+shards are merged into one file once the last is written.
+"""
+import logging
+import re
+import tempfile
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import storages
+from django.db import transaction
+from django.utils import timezone
+
+from .exporters import (
+    EXPORT_FORMATS, ExportCounter, parquet_schema, parquet_supported, stream_export, write_parquet,
+)
+
+logger = logging.getLogger(__name__)
+
+STORAGE = 'audit_exports'
+
+PENDING = 'pending'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+PARQUET = ('application/vnd.apache.parquet', 'parquet')
+
+# Bytes read from storage per chunk of a download
+DOWNLOAD_CHUNK_BYTES = 256 * 1024
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def get_storage():
+    return storages[STORAGE]
+
+
+def job_formats():
+    """``{format: (content type, extension)}`` of the formats jobs can write"""
+    formats = dict(EXPORT_FORMATS)
+    if parquet_supported():
+        formats['parquet'] = PARQUET
+    return formats
+
+
+def filename(job):
+    _, extension = job_formats().get(job.export_format, PARQUET)
+    name = f'audit_logs_{job.created_at.date()}_{job.pk}.{extension}'
+    return name + '.gz' if job.compress else name
+
+
+def content_type(job):
+    if job.compress:
+        return 'application/gzip'
+    return job_formats().get(job.export_format, PARQUET)[0]
+
+
+def split_range(start, end, hours, max_shards):
+    """``[start, end)`` cut into at most ``max_shards`` slices of ``hours``, widened to fit"""
+    width = timedelta(hours=hours)
+    if (end - start) / width > max_shards:
+        width = (end - start) / max_shards
+    bounds = []
+    lower = start
+    while lower < end:
+        upper = min(lower + width, end)
+        bounds.append((lower, upper))
+        lower = upper
+    return bounds or [(start, end)]
+
+
+def create_job(user, ip_address, queryset, params, start, end, export_format, compress, descending):
+    """
+    Record an export of ``queryset``, the list of ``user`` filtered by the
+    query ``params`` and the ``start``/``end`` dates (either may be None),
+    and queue its shards once the job is committed
+    """
+    from .models import AuditLogExport
+    from .tasks import export_audit_log_shard
+
+    # The range is fixed now, so logs written while the export runs are left out
+    end = min(end, timezone.now()) if end else timezone.now()
+    first = queryset.order_by('timestamp').values_list('timestamp', flat=True).first()
+    start = max(start, first) if start and first else start or first or end
+    # end_date is inclusive in the list filters, shard ends are exclusive
+    end += timedelta(microseconds=1)
+    start = min(start, end)
+
+    bounds = split_range(start, end, settings.AUDIT_EXPORT_SHARD_HOURS, settings.AUDIT_EXPORT_MAX_SHARDS)
+    if descending:
+        bounds.reverse()
+    job = AuditLogExport.objects.create(
+        user=user,
+        ip_address=ip_address,
+        export_format=export_format,
+        compress=compress and export_format != 'parquet',
+        # The shards apply the dates
+        filters={key: values for key, values in params.items() if key not in ('start_date', 'end_date')},
+        descending=descending,
+        shard_bounds=[[lower.isoformat(), upper.isoformat()] for lower, upper in bounds],
+        files=[None] * len(bounds),
+    )
+
+    def queue_shards():
+        for index in range(len(bounds)):
+            export_audit_log_shard.delay(job.pk, index)
+
+    transaction.on_commit(queue_shards)
+    return job
+
+
+def shard_queryset(job, index):
+    """The logs of shard ``index`` of ``job``, in file order"""
+    from .views import AuditLogViewSet
+
+    lower, upper = (datetime.fromisoformat(value) for value in job.shard_bounds[index])
+    queryset = AuditLogViewSet.filtered_queryset(job.user, job.filters)
+    queryset = queryset.filter(timestamp__gte=lower, timestamp__lt=upper)
+    if job.descending:
+        return queryset.order_by('-timestamp', '-id')
+    return queryset.order_by('timestamp', 'id')
+
+
+def write_shard(job, index):
+    """Write shard ``index`` of ``job`` to storage; returns its name, size and row count"""
+    queryset = shard_queryset(job, index)
+    counter = ExportCounter()
+    with tempfile.TemporaryFile() as file:
+        if job.export_format == 'parquet':
+            write_parquet(queryset, file, counter)
+        else:
+            for chunk in stream_export(queryset, job.export_format, counter,
+                                       compress=job.compress, header=index == 0):
+                file.write(chunk)
+        size = file.tell()
+        file.seek(0)
+        name = get_storage().save(f'shard-{index:05d}-{filename(job)}', File(file))
+    return name, size, counter.count
+
+
+def run_shard(job_id, index):
+    """
+    Write one shard and record it on the job. Reruns of a stored shard
+    change nothing, so tasks can be retried.
+    """
+    from .models import AuditLogExport
+
+    job = AuditLogExport.objects.filter(pk=job_id).first()
+    if job is None or job.status in (COMPLETED, FAILED) or job.files[index] is not None:
+        return
+    if job.status == PENDING:
+        AuditLogExport.objects.filter(pk=job_id, status=PENDING).update(
+            status=RUNNING, started_at=timezone.now()
+        )
+    if not job.user.is_active or not job.user.is_staff:
+        fail(job_id, 'The requesting user can no longer export logs')
+        return
+
+    try:
+        name, size, rows = write_shard(job, index)
+    except Exception as e:
+        logger.exception('Export %s failed writing shard %d', job_id, index)
+        fail(job_id, f'Shard {index} failed: {e}')
+        raise
+
+    with transaction.atomic():
+        job = AuditLogExport.objects.select_for_update().get(pk=job_id)
+        stored = job.status != FAILED and job.files[index] is None
+        if stored:
+            job.files[index] = [name, size]
+            job.shards_done += 1
+            job.rows += rows
+            job.save(update_fields=['files', 'shards_done', 'rows'])
+    if not stored:
+        get_storage().delete(name)
+    elif job.shards_done == job.shards:
+        complete(job)
+
+
+def merge_parquet(job):
+    """Merge the Parquet shards of ``job`` into one file, replacing them"""
+    import pyarrow.parquet as pq
+
+    storage = get_storage()
+    with tempfile.TemporaryFile() as file:
+        with pq.ParquetWriter(file, parquet_schema(), compression='zstd') as writer:
+            for name, _ in job.files:
+                with storage.open(name) as shard:
+                    parquet = pq.ParquetFile(shard)
+                    for group in range(parquet.num_row_groups):
+                        writer.write_table(parquet.read_row_group(group))
+        size = file.tell()
+        file.seek(0)
+        name = storage.save(filename(job), File(file))
+    for shard, _ in job.files:
+        storage.delete(shard)
+    return [[name, size]]
+
+
+def complete(job):
+    from .models import AuditLog
+
+    try:
+        if job.export_format == 'parquet':
+            job.files = merge_parquet(job)
+    except Exception as e:
+        logger.exception('Export %s failed merging its shards', job.pk)
+        fail(job.pk, f'Merging the shards failed: {e}')
+        raise
+    job.size = sum(size for _, size in job.files)
+    job.status = COMPLETED
+    job.completed_at = timezone.now()
+    job.save(update_fields=['files', 'size', 'status', 'completed_at'])
+
+    AuditLog.log_action(
+        user=job.user,
+        action='EXPORT',
+        resource='AuditLog',
+        ip_address=job.ip_address,
+        details={
+            'exported_count': job.rows,
+            'format': job.export_format,
+            'filters': job.filters,
+            'export_job': job.pk,
+        }
+    )
+
+
+def fail(job_id, error):
+    from .models import AuditLogExport
+
+    AuditLogExport.objects.filter(pk=job_id).exclude(status=FAILED).update(
+        status=FAILED, error=error, completed_at=timezone.now()
+    )
+
+
+def parse_range(header, size):
+    """
+    ``(first, last)`` byte positions of a ``Range`` header over ``size``
+    bytes, or None to send everything. Only single ranges are served; a
+    list of ranges gets the whole file, as RFC 9110 allows.
+    """
+    match = _RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last ``last`` bytes
+        first, last = max(size - int(last), 0), size - 1
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last:
+        raise RangeNotSatisfiable
+    return first, last
+
+
+def iter_range(job, first, last):
+    """Yield the bytes ``first`` to ``last`` (inclusive) of the export, across its files"""
+    storage = get_storage()
+    offset = 0
+    for name, size in job.files:
+        if offset + size <= first:
+            offset += size
+            continue
+        if offset > last:
+            break
+        with storage.open(name) as file:
+            position = max(first - offset, 0)
+            file.seek(position)
+            remaining = min(last - offset + 1, size) - position
+            while remaining > 0:
+                data = file.read(min(DOWNLOAD_CHUNK_BYTES, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        offset += size
+
+
+def expire_jobs():
+    """Delete exports older than ``AUDIT_EXPORT_RETENTION_HOURS`` and their files"""
+    from .models import AuditLogExport
+
+    storage = get_storage()
+    cutoff = timezone.now() - timedelta(hours=settings.AUDIT_EXPORT_RETENTION_HOURS)
+    expired = list(AuditLogExport.objects.filter(created_at__lt=cutoff))
+    for job in expired:
+        for entry in job.files:
+            if entry is not None:
+                storage.delete(entry[0])
+    AuditLogExport.objects.filter(pk__in=[job.pk for job in expired]).delete()
+    return len(expired)
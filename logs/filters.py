@@ -0,0 +1,198 @@
+"""
+Search and ``details`` filtering for audit logs.
+
+``?q=`` matches the identifier columns in ``TRIGRAM_SEARCH_FIELDS`` by
+substring and ``details`` by full-text search. On PostgreSQL both are
+served by GIN indexes (pg_trgm and tsvector), so a search costs index
+lookups rather than a scan of ``audit_logs``, and results are ranked by
+relevance unless an explicit ``ordering`` is requested. User agents are
+matched by substring in the small ``UserAgent`` table first, and their
+logs found through the ``agent`` index with the ids as a literal list: an
+``IN (SELECT ...)`` subquery would be a hashed SubPlan, which PostgreSQL
+cannot combine with the other indexes and checks on every row instead.
+
+``?details.<key>[__<op>]=<value>`` filters on keys of the ``details`` JSON.
+Equality becomes a ``details @> {...}`` containment test served by the GIN
+``jsonb_path_ops`` index; ranges and prefixes on the keys listed in
+``DETAILS_INDEXED_KEYS`` are served by their expression indexes.
+"""
+import json
+import re
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connections
+from django.db.models import Case, F, FloatField, Q, Value, When
+from django.db.models.functions import Cast
+from rest_framework import filters
+from rest_framework.exceptions import ValidationError
+
+from .models import TRIGRAM_SEARCH_FIELDS, UserAgent, search_vector
+
+DETAILS_PARAM = 'details'
+DETAILS_LOOKUPS = ['in', 'gt', 'gte', 'lt', 'lte', 'startswith', 'isnull']
+
+_DETAILS_KEY_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+SEARCH_RANK = 'search_rank'
+
+# User agents a search term may match and still be looked up by id; a
+# term matching more is too common to narrow the search much, and is
+# matched through a join instead
+SEARCH_MAX_USER_AGENTS = 1000
+
+
+class AuditLogSearchFilter(filters.SearchFilter):
+    """
+    ``?q=`` search (``?search=`` is still accepted).
+
+    Every whitespace separated term has to match one identifier column or
+    the user agent, or the whole query has to match the full-text
+    document. Full-text queries use websearch syntax: ``"quoted
+    phrases"``, ``or`` and ``-excluded``.
+    """
+    search_param = 'q'
+    legacy_search_param = 'search'
+
+    def get_search_terms(self, request):
+        params = request.query_params.get(self.search_param) or \
+            request.query_params.get(self.legacy_search_param, '')
+        return params.replace('\x00', '')
+
+    def filter_queryset(self, request, queryset, view):
+        query = self.get_search_terms(request).strip()
+        if not query:
+            return queryset
+
+        fields = getattr(view, 'search_fields', None) or TRIGRAM_SEARCH_FIELDS
+        identifier_match = Q()
+        for term in query.split():
+            term_match = Q(*[Q(**{f'{field}__icontains': term}) for field in fields], _connector=Q.OR)
+            identifier_match &= term_match | self.user_agent_match(term)
+
+        if connections[queryset.db].vendor != 'postgresql':
+            return queryset.filter(
+                identifier_match |
+                Q(details__icontains=query)
+            )
+
+        text_query = SearchQuery(query, config='simple', search_type='websearch')
+        return (
+            queryset
+            .annotate(search_document=search_vector())
+            .filter(identifier_match | Q(search_document=text_query))
+            .annotate(**{
+                SEARCH_RANK: Cast(
+                    Case(When(identifier_match, then=Value(1.0)), default=Value(0.0)) +
+                    SearchRank(F('search_document'), text_query),
+                    FloatField()
+                )
+            })
+        )
+
+    @staticmethod
+    def user_agent_match(term):
+        """Logs whose user agent contains ``term``"""
+        agents = UserAgent.objects.filter(user_agent__icontains=term)
+        ids = list(agents.values_list('id', flat=True)[:SEARCH_MAX_USER_AGENTS + 1])
+        if len(ids) > SEARCH_MAX_USER_AGENTS:
+            return Q(agent__user_agent__icontains=term)
+        return Q(agent_id__in=ids) if ids else Q(pk__in=[])
+
+
+class AuditLogOrderingFilter(filters.OrderingFilter):
+    """Orders search results by relevance, newest first, when no ordering is given"""
+
+    def get_ordering(self, request, queryset, view):
+        if not request.query_params.get(self.ordering_param) and SEARCH_RANK in queryset.query.annotations:
+            return [f'-{SEARCH_RANK}', '-timestamp']
+        return super().get_ordering(request, queryset, view)
+
+
+def _parse_details_value(raw):
+    """JSON scalars (``500``, ``true``, ``null``) are typed, anything else is a string"""
+    try:
+        value = json.loads(raw)
+    except ValueError:
+        return raw
+    return raw if isinstance(value, (dict, list)) else value
+
+
+def _nest(path, value):
+    for key in reversed(path):
+        value = {key: value}
+    return value
+
+
+class DetailsFilterBackend:
+    """
+    Filters on the ``details`` JSON of audit logs.
+
+    - ``details.status_code=404``: equality; typed values also match their
+      string form, so ``404`` matches both ``404`` and ``"404"``
+    - ``details.method__in=PUT,DELETE``: any of the values
+    - ``details.status_code__gte=500`` (``gt``, ``lt``, ``lte``): range
+    - ``details.path__startswith=/api/orders``: prefix
+    - ``details.attempted_username__isnull=false``: key present or absent
+    - ``details={"method": "DELETE"}``: raw containment
+    - nested keys are dotted: ``details.request.method=GET``
+    """
+
+    @classmethod
+    def has_filters(cls, request):
+        return any(
+            param == DETAILS_PARAM or param.startswith(f'{DETAILS_PARAM}.')
+            for param in request.query_params
+        )
+
+    def get_filter(self, request):
+        condition = Q()
+        for param, raw_values in request.query_params.lists():
+            for raw in raw_values:
+                if param == DETAILS_PARAM:
+                    condition &= self.containment_filter(raw)
+                elif param.startswith(f'{DETAILS_PARAM}.'):
+                    condition &= self.key_filter(param[len(DETAILS_PARAM) + 1:], raw)
+        return condition
+
+    def filter_queryset(self, request, queryset, view):
+        if not self.has_filters(request):
+            return queryset
+        return queryset.filter(self.get_filter(request))
+
+    def containment_filter(self, raw):
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            value = None
+        if not isinstance(value, dict):
+            raise ValidationError({DETAILS_PARAM: 'Expected a JSON object'})
+        return Q(details__contains=value)
+
+    def key_filter(self, expression, raw):
+        path, _, lookup = expression.partition('__')
+        keys = path.split('.')
+        if not all(_DETAILS_KEY_RE.match(key) for key in keys):
+            raise ValidationError({f'{DETAILS_PARAM}.{expression}': 'Invalid details key'})
+        if lookup and lookup not in DETAILS_LOOKUPS:
+            raise ValidationError({
+                f'{DETAILS_PARAM}.{expression}':
+                f'Unsupported lookup, use one of {", ".join(DETAILS_LOOKUPS)}'
+            })
+
+        if not lookup:
+            return self.equals(keys, raw)
+        if lookup == 'in':
+            return Q(*[self.equals(keys, item) for item in raw.split(',')], _connector=Q.OR)
+
+        key_path = '__'.join(['details'] + keys)
+        if lookup == 'isnull':
+            return Q(**{f'{key_path}__isnull': raw.lower() in ('true', '1')})
+        if lookup == 'startswith':
+            return Q(**{f'{key_path}__startswith': raw})
+        return Q(**{f'{key_path}__{lookup}': _parse_details_value(raw)})
+
+    def equals(self, keys, raw):
+        value = _parse_details_value(raw)
+        condition = Q(details__contains=_nest(keys, value))
+        if not isinstance(value, str):
+            condition |= Q(details__contains=_nest(keys, raw))
+        return condition
@@ -0,0 +1,265 @@
+"""
+Offline import of audit history exported by other systems.
+
+Files are JSONL (one object per line) or CSV with a header row, optionally
+gzip-compressed, and are streamed: memory use depends on the batch size,
+not the file size. Each batch is validated with ``AuditLogBulkItemSerializer``,
+its usernames are resolved to users with one query for the names not seen
+before, and it is loaded with ``COPY``. The batch and the file position
+after it (an ``AuditLogImport`` row) are committed together, so a run that
+is interrupted resumes after the last committed batch.
+"""
+import codecs
+import csv
+import gzip
+import json
+import os
+from collections import OrderedDict
+
+from django.contrib.auth.models import User
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+from rest_framework import serializers
+
+from .models import AuditLog, AuditLogImport
+from .parsers import InvalidLine
+from .serializers import AuditLogBulkItemSerializer
+from .writers import copy_entries
+
+FORMATS = ('jsonl', 'csv')
+
+EXTENSIONS = {
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.json': 'jsonl',
+    '.csv': 'csv',
+}
+
+
+def detect_format(path):
+    root, extension = os.path.splitext(path)
+    if extension == '.gz':
+        extension = os.path.splitext(root)[1]
+    return EXTENSIONS.get(extension.lower())
+
+
+class UserCache:
+    """
+    Username to ``(id, email, is_staff)``, or ``None`` for names without a
+    local account. Names missing from the cache are looked up together, one
+    query per batch; the least recently used names are evicted past
+    ``max_size``.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._users = OrderedDict()
+
+    def load(self, usernames):
+        missing = {name for name in usernames if name not in self._users}
+        for name in usernames:
+            if name in self._users:
+                self._users.move_to_end(name)
+        found = {
+            username: (user_id, email, is_staff)
+            for username, user_id, email, is_staff in
+            User.objects.filter(username__in=missing).values_list('username', 'id', 'email', 'is_staff')
+        } if missing else {}
+        for name in missing:
+            self._users[name] = found.get(name)
+        while len(self._users) > self.max_size:
+            self._users.popitem(last=False)
+
+    def get(self, username):
+        return self._users.get(username)
+
+
+class LineReader:
+    """Iterates over the decoded lines of a binary file, counting bytes and lines consumed"""
+
+    def __init__(self, handle, offset=0, line=0):
+        self.handle = handle
+        self.offset = offset
+        self.line = line
+        self.decode = codecs.getincrementaldecoder('utf-8')('replace').decode
+
+    def __iter__(self):
+        for raw in self.handle:
+            self.offset += len(raw)
+            self.line += 1
+            yield self.decode(raw)
+
+
+class AuditLogImporter:
+    """
+    Imports one file. ``mapping`` renames source fields to the names
+    ``AuditLogBulkItemSerializer`` expects (``{'user': 'username'}``).
+    Rows without a ``timestamp``, or without an ``ip_address`` when no
+    ``default_ip`` is given, are rejected: history needs both.
+    """
+
+    def __init__(self, path, format=None, mapping=None, batch_size=50000, default_ip=None,
+                 user_cache=None, rejects=None, dry_run=False):
+        self.path = os.path.abspath(path)
+        self.format = format or detect_format(path)
+        if self.format not in FORMATS:
+            raise ValueError(f'Cannot tell the format of {path}; pass one of {", ".join(FORMATS)}')
+        self.mapping = mapping or {}
+        self.batch_size = batch_size
+        self.default_ip = default_ip
+        self.users = user_cache or UserCache()
+        self.rejects = rejects
+        self.dry_run = dry_run
+        self.serializer = AuditLogBulkItemSerializer(context={'allow_provenance': True})
+        # Rows loaded by this run, as opposed to the file's running total
+        self.loaded = 0
+
+    def open(self):
+        if self.path.endswith('.gz'):
+            return gzip.open(self.path, 'rb')
+        return open(self.path, 'rb')
+
+    def get_progress(self, from_start=False):
+        if self.dry_run:
+            return AuditLogImport(source=self.path)
+        progress, created = AuditLogImport.objects.get_or_create(source=self.path)
+        if from_start and not created:
+            progress.offset = progress.line = progress.imported = progress.rejected = 0
+            progress.completed_at = None
+            progress.save()
+        return progress
+
+    def run(self, from_start=False, on_batch=None):
+        """Import the rest of the file; returns its ``AuditLogImport`` progress"""
+        progress = self.get_progress(from_start)
+        with self.open() as handle:
+            header = None
+            if self.format == 'csv':
+                header = next(csv.reader([handle.readline().decode('utf-8-sig')]), None)
+                if not header:
+                    raise ValueError(f'{self.path} has no CSV header')
+                if not progress.offset:
+                    progress.offset, progress.line = handle.tell(), 1
+            handle.seek(progress.offset)
+
+            reader = LineReader(handle, progress.offset, progress.line)
+            batch = []
+            for record in self.records(reader, header):
+                batch.append((reader.line, record))
+                if len(batch) >= self.batch_size:
+                    self.load(batch, progress, reader)
+                    batch = []
+                    if on_batch:
+                        on_batch(progress)
+            self.load(batch, progress, reader, completed=True)
+            if on_batch:
+                on_batch(progress)
+        return progress
+
+    def records(self, reader, header):
+        if self.format == 'csv':
+            for row in csv.reader(reader):
+                if not row:
+                    continue
+                record = {name: value for name, value in zip(header, row) if value != ''}
+                if 'details' in record:
+                    try:
+                        record['details'] = json.loads(record['details'])
+                    except ValueError as e:
+                        yield InvalidLine(f'Invalid JSON in details: {e}')
+                        continue
+                yield self.rename(record)
+        else:
+            for line in reader:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    yield InvalidLine(f'Invalid JSON: {e}')
+                    continue
+                yield self.rename(record) if isinstance(record, dict) else record
+
+    def rename(self, record):
+        if not self.mapping:
+            return record
+        return {self.mapping.get(key, key): value for key, value in record.items()}
+
+    def build(self, record):
+        """Validate one record and return an unsaved ``AuditLog``"""
+        if isinstance(record, InvalidLine):
+            raise serializers.ValidationError({'non_field_errors': [record.error]})
+        values = self.serializer.run_validation(record)
+        if 'timestamp' not in values:
+            raise serializers.ValidationError({'timestamp': ['This field is required.']})
+        ip_address = values.get('ip_address') or self.default_ip
+        if not ip_address:
+            raise serializers.ValidationError({'ip_address': ['This field is required.']})
+
+        username = values.get('username')
+        user = self.users.get(username) if username else None
+        action = values['action']
+        return AuditLog(
+            user_id=user[0] if user else None,
+            actor_username=username,
+            actor_email=user[1] if user else values.get('user_email'),
+            actor_is_staff=user[2] if user else False,
+            action=action,
+            resource=values['resource'],
+            resource_id=values.get('resource_id'),
+            ip_address=ip_address,
+            user_agent=values.get('user_agent'),
+            timestamp=values['timestamp'],
+            severity=values.get('severity') or AuditLog.DEFAULT_SEVERITIES.get(action, 'LOW'),
+            details=values.get('details') or {},
+            session_id=values.get('session_id'),
+        )
+
+    def load(self, batch, progress, reader, completed=False):
+        self.users.load({
+            record['username'] for _, record in batch
+            if isinstance(record, dict) and isinstance(record.get('username'), str)
+        })
+        entries = []
+        rejected = []
+        for line, record in batch:
+            try:
+                entries.append((line, self.build(record)))
+            except serializers.ValidationError as e:
+                rejected.append((line, e.detail))
+
+        if self.dry_run:
+            loaded = len(entries)
+            self.advance(progress, reader, loaded, len(rejected), completed)
+        else:
+            with transaction.atomic():
+                loaded = self.copy(entries, rejected)
+                self.advance(progress, reader, loaded, len(rejected), completed)
+                progress.save()
+        self.loaded += loaded
+
+        if self.rejects is not None:
+            for line, errors in sorted(rejected, key=lambda rejection: rejection[0]):
+                self.rejects.write(json.dumps({'source': self.path, 'line': line, 'errors': errors}) + '\n')
+
+    def advance(self, progress, reader, loaded, rejected, completed):
+        progress.offset, progress.line = reader.offset, reader.line
+        progress.imported += loaded
+        progress.rejected += rejected
+        if completed:
+            progress.completed_at = timezone.now()
+
+    def copy(self, entries, rejected):
+        """COPY ``entries``, bisecting with savepoints to isolate rows the database rejects"""
+        if not entries:
+            return 0
+        try:
+            with transaction.atomic():
+                return copy_entries([entry for _, entry in entries])
+        except DatabaseError as e:
+            if len(entries) == 1:
+                rejected.append((entries[0][0], {'non_field_errors': [f'Rejected by the database: {e}'.strip()]}))
+                return 0
+        middle = len(entries) // 2
+        return self.copy(entries[:middle], rejected) + self.copy(entries[middle:], rejected)
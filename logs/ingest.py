@@ -0,0 +1,118 @@
+"""
+Bulk ingestion of audit events forwarded by other services.
+
+Events are validated one by one with ``AuditLogBulkItemSerializer`` and
+inserted with ``bulk_create`` in chunks of ``AUDIT_BULK_INGEST_CHUNK_SIZE``,
+one transaction per chunk. ``mode`` decides what happens to a request with
+invalid events:
+- ``partial``: insert the valid events and report the invalid ones
+- ``atomic``: insert nothing unless every event is valid and stored
+
+Stored events reach the live tail and the detection rules once their
+transaction commits, so events that end up rolled back raise nothing.
+"""
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from rest_framework import serializers
+
+from .models import AuditLog
+from .parsers import InvalidLine
+from .serializers import AuditLogBulkItemSerializer
+from .writers import dispatch_entries, store_entries
+
+MODES = ('partial', 'atomic')
+
+
+class IngestResult:
+    def __init__(self, received):
+        self.received = received
+        self.inserted = 0
+        self.errors = []
+
+    def as_dict(self):
+        return {
+            'received': self.received,
+            'inserted': self.inserted,
+            'failed': len(self.errors),
+            'errors': self.errors,
+        }
+
+
+def build_entries(items, user, ip_address, allow_provenance, result):
+    """Validate ``items`` and build unsaved logs, recording per-item errors"""
+    serializer = AuditLogBulkItemSerializer(context={'allow_provenance': allow_provenance})
+    entries = []
+    for index, item in enumerate(items):
+        if isinstance(item, InvalidLine):
+            result.errors.append({'index': index, 'errors': {'non_field_errors': [item.error]}})
+            continue
+        try:
+            values = serializer.run_validation(item)
+        except serializers.ValidationError as e:
+            result.errors.append({'index': index, 'errors': e.detail})
+            continue
+
+        username = values.pop('username', None)
+        email = values.pop('user_email', None)
+        if username:
+            # Forwarded on behalf of someone outside this system
+            entry = AuditLog.build(
+                None, values.pop('action'), values.pop('resource'),
+                values.pop('ip_address', ip_address),
+                actor_username=username, actor_email=email, **values
+            )
+        else:
+            entry = AuditLog.build(
+                user, values.pop('action'), values.pop('resource'),
+                values.pop('ip_address', ip_address), **values
+            )
+        entries.append((index, entry))
+    return entries
+
+
+def _store(entries):
+    """Store ``entries`` and dispatch them when the transaction commits"""
+    store_entries(entries)
+    transaction.on_commit(lambda: dispatch_entries(entries))
+
+
+def _insert_chunk(chunk, result):
+    """Insert a chunk, isolating the rows the database rejects"""
+    try:
+        with transaction.atomic():
+            _store([entry for _, entry in chunk])
+        result.inserted += len(chunk)
+        return
+    except DatabaseError:
+        if len(chunk) == 1:
+            index, _ = chunk[0]
+            result.errors.append({'index': index, 'errors': {'non_field_errors': ['Rejected by the database']}})
+            return
+    middle = len(chunk) // 2
+    _insert_chunk(chunk[:middle], result)
+    _insert_chunk(chunk[middle:], result)
+
+
+def ingest(items, user, ip_address, mode='partial', allow_provenance=False):
+    """Validate and store ``items`` (dicts); returns an ``IngestResult``"""
+    chunk_size = settings.AUDIT_BULK_INGEST_CHUNK_SIZE
+    result = IngestResult(len(items))
+    entries = build_entries(items, user, ip_address, allow_provenance, result)
+
+    if mode == 'atomic':
+        if result.errors:
+            return result
+        try:
+            with transaction.atomic():
+                for start in range(0, len(entries), chunk_size):
+                    _store([entry for _, entry in entries[start:start + chunk_size]])
+        except DatabaseError as e:
+            result.errors.append({'index': None, 'errors': {'non_field_errors': [f'Rejected by the database: {e}']}})
+            return result
+        result.inserted = len(entries)
+        return result
+
+    for start in range(0, len(entries), chunk_size):
+        _insert_chunk(entries[start:start + chunk_size], result)
+    result.errors.sort(key=lambda error: error['index'])
+    return result
@@ -0,0 +1,277 @@
+"""
+Live tail of audit logs for the server-sent events endpoint.
+
+Writers publish every stored log to a broker. Each ASGI process holds one
+subscription to the broker (a single ``LISTEN`` connection on PostgreSQL)
+and fans events out in memory to its connected clients. Each client
+applies its own filters, so one notification serves any number of open
+dashboards without a query per client.
+
+``AUDIT_LIVE_TAIL`` selects the broker:
+- ``PostgresBroker``: ``pg_notify`` on publish, ``LISTEN`` in the ASGI process
+- ``LocalBroker``: in-process only, for development and tests
+"""
+import asyncio
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection, connections
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+EVENT_FIELDS = (
+    'id', 'user_id', 'actor_username', 'action', 'resource', 'resource_id',
+    'ip_address', 'ip_network', 'ip_network_name', 'ip_country', 'ip_blocklisted',
+    'severity', 'details',
+)
+
+
+def serialize_event(entry):
+    event = {field: getattr(entry, field) for field in EVENT_FIELDS}
+    event['username'] = event.pop('actor_username')
+    event['timestamp'] = entry.timestamp.isoformat()
+    return event
+
+
+class Subscription:
+    """One connected client: its filters and a bounded queue of pending events"""
+
+    def __init__(self, filters, max_queue_size):
+        self.filters = filters
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self.lagged = False
+
+    def matches(self, event):
+        for field, allowed in self.filters.items():
+            if event.get(field) not in allowed:
+                return False
+        return True
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # A slow client loses events rather than holding up the others
+            self.lagged = True
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class LiveTailHub:
+    """Fan-out of broker events to the subscriptions of one event loop"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.subscriptions = set()
+
+    def subscribe(self, filters):
+        subscription = Subscription(filters, settings.AUDIT_LIVE_TAIL_QUEUE_SIZE)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.discard(subscription)
+
+    def broadcast(self, events):
+        for subscription in list(self.subscriptions):
+            for event in events:
+                if subscription.matches(event):
+                    subscription.put(event)
+
+    def broadcast_threadsafe(self, events):
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.broadcast, events)
+
+
+class BaseBroker:
+    def __init__(self, **options):
+        self.options = options
+
+    def publish(self, events):
+        """Deliver serialized events to every live tail subscriber"""
+        raise NotImplementedError
+
+    def listen(self, hub):
+        """Start feeding published events into ``hub`` (called on its loop)"""
+
+    def unlisten(self, hub):
+        """Stop feeding ``hub`` and release what ``listen`` opened for it"""
+
+
+class LocalBroker(BaseBroker):
+    """Delivers events to hubs in the same process"""
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self._hubs = set()
+        self._lock = threading.Lock()
+
+    def publish(self, events):
+        with self._lock:
+            hubs = list(self._hubs)
+        for hub in hubs:
+            hub.broadcast_threadsafe(events)
+
+    def listen(self, hub):
+        with self._lock:
+            self._hubs.add(hub)
+
+    def unlisten(self, hub):
+        with self._lock:
+            self._hubs.discard(hub)
+
+
+class PostgresBroker(BaseBroker):
+    """
+    Publishes with ``pg_notify`` on the writer's connection and listens on
+    one dedicated connection per ASGI process, read from the event loop.
+    """
+
+    def __init__(self, channel='audit_logs', max_payload=7900, reconnect_delay=5, **options):
+        super().__init__(**options)
+        self.channel = channel
+        self.max_payload = max_payload
+        self.reconnect_delay = reconnect_delay
+        self._hub = None
+        self._listener = None
+
+    def publish(self, events):
+        if connection.vendor != 'postgresql':
+            return
+        payloads = []
+        for event in events:
+            payload = json.dumps(event, default=str)
+            if len(payload.encode('utf-8')) > self.max_payload:
+                # NOTIFY payloads are limited to 8000 bytes
+                payload = json.dumps(dict(event, details=None, details_truncated=True), default=str)
+            payloads.append(payload)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload',
+                [self.channel, payloads]
+            )
+
+    def listen(self, hub):
+        self._hub = hub
+        self._connect(hub)
+
+    def unlisten(self, hub):
+        if hub is not self._hub:
+            return
+        listener, self._hub, self._listener = self._listener, None, None
+        if listener is None:
+            return
+
+        def close():
+            hub.loop.remove_reader(listener.fileno())
+            listener.close()
+
+        if hub.loop.is_running():
+            hub.loop.call_soon_threadsafe(close)
+        elif not hub.loop.is_closed():
+            close()
+        else:
+            listener.close()
+
+    def _connect(self, hub):
+        import psycopg2
+        import psycopg2.extensions
+
+        if hub is not self._hub:
+            return  # unlistened while waiting to reconnect
+        try:
+            params = connections['default'].get_connection_params()
+            listener = psycopg2.connect(**params)
+            listener.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with listener.cursor() as cursor:
+                cursor.execute(f'LISTEN {connection.ops.quote_name(self.channel)}')
+        except psycopg2.Error:
+            logger.exception('Live tail cannot listen on %s, retrying', self.channel)
+            hub.loop.call_later(self.reconnect_delay, self._connect, hub)
+            return
+
+        self._listener = listener
+        hub.loop.add_reader(listener.fileno(), self._read, hub, listener)
+
+    def _read(self, hub, listener):
+        import psycopg2
+
+        try:
+            listener.poll()
+        except psycopg2.Error:
+            logger.exception('Live tail lost its connection to %s', self.channel)
+            hub.loop.remove_reader(listener.fileno())
+            listener.close()
+            if listener is self._listener:
+                self._listener = None
+                hub.loop.call_later(self.reconnect_delay, self._connect, hub)
+            return
+
+        events = []
+        while listener.notifies:
+            notify = listener.notifies.pop(0)
+            try:
+                events.append(json.loads(notify.payload))
+            except ValueError:
+                logger.warning('Ignoring malformed live tail payload')
+        if events:
+            hub.broadcast(events)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+_hub = None
+
+
+def get_live_broker():
+    """Return the process-wide broker configured by ``AUDIT_LIVE_TAIL``"""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                config = getattr(settings, 'AUDIT_LIVE_TAIL', {})
+                backend = import_string(config.get('BACKEND', 'logs.live.LocalBroker'))
+                _broker = backend(**config.get('OPTIONS', {}))
+    return _broker
+
+
+def reset_live_broker(**kwargs):
+    global _broker, _hub
+    if kwargs.get('setting', 'AUDIT_LIVE_TAIL') == 'AUDIT_LIVE_TAIL':
+        if _broker is not None and _hub is not None:
+            _broker.unlisten(_hub)
+        _broker = None
+        _hub = None
+
+
+setting_changed.connect(reset_live_broker)
+
+
+def get_hub():
+    """
+    Hub of the running event loop, subscribed to the broker on first use.
+    A hub left from an earlier loop is unsubscribed first, which closes its
+    ``LISTEN`` connection.
+    """
+    global _hub
+    loop = asyncio.get_running_loop()
+    if _hub is None or _hub.loop is not loop:
+        broker = get_live_broker()
+        if _hub is not None:
+            broker.unlisten(_hub)
+        _hub = LiveTailHub(loop)
+        broker.listen(_hub)
+    return _hub
+
+
+def publish(entries):
+    """Publish stored audit logs; never lets a broker failure reach the writer"""
+    try:
+        get_live_broker().publish([serialize_event(entry) for entry in entries])
+    except Exception:
+        logger.exception('Failed to publish %d audit log(s) to the live tail', len(entries))
@@ -0,0 +1,43 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min, OuterRef, Subquery
+
+from logs.models import AuditLog
+
+
+class Command(BaseCommand):
+    help = 'Copy username, email and staff flag onto audit logs written before actor snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Number of audit log ids updated per statement'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive')
+
+        pending = AuditLog.objects.filter(actor_username__isnull=True, user__isnull=False)
+        bounds = pending.aggregate(first=Min('id'), last=Max('id'))
+        if bounds['first'] is None:
+            self.stdout.write(self.style.SUCCESS('All audit logs already have an actor snapshot'))
+            return
+
+        users = User.objects.filter(pk=OuterRef('user_id'))
+        updated = 0
+        lower = bounds['first'] - 1
+        # Each batch is its own statement, so locks are held only briefly and
+        # an interrupted run resumes where it stopped.
+        while lower < bounds['last']:
+            upper = lower + batch_size
+            updated += pending.filter(id__gt=lower, id__lte=upper).update(
+                actor_username=Subquery(users.values('username')[:1]),
+                actor_email=Subquery(users.values('email')[:1]),
+                actor_is_staff=Subquery(users.values('is_staff')[:1]),
+            )
+            lower = upper
+            self.stdout.write(f'Backfilled {updated} audit logs (up to id {min(upper, bounds["last"])})')
+
+        self.stdout.write(self.style.SUCCESS(f'Backfilled {updated} audit logs'))
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from logs import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the audit log endpoints, middleware and failed-login handling'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations', type=int, default=50,
+            help='Timed iterations per scenario'
+        )
+        parser.add_argument(
+            '--page-depths', default='1,10,100,1000',
+            help='Comma separated page numbers to time list pagination at'
+        )
+        parser.add_argument(
+            '--only', action='append', default=[],
+            help='Run only scenarios whose name starts with this prefix (repeatable)'
+        )
+        parser.add_argument(
+            '--save', metavar='PATH',
+            help='Write the results to PATH as JSON, e.g. to record a baseline'
+        )
+        parser.add_argument(
+            '--baseline', metavar='PATH',
+            help='Compare with results saved earlier with --save'
+        )
+        parser.add_argument(
+            '--max-regression', type=float, default=20.0,
+            help='Fail when a p95 is this many percent above the baseline'
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('The benchmark runs against PostgreSQL')
+        if options['iterations'] < 1:
+            raise CommandError('--iterations must be positive')
+        try:
+            depths = tuple(int(depth) for depth in options['page_depths'].split(',') if depth)
+        except ValueError:
+            raise CommandError('--page-depths must be comma separated integers')
+
+        baseline = benchmarks.load_results(options['baseline']) if options['baseline'] else None
+
+        benchmark = benchmarks.AuditBenchmark(iterations=options['iterations'], page_depths=depths)
+        try:
+            results = benchmark.run(only=options['only'], stdout=None if baseline else self.stdout)
+        except (ValueError, AssertionError) as e:
+            raise CommandError(str(e))
+
+        if options['save']:
+            benchmarks.save_results(results, options['save'])
+            self.stdout.write(f"Saved results to {options['save']}")
+
+        if baseline is None:
+            return
+
+        for name, result in results['scenarios'].items():
+            self.stdout.write(benchmarks.format_result(name, result, baseline['scenarios'].get(name)))
+        regressions = benchmarks.compare(results, baseline, options['max_regression'])
+        if regressions:
+            raise CommandError('Regressions against the baseline:\n' + '\n'.join(regressions))
+        self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
@@ -0,0 +1,92 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from logs import partitions
+from logs.importer import FORMATS, AuditLogImporter, UserCache
+
+
+class Command(BaseCommand):
+    help = 'Import audit logs from JSONL or CSV files (optionally gzipped), resuming where a previous run stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', metavar='PATH', help='Files to import')
+        parser.add_argument(
+            '--format', choices=FORMATS,
+            help='File format; detected from the extension by default'
+        )
+        parser.add_argument(
+            '--map', action='append', default=[], metavar='SOURCE=FIELD',
+            help='Read FIELD from the SOURCE column or key, e.g. --map user=username (repeatable)'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=50000,
+            help='Number of rows loaded and checkpointed per COPY'
+        )
+        parser.add_argument(
+            '--default-ip',
+            help='IP address to record for rows without one; such rows are rejected otherwise'
+        )
+        parser.add_argument(
+            '--rejects', metavar='PATH',
+            help='Append rejected rows (file, line and errors) to PATH as JSON lines; default is stderr'
+        )
+        parser.add_argument(
+            '--from-start', action='store_true',
+            help='Ignore the saved position and import each file from the beginning'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Validate the files without loading anything'
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Importing uses COPY and requires PostgreSQL')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        mapping = {}
+        for pair in options['map']:
+            source, _, field = pair.partition('=')
+            if not source or not field:
+                raise CommandError(f'--map expects SOURCE=FIELD, got {pair!r}')
+            mapping[source] = field
+
+        if not options['dry_run']:
+            partitions.create_partitions()
+
+        rejects = open(options['rejects'], 'a') if options['rejects'] else sys.stderr
+        users = UserCache()
+        try:
+            for path in options['paths']:
+                try:
+                    importer = AuditLogImporter(
+                        path, format=options['format'], mapping=mapping, batch_size=options['batch_size'],
+                        default_ip=options['default_ip'], user_cache=users, rejects=rejects,
+                        dry_run=options['dry_run'],
+                    )
+                    self.import_file(importer, options['from_start'])
+                except (OSError, ValueError) as e:
+                    raise CommandError(f'{path}: {e}')
+        finally:
+            if rejects is not sys.stderr:
+                rejects.close()
+
+    def import_file(self, importer, from_start):
+        started = time.monotonic()
+
+        def report(progress):
+            rate = importer.loaded / max(time.monotonic() - started, 1e-6)
+            self.stdout.write(
+                f'{importer.path}: line {progress.line}, {progress.imported} imported, '
+                f'{progress.rejected} rejected ({rate:.0f} rows/s)'
+            )
+
+        progress = importer.run(from_start=from_start, on_batch=report)
+        verb = 'Validated' if importer.dry_run else 'Imported'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {importer.path} in {time.monotonic() - started:.1f}s: '
+            f'{progress.imported} rows, {progress.rejected} rejected'
+        ))
@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from logs import partitions
+
+
+class Command(BaseCommand):
+    help = 'Create upcoming monthly audit log partitions and drop expired ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ahead', type=int, default=settings.AUDIT_LOG_PARTITIONS_AHEAD,
+            help='Number of future months to create partitions for'
+        )
+        parser.add_argument(
+            '--retention-months', type=int, default=settings.AUDIT_LOG_RETENTION_MONTHS,
+            help='Drop partitions older than this many months (0 keeps everything)'
+        )
+        parser.add_argument(
+            '--detach-only', action='store_true',
+            help='Detach expired partitions without dropping them'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report which partitions would be removed'
+        )
+
+    def handle(self, *args, **options):
+        if not partitions.is_supported():
+            raise CommandError('Audit log partitioning requires PostgreSQL')
+
+        try:
+            if not options['dry_run']:
+                for name in partitions.create_partitions(options['ahead']):
+                    self.stdout.write(f'Created partition {name}')
+
+            if options['retention_months'] > 0:
+                expired = partitions.drop_expired_partitions(
+                    options['retention_months'],
+                    detach_only=options['detach_only'],
+                    dry_run=options['dry_run'],
+                )
+                verb = 'Would remove' if options['dry_run'] else (
+                    'Detached' if options['detach_only'] else 'Dropped'
+                )
+                for name in expired:
+                    self.stdout.write(f'{verb} partition {name}')
+        except DatabaseError as e:
+            raise CommandError(f'Partition maintenance failed: {e}')
+
+        self.stdout.write(self.style.SUCCESS('Audit log partitions are up to date'))
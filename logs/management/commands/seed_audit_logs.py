@@ -0,0 +1,100 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from logs import partitions, rollups, sketches
+from logs.synthetic import SyntheticLogGenerator
+from logs.writers import copy_entries
+
+
+class Command(BaseCommand):
+    help = 'Load synthetic audit logs with skewed users, IPs and actions for benchmarking'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows', type=int, default=1000000,
+            help='Number of audit logs to generate'
+        )
+        parser.add_argument(
+            '--users', type=int, default=1000,
+            help='Number of synthetic users (bench_user_NNNNNN) to spread activity over'
+        )
+        parser.add_argument(
+            '--staff-ratio', type=float, default=0.02,
+            help='Share of synthetic users that are staff'
+        )
+        parser.add_argument(
+            '--ips', type=int, default=50000,
+            help='Number of distinct client IP addresses'
+        )
+        parser.add_argument(
+            '--days', type=int, default=90,
+            help='Spread timestamps over this many days before now'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=50000,
+            help='Number of rows loaded per COPY'
+        )
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Random seed; the same seed generates the same data'
+        )
+        parser.add_argument(
+            '--skip-rollups', action='store_true',
+            help='Do not fold the new rows into the statistics rollups and sketches afterwards'
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Seeding uses COPY and requires PostgreSQL')
+        for name in ('rows', 'users', 'ips', 'days', 'batch_size'):
+            if options[name] < 1:
+                raise CommandError(f'--{name.replace("_", "-")} must be positive')
+
+        users = self.ensure_users(options['users'], options['staff_ratio'])
+        partitions.create_partitions()
+
+        generator = SyntheticLogGenerator(
+            users, options['rows'], days=options['days'], ip_pool=options['ips'],
+            seed=options['seed'],
+        )
+        started = time.monotonic()
+        loaded = 0
+        for batch in generator.batches(options['batch_size']):
+            with transaction.atomic():
+                loaded += copy_entries(batch)
+            elapsed = time.monotonic() - started
+            self.stdout.write(f'Loaded {loaded}/{options["rows"]} audit logs ({loaded / elapsed:.0f} rows/s)')
+
+        if not options['skip_rollups']:
+            self.stdout.write('Updating statistics rollups and sketches')
+            # The first run records the new high-water mark, the second folds up to it
+            rollups.update_rollups()
+            rollups.update_rollups()
+            sketches.update_sketches()
+            sketches.update_sketches()
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {connection.ops.quote_name(partitions.PARENT_TABLE)}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded {loaded} audit logs in {time.monotonic() - started:.1f}s'
+        ))
+
+    def ensure_users(self, count, staff_ratio):
+        staff_every = round(1 / staff_ratio) if staff_ratio > 0 else 0
+        users = [
+            User(
+                username=f'bench_user_{number:06d}',
+                email=f'bench_user_{number:06d}@example.com',
+                is_staff=bool(staff_every) and number % staff_every == 0,
+                password='!',  # unusable
+            )
+            for number in range(count)
+        ]
+        User.objects.bulk_create(users, ignore_conflicts=True, batch_size=5000)
+        return list(
+            User.objects.filter(username__in=[user.username for user in users]).order_by('username')
+        )
@@ -0,0 +1,495 @@
+"""
+Metrics for the audit pipeline, exported in the Prometheus text format at
+``/metrics``.
+
+Recording a value only updates a dict in the current process. Every
+``AUDIT_METRICS_FLUSH_INTERVAL`` seconds a background thread adds the
+accumulated increments to the counter store (``AUDIT_COUNTER_STORE``), so
+requests never wait on the store. With Redis the
+endpoint reports totals over all web and Celery worker processes. That is
+why only counters and histograms are recorded; gauges such as queue
+lengths are read when the endpoint is scraped.
+
+Per-request values (query count, serializer and render time) are gathered
+by ``MetricsMiddleware`` and also logged as structured fields on the
+``logs.metrics`` logger at INFO level.
+"""
+import atexit
+import functools
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from datetime import datetime
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+
+from .counters import LocalCounterStore, get_counter_store
+
+logger = logging.getLogger(__name__)
+
+STORE_KEY = 'metrics'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DELAY_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class MetricsRegistry:
+    """The metrics of this process; their values are increments not flushed yet"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.enabled = True
+        self.flush_interval = 10.0
+        self.lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._flusher = None
+        self._stopped = threading.Event()
+        self._exit_registered = False
+
+    def configure(self):
+        self.enabled = getattr(settings, 'AUDIT_METRICS_ENABLED', True)
+        self.flush_interval = getattr(settings, 'AUDIT_METRICS_FLUSH_INTERVAL', 10.0)
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def reset(self):
+        """Forget the increments a forked child inherited from its parent"""
+        self.lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        # Threads do not survive fork(), so the child starts its own flusher
+        self._flusher = None
+        self._stopped = threading.Event()
+        for metric in self.metrics.values():
+            metric._values = {}
+
+    def start(self):
+        """Start the thread flushing every ``flush_interval`` seconds, once per process"""
+        with self._start_lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._run, name='audit-metrics-flusher', daemon=True)
+            self._flusher.start()
+            # A process-local store goes away with the process, so flushing
+            # into it at exit would be wasted work. Forked children inherit
+            # the handler, which flushes their own registry.
+            if not self._exit_registered and not isinstance(get_counter_store(), LocalCounterStore):
+                atexit.register(self.stop)
+                self._exit_registered = True
+
+    def stop(self):
+        """Stop the flusher thread and flush what it has not sent yet"""
+        self._stopped.set()
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def drain(self):
+        """Return and reset the pending increments as ``{series: amount}``"""
+        deltas = {}
+        with self.lock:
+            for metric in self.metrics.values():
+                metric.drain(deltas)
+        return deltas
+
+    def flush(self):
+        """Add the pending increments to the counter store"""
+        if not self._flush_lock.acquire(blocking=False):
+            return  # another thread is flushing
+        try:
+            deltas = self.drain()
+            if deltas:
+                try:
+                    get_counter_store().incr_fields(STORE_KEY, deltas)
+                except Exception as exc:
+                    # Dropped rather than retried, so a store outage cannot grow memory
+                    logger.warning('Could not flush %d metric series: %s', len(deltas), exc)
+        finally:
+            self._flush_lock.release()
+
+    def collect(self):
+        """Flush, then return the totals of every series across processes"""
+        self.flush()
+        return get_counter_store().get_fields(STORE_KEY)
+
+    def render(self, values, gauges=()):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.render(values))
+        for name, documentation, samples in gauges:
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in samples:
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class Metric:
+    """
+    Values are kept per label tuple in a plain list, the cheapest thing to
+    update; series names are only built when flushing.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry
+        self._values = {}
+        self._series = {}
+        registry.register(self)
+
+    def format_labels(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {labels}')
+        return ''.join(f'{name}="{_escape(value)}",' for name, value in zip(self.labelnames, labels))
+
+    def get_series(self, labels):
+        """Names of the series stored for ``labels``, in the order of their values"""
+        raise NotImplementedError
+
+    def drain(self, deltas):
+        """Move the non-zero values into ``deltas``; called with the registry lock held"""
+        values, self._values = self._values, {}
+        for labels, amounts in values.items():
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = self.get_series(labels)
+            for name, amount in zip(series, amounts):
+                if amount:
+                    deltas[name] = amount
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, *labels):
+        registry = self.registry
+        if not registry.enabled:
+            return
+        with registry.lock:
+            values = self._values.get(labels)
+            if values is None:
+                self._values[labels] = [amount]
+            else:
+                values[0] += amount
+        if registry._flusher is None:
+            registry.start()
+
+    def get_series(self, labels):
+        labels_text = self.format_labels(labels).rstrip(',')
+        return [f'{self.name}{{{labels_text}}}' if labels_text else self.name]
+
+    def render(self, values):
+        prefix = f'{self.name}{{'
+        for series in sorted(values):
+            if series == self.name or series.startswith(prefix):
+                yield f'{series} {_format_value(values[series])}'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+        self._bounds = [_format_value(bound) for bound in self.buckets] + ['+Inf']
+        self._sum = len(self._bounds)
+        self._count = self._sum + 1
+
+    def observe(self, value, *labels):
+        registry = self.registry
+        if not registry.enabled:
+            return
+        index = bisect_left(self.buckets, value)
+        with registry.lock:
+            values = self._values.get(labels)
+            if values is None:
+                values = self._values[labels] = [0] * (self._count + 1)
+            values[index] += 1
+            values[self._sum] += value
+            values[self._count] += 1
+        if registry._flusher is None:
+            registry.start()
+
+    def timed(self, *labels):
+        """Decorator observing the run time of the decorated function"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with Timer(self, labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def get_series(self, labels):
+        # Buckets are stored per bucket and made cumulative by render()
+        labels_text = self.format_labels(labels)
+        plain = labels_text.rstrip(',')
+        return [f'{self.name}_bucket{{{labels_text}le="{bound}"}}' for bound in self._bounds] + [
+            f'{self.name}_sum{{{plain}}}' if plain else f'{self.name}_sum',
+            f'{self.name}_count{{{plain}}}' if plain else f'{self.name}_count',
+        ]
+
+    def render(self, values):
+        bucket_prefix = f'{self.name}_bucket{{'
+        positions = {bound: index for index, bound in enumerate(self._bounds)}
+        groups = {}
+        for series, value in values.items():
+            if series.startswith(bucket_prefix):
+                split = series.rindex('le="')
+                counts = groups.setdefault(series[len(bucket_prefix):split], [0] * len(self._bounds))
+                position = positions.get(series[split + 4:-2])
+                if position is not None:
+                    counts[position] += value
+        for labels_text in sorted(groups):
+            total = 0
+            for bound, count in zip(self._bounds, groups[labels_text]):
+                total += count
+                yield f'{bucket_prefix}{labels_text}le="{bound}"}} {_format_value(total)}'
+            plain = labels_text.rstrip(',')
+            for suffix in ('_sum', '_count'):
+                series = f'{self.name}{suffix}{{{plain}}}' if plain else f'{self.name}{suffix}'
+                yield f'{series} {_format_value(values.get(series, 0))}'
+
+
+class Timer:
+    """Context manager observing the time spent in its block"""
+
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+# HTTP requests (recorded by logs.middleware.MetricsMiddleware)
+REQUEST_SECONDS = Histogram(
+    'audit_http_request_seconds', 'Time until the response is returned (streamed bodies excluded)',
+    ['endpoint', 'method', 'status'],
+)
+REQUEST_QUERIES = Histogram(
+    'audit_http_request_queries', 'Database queries run per request', ['endpoint'], buckets=QUERY_BUCKETS,
+)
+REQUEST_DB_SECONDS = Histogram(
+    'audit_http_request_db_seconds', 'Time spent in database queries per request', ['endpoint'],
+)
+SERIALIZE_SECONDS = Histogram(
+    'audit_http_serialize_seconds', 'Time spent producing serializer data per request', ['endpoint'],
+)
+RENDER_SECONDS = Histogram(
+    'audit_http_render_seconds', 'Time spent rendering the response body per request', ['endpoint'],
+)
+
+# Audit log capture and writing
+AUDIT_MIDDLEWARE_SECONDS = Histogram(
+    'audit_middleware_seconds', 'Time AuditMiddleware adds to a request after the view returns',
+)
+SIGNAL_SECONDS = Histogram(
+    'audit_signal_seconds', 'Time spent in the authentication signal handlers', ['signal'],
+)
+WRITER_ENTRIES = Counter(
+    'audit_writer_entries_total', 'Audit log entries by writer outcome', ['outcome'],
+)
+WRITE_SECONDS = Histogram(
+    'audit_writer_write_seconds', 'Time to write one batch of audit logs',
+)
+WRITE_BATCH_SIZE = Histogram(
+    'audit_writer_batch_size', 'Audit log entries per written batch', buckets=SIZE_BUCKETS,
+)
+WRITE_LAG_SECONDS = Histogram(
+    'audit_writer_lag_seconds', 'Age of the oldest entry of a batch when it is written',
+    buckets=DELAY_BUCKETS,
+)
+
+# Celery tasks and alerts
+TASK_SECONDS = Histogram(
+    'audit_celery_task_seconds', 'Celery task run time', ['task', 'state'],
+)
+TASK_LAG_SECONDS = Histogram(
+    'audit_celery_task_lag_seconds', 'Time between a task becoming due and a worker starting it',
+    ['task'], buckets=DELAY_BUCKETS,
+)
+DETECTION_SECONDS = Histogram(
+    'audit_detection_seconds', 'Time to evaluate the detection rules on a batch of audit logs',
+)
+DETECTIONS = Counter(
+    'audit_detections_total', 'Detection rules fired', ['rule'],
+)
+ALERT_DELIVERY_SECONDS = Histogram(
+    'audit_alert_delivery_seconds', 'Time from raising a security alert to mailing its digest',
+    buckets=DELAY_BUCKETS,
+)
+
+
+class RequestStats:
+    __slots__ = ('queries', 'db_seconds', 'serialize_seconds', 'render_seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.render_seconds = 0.0
+
+
+# Shared by reference with sync_to_async threads, so their queries count too
+_request_stats = ContextVar('audit_request_stats', default=None)
+
+
+def start_request():
+    """Start collecting per-request values; returns a token for ``end_request``"""
+    stats = RequestStats()
+    return stats, _request_stats.set(stats)
+
+
+def end_request(token):
+    _request_stats.reset(token)
+
+
+def request_stats():
+    return _request_stats.get()
+
+
+def _count_query(execute, sql, params, many, context):
+    stats = _request_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.db_seconds += time.perf_counter() - started
+
+
+def install_query_counter(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+connection_created.connect(install_query_counter)
+
+
+def log_event(event, **fields):
+    """Log ``fields`` on ``logs.metrics``, as key=value text and as the ``metrics`` record attribute"""
+    if logger.isEnabledFor(logging.INFO):
+        text = ' '.join(f'{key}={value}' for key, value in fields.items())
+        logger.info('%s %s', event, text, extra={'metrics': dict(fields, event=event)})
+
+
+def celery_queue_lengths():
+    """``[(labels, length)]`` for the Celery queues, empty if the broker is unreachable"""
+    from celery import current_app
+
+    samples = []
+    try:
+        with current_app.connection_for_read() as connection:
+            connection.ensure_connection(max_retries=0)
+            channel = connection.default_channel
+            for queue in sorted(current_app.amqp.queues):
+                try:
+                    _, length, _ = channel.queue_declare(queue, passive=True)
+                except Exception:
+                    length = 0  # Redis drops empty queues
+                samples.append((f'{{queue="{_escape(queue)}"}}', length))
+    except Exception as e:
+        logger.warning('Could not read Celery queue lengths: %s', e)
+    return samples
+
+
+def render_metrics():
+    gauges = [(
+        'audit_celery_queue_length', 'Tasks waiting in each Celery queue', celery_queue_lengths(),
+    )]
+    return REGISTRY.render(REGISTRY.collect(), gauges)
+
+
+def _task_due(request):
+    """When a task message could first run: its ETA, else when it was published"""
+    sent_at = getattr(request, 'audit_sent_at', None)
+    if sent_at is None:
+        sent_at = (getattr(request, 'headers', None) or {}).get('audit_sent_at')
+    eta = request.eta
+    if isinstance(eta, str):
+        eta = datetime.fromisoformat(eta)
+    if eta is not None:
+        eta = eta.timestamp() if timezone.is_aware(eta) else timezone.make_aware(eta).timestamp()
+        return max(eta, sent_at or 0)
+    return sent_at
+
+
+def connect_celery_signals():
+    from celery.signals import before_task_publish, task_postrun, task_prerun, worker_process_shutdown
+
+    started = {}
+
+    def on_publish(headers=None, **kwargs):
+        if REGISTRY.enabled and headers is not None:
+            headers['audit_sent_at'] = time.time()
+
+    def on_prerun(task_id=None, task=None, **kwargs):
+        if not REGISTRY.enabled:
+            return
+        started[task_id] = time.perf_counter()
+        due = _task_due(task.request)
+        if due is not None:
+            TASK_LAG_SECONDS.observe(max(time.time() - due, 0), task.name)
+
+    def on_postrun(task_id=None, task=None, state=None, **kwargs):
+        began = started.pop(task_id, None)
+        if began is not None:
+            TASK_SECONDS.observe(time.perf_counter() - began, task.name, state or 'UNKNOWN')
+
+    before_task_publish.connect(on_publish, weak=False)
+    task_prerun.connect(on_prerun, weak=False)
+    task_postrun.connect(on_postrun, weak=False)
+    worker_process_shutdown.connect(lambda **kwargs: REGISTRY.flush(), weak=False)
+
+
+connect_celery_signals()
+os.register_at_fork(after_in_child=REGISTRY.reset)
+
+
+def reconfigure(**kwargs):
+    if kwargs['setting'] in ('AUDIT_METRICS_ENABLED', 'AUDIT_METRICS_FLUSH_INTERVAL'):
+        REGISTRY.configure()
+
+
+REGISTRY.configure()
+setting_changed.connect(reconfigure)
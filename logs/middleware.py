@@ -1,51 +1,174 @@
-from django.utils.deprecation import MiddlewareMixin
+import random
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.contrib.auth.models import AnonymousUser
+from django.utils.functional import SimpleLazyObject
+from . import metrics
 from .models import AuditLog
+from .routing import get_audit_router
+from .writers import get_audit_writer
 
-class AuditMiddleware(MiddlewareMixin):
+
+class MetricsMiddleware:
     """
-    Middleware to automatically log certain actions
+    Records latency, query count, database, serializer and render time
+    per endpoint (see logs.metrics). Install it first so it times the
+    other middleware too.
     """
+    sync_capable = True
+    async_capable = True
+    
+    methods = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+    
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not metrics.REGISTRY.enabled:
+            return self.get_response(request)
+    
+        started = time.perf_counter()
+        stats, token = metrics.start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.end_request(token)
+        self.record(request, response, stats, time.perf_counter() - started)
+        return response
+    
+    async def __acall__(self, request):
+        if not metrics.REGISTRY.enabled:
+            return await self.get_response(request)
     
-    def process_response(self, request, response):
-        # Skip logging for static files and admin
-        if (request.path.startswith('/static/') or 
-            request.path.startswith('/admin/') or
-            request.path.startswith('/api/logs/')):
-            return response
-        
-        # Log database modifications (POST, PUT, PATCH, DELETE)
-        if (request.method in ['POST', 'PUT', 'PATCH', 'DELETE'] and 
-            response.status_code < 400 and
-            not isinstance(request.user, AnonymousUser)):
-            
-            action_map = {
-                'POST': 'CREATE',
-                'PUT': 'UPDATE',
-                'PATCH': 'UPDATE',
-                'DELETE': 'DELETE'
-            }
-            
-            # Determine resource from URL
-            resource = self.extract_resource_from_path(request.path)
-            
-            if resource:
-                AuditLog.log_action(
-                    user=request.user,
-                    action=action_map[request.method],
-                    resource=resource,
-                    ip_address=self.get_client_ip(request),
-                    user_agent=request.META.get('HTTP_USER_AGENT', ''),
-                    session_id=request.session.session_key,
-                    details={
-                        'method': request.method,
-                        'path': request.path,
-                        'status_code': response.status_code
-                    }
-                )
-        
+        started = time.perf_counter()
+        stats, token = metrics.start_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.end_request(token)
+        self.record(request, response, stats, time.perf_counter() - started)
         return response
     
+    def process_template_response(self, request, response):
+        # Called just before rendering; the callback runs just after it
+        stats = metrics.request_stats()
+        if stats is not None:
+            started = time.perf_counter()
+    
+            def rendered(response):
+                stats.render_seconds += time.perf_counter() - started
+            response.add_post_render_callback(rendered)
+        return response
+    
+    def record(self, request, response, stats, elapsed):
+        # Route names rather than paths keep the number of series bounded
+        match = request.resolver_match
+        endpoint = match.view_name if match is not None else 'unmatched'
+        method = request.method if request.method in self.methods else 'OTHER'
+        status = f'{response.status_code // 100}xx'
+    
+        metrics.REQUEST_SECONDS.observe(elapsed, endpoint, method, status)
+        metrics.REQUEST_QUERIES.observe(stats.queries, endpoint)
+        if stats.queries:
+            metrics.REQUEST_DB_SECONDS.observe(stats.db_seconds, endpoint)
+        if stats.serialize_seconds:
+            metrics.SERIALIZE_SECONDS.observe(stats.serialize_seconds, endpoint)
+        if stats.render_seconds:
+            metrics.RENDER_SECONDS.observe(stats.render_seconds, endpoint)
+        metrics.log_event(
+            'request', endpoint=endpoint, method=method, status=response.status_code,
+            duration_ms=round(elapsed * 1000, 3), queries=stats.queries,
+            db_ms=round(stats.db_seconds * 1000, 3),
+            serialize_ms=round(stats.serialize_seconds * 1000, 3),
+            render_ms=round(stats.render_seconds * 1000, 3),
+        )
+
+
+class AuditMiddleware:
+    """
+    Middleware to automatically log the requests selected by
+    AUDIT_ROUTING_RULES (see logs.routing)
+    
+    Runs natively in both modes: under ASGI the response is awaited and the
+    entry is handed to the writer without moving the request to a thread
+    (a buffered writer only enqueues it).
+    """
+    sync_capable = True
+    async_capable = True
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        # Compile the rules now so configuration errors surface at startup
+        get_audit_router()
+    
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+    
+        response = self.get_response(request)
+        started = time.perf_counter()
+        rule = self.get_rule(request, response)
+        if rule is not None and not isinstance(request.user, AnonymousUser):
+            get_audit_writer().submit(self.build_entry(request, response, request.user, rule))
+        metrics.AUDIT_MIDDLEWARE_SECONDS.observe(time.perf_counter() - started)
+        return response
+    
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        started = time.perf_counter()
+        rule = self.get_rule(request, response)
+        if rule is not None:
+            user = request.user
+            if isinstance(user, SimpleLazyObject):
+                # Not replaced by DRF authentication: resolve the session user
+                user = await request.auser()
+            if not isinstance(user, AnonymousUser):
+                await get_audit_writer().asubmit(self.build_entry(request, response, user, rule))
+        metrics.AUDIT_MIDDLEWARE_SECONDS.observe(time.perf_counter() - started)
+        return response
+    
+    def get_rule(self, request, response):
+        """The AUDIT_ROUTING_RULES entry to log this request with, or None to skip it"""
+        rule = get_audit_router().match(request, response)
+        if rule is None or not rule.log or rule.get_action(request.method) is None:
+            return None
+        if rule.sample_rate < 1 and random.random() >= rule.sample_rate:
+            return None
+        if rule.resource is None and self.extract_resource_from_path(request.path) is None:
+            return None
+        return rule
+    
+    def build_entry(self, request, response, user, rule):
+        details = {
+            'method': request.method,
+            'path': request.path,
+            'status_code': response.status_code
+        }
+        if rule.sample_rate < 1:
+            # Lets reports scale sampled counts back up
+            details['sample_rate'] = rule.sample_rate
+        match = request.resolver_match
+        kwargs = {'severity': rule.severity} if rule.severity else {}
+        return AuditLog.build(
+            user=user,
+            action=rule.get_action(request.method),
+            resource=rule.resource or self.extract_resource_from_path(request.path),
+            resource_id=str(match.kwargs['pk']) if match is not None and 'pk' in match.kwargs else None,
+            ip_address=self.get_client_ip(request),
+            user_agent=request.META.get('HTTP_USER_AGENT', ''),
+            session_id=request.session.session_key,
+            details=details,
+            **kwargs
+        )
+    
     def extract_resource_from_path(self, path):
         """Extract resource name from URL path"""
         # Simple extraction - can be enhanced based on your URL patterns
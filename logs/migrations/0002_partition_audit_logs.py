@@ -0,0 +1,23 @@
+from django.db import migrations
+
+from logs.partitions import PARTITION_TABLE_SQL, create_partitions, is_supported
+
+
+def partition_audit_logs(apps, schema_editor):
+    if not is_supported(schema_editor.connection):
+        return
+    schema_editor.execute(PARTITION_TABLE_SQL, params=None)
+    create_partitions()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("logs", "0001_initial"),
+    ]
+
+    operations = [
+        # Partitioning only changes the physical layout, so the model state
+        # is untouched and reversing leaves the partitioned table in place.
+        migrations.RunPython(partition_audit_logs, migrations.RunPython.noop),
+    ]
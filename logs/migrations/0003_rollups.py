@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:42
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logs', '0002_partition_audit_logs'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditLogWatermark',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('last_id', models.BigIntegerField(default=0, help_text='Largest audit log id already processed')),
+                ('pending_id', models.BigIntegerField(default=0, help_text='Largest audit log id seen on the previous run')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'audit_log_watermarks',
+            },
+        ),
+        migrations.CreateModel(
+            name='AuditLogRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('minute', 'Minute'), ('hour', 'Hour'), ('day', 'Day')], help_text='Width of the time bucket', max_length=10)),
+                ('bucket', models.DateTimeField(help_text='Start of the time bucket')),
+                ('action', models.CharField(choices=[('LOGIN', 'User Login'), ('FAILED_LOGIN', 'Failed Login'), ('LOGOUT', 'User Logout'), ('CREATE', 'Record Created'), ('UPDATE', 'Record Updated'), ('DELETE', 'Record Deleted'), ('VIEW', 'Record Viewed'), ('EXPORT', 'Data Exported')], max_length=20)),
+                ('severity', models.CharField(choices=[('LOW', 'Low'), ('MEDIUM', 'Medium'), ('HIGH', 'High'), ('CRITICAL', 'Critical')], max_length=10)),
+                ('resource', models.CharField(max_length=100)),
+                ('count', models.PositiveBigIntegerField(default=0, help_text='Number of audit logs in the bucket')),
+                ('user', models.ForeignKey(blank=True, db_constraint=False, help_text='User who performed the actions', null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'audit_log_rollups',
+                'indexes': [models.Index(fields=['granularity', 'bucket'], name='audit_log_r_granula_af2c3c_idx')],
+                'constraints': [models.UniqueConstraint(fields=('granularity', 'bucket', 'action', 'severity', 'resource', 'user'), name='audit_log_rollups_unique', nulls_distinct=False)],
+            },
+        ),
+    ]
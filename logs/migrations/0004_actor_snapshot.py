@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logs', '0003_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='auditlog',
+            name='actor_email',
+            field=models.EmailField(blank=True, help_text='Email of the user when the action occurred', max_length=254, null=True),
+        ),
+        migrations.AddField(
+            model_name='auditlog',
+            name='actor_is_staff',
+            field=models.BooleanField(default=False, help_text='Whether the user was staff when the action occurred'),
+        ),
+        migrations.AddField(
+            model_name='auditlog',
+            name='actor_username',
+            field=models.CharField(blank=True, help_text='Username of the user when the action occurred', max_length=150, null=True),
+        ),
+    ]
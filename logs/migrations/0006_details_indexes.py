@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:52
+
+import django.contrib.postgres.indexes
+import django.db.models.fields.json
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logs', '0005_search_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['details'], name='audit_logs_details_gin', opclasses=['jsonb_path_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(django.contrib.postgres.indexes.OpClass(django.db.models.fields.json.KeyTextTransform('method', 'details'), name='text_pattern_ops'), name='audit_d_method'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(django.contrib.postgres.indexes.OpClass(django.db.models.fields.json.KeyTextTransform('path', 'details'), name='text_pattern_ops'), name='audit_d_path'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(django.db.models.fields.json.KeyTransform('status_code', 'details'), name='audit_d_status_code'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(django.contrib.postgres.indexes.OpClass(django.db.models.fields.json.KeyTextTransform('attempted_username', 'details'), name='text_pattern_ops'), name='audit_d_attempted_username'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(django.contrib.postgres.indexes.OpClass(django.db.models.fields.json.KeyTextTransform('alert_type', 'details'), name='text_pattern_ops'), name='audit_d_alert_type'),
+        ),
+    ]
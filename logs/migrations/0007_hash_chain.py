@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logs', '0006_details_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='auditlog',
+            name='entry_hash',
+            field=models.CharField(blank=True, editable=False, help_text="HMAC of the entry's content when it was written (see logs.chain)", max_length=64, null=True),
+        ),
+        migrations.CreateModel(
+            name='AuditChainCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_id', models.BigIntegerField(help_text='First audit log id covered')),
+                ('last_id', models.BigIntegerField(help_text='Last audit log id covered', unique=True)),
+                ('size', models.PositiveIntegerField(help_text='Number of audit logs sealed')),
+                ('first_timestamp', models.DateTimeField(help_text='Oldest timestamp of the sealed logs')),
+                ('last_timestamp', models.DateTimeField(help_text='Newest timestamp of the sealed logs')),
+                ('merkle_root', models.CharField(max_length=64)),
+                ('previous_hash', models.CharField(help_text='chain_hash of the previous checkpoint', max_length=64)),
+                ('chain_hash', models.CharField(help_text='HMAC over this checkpoint and previous_hash', max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'audit_chain_checkpoints',
+                'ordering': ['last_id'],
+                'indexes': [models.Index(fields=['last_timestamp'], name='audit_chain_last_ti_10d854_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logs', '0007_hash_chain'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditLogImport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(help_text='Absolute path of the imported file', max_length=500, unique=True)),
+                ('offset', models.BigIntegerField(default=0, help_text='Bytes of the (decompressed) file already consumed')),
+                ('line', models.BigIntegerField(default=0, help_text='Lines of the file already consumed')),
+                ('imported', models.BigIntegerField(default=0)),
+                ('rejected', models.BigIntegerField(default=0)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'audit_log_imports',
+            },
+        ),
+    ]
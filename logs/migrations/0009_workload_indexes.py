@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:44
+
+import django.contrib.postgres.indexes
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logs', '0008_log_imports'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='auditlog',
+            name='audit_logs_ip_addr_345630_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='auditlog',
+            name='audit_logs_severit_83c56b_idx',
+        ),
+        migrations.AlterField(
+            model_name='auditlog',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='When the action occurred'),
+        ),
+        migrations.AlterField(
+            model_name='auditlog',
+            name='user',
+            field=models.ForeignKey(blank=True, db_index=False, help_text='User who performed the action', null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['timestamp', 'id'], name='audit_logs_timestamp_id'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['resource_id'], name='audit_logs_resource_id'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=django.contrib.postgres.indexes.HashIndex(condition=models.Q(('session_id__isnull', False)), fields=['session_id'], name='audit_logs_session_id'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(condition=models.Q(('severity__in', ['HIGH', 'CRITICAL'])), fields=['timestamp', 'id'], name='audit_logs_high_severity'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(condition=models.Q(('action', 'FAILED_LOGIN')), fields=['timestamp', 'ip_address'], name='audit_logs_failed_login'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:51
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logs', '0009_workload_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditLogSketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], help_text='Width of the time bucket', max_length=10)),
+                ('bucket', models.DateTimeField(help_text='Start of the time bucket')),
+                ('metric', models.CharField(help_text='What the sketch summarizes, e.g. distinct_ip_address', max_length=50)),
+                ('data', models.BinaryField(help_text='Serialized sketch')),
+                ('user', models.ForeignKey(blank=True, db_constraint=False, help_text='User the sketch is limited to, if any', null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'audit_log_sketches',
+                'constraints': [models.UniqueConstraint(fields=('granularity', 'bucket', 'metric', 'user'), name='audit_log_sketches_unique', nulls_distinct=False)],
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logs', '0010_sketches'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='auditlog',
+            name='ip_blocklisted',
+            field=models.BooleanField(default=False, help_text='Whether the IP address was on the blocklist'),
+        ),
+        migrations.AddField(
+            model_name='auditlog',
+            name='ip_country',
+            field=models.CharField(blank=True, help_text='Country code of the IP address', max_length=2, null=True),
+        ),
+        migrations.AddField(
+            model_name='auditlog',
+            name='ip_network',
+            field=models.CharField(blank=True, help_text='Network class of the IP address: internal, vpn, cloud, ... or public', max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='auditlog',
+            name='ip_network_name',
+            field=models.CharField(blank=True, help_text='Name of that network, e.g. the cloud provider', max_length=100, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(condition=models.Q(('ip_blocklisted', True)), fields=['timestamp', 'id'], name='audit_logs_ip_blocklisted'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['ip_network', '-timestamp'], name='audit_logs_ip_network'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['ip_country', '-timestamp'], name='audit_logs_ip_country'),
+        ),
+    ]
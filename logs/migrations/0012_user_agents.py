@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:08
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logs', '0011_ip_enrichment'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserAgent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(help_text='MD5 of the user agent string', max_length=32, unique=True)),
+                ('user_agent', models.TextField(help_text='User agent string')),
+                ('browser', models.CharField(blank=True, max_length=50)),
+                ('browser_version', models.CharField(blank=True, max_length=20)),
+                ('os', models.CharField(blank=True, max_length=50)),
+                ('os_version', models.CharField(blank=True, max_length=20)),
+                ('device', models.CharField(choices=[('desktop', 'Desktop'), ('mobile', 'Mobile'), ('tablet', 'Tablet'), ('bot', 'Bot or script'), ('other', 'Other')], default='other', max_length=10)),
+                ('first_seen', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'audit_user_agents',
+            },
+        ),
+        migrations.AddField(
+            model_name='auditlog',
+            name='agent',
+            field=models.ForeignKey(blank=True, db_constraint=False, db_index=False, help_text='User agent of the request', null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='logs.useragent'),
+        ),
+    ]
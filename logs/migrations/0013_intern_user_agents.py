@@ -0,0 +1,82 @@
+"""
+Links every audit log to its row in audit_user_agents. The user_agent
+column is only dropped by the next migration, so this one can be rerun
+after an interruption.
+"""
+from django.db import migrations, transaction
+from django.db.models import Max, Min
+
+from logs.agents import digest, parse_user_agent
+
+# Audit log ids updated per transaction
+BATCH_SIZE = 50000
+
+
+def _id_batches(AuditLog):
+    bounds = AuditLog.objects.aggregate(first=Min('id'), last=Max('id'))
+    if bounds['first'] is None:
+        return
+    for after in range(bounds['first'] - 1, bounds['last'], BATCH_SIZE):
+        yield after, after + BATCH_SIZE
+
+
+def intern_user_agents(apps, schema_editor):
+    AuditLog = apps.get_model('logs', 'AuditLog')
+    UserAgent = apps.get_model('logs', 'UserAgent')
+    connection = schema_editor.connection
+
+    values = (
+        AuditLog.objects.filter(user_agent__isnull=False)
+        .order_by().values_list('user_agent', flat=True).distinct()
+    )
+    UserAgent.objects.bulk_create(
+        [UserAgent(digest=digest(value), user_agent=value, **parse_user_agent(value)) for value in values],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+    if connection.vendor != 'postgresql':
+        for agent_id, value in UserAgent.objects.values_list('id', 'user_agent'):
+            AuditLog.objects.filter(user_agent=value).update(agent_id=agent_id)
+        return
+    # Batches of ids, each committed on its own: no transaction holds the
+    # whole table, and a rerun after an interruption skips the linked logs
+    for after, last in _id_batches(AuditLog):
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(
+                'UPDATE audit_logs l SET agent_id = a.id FROM audit_user_agents a '
+                'WHERE l.id > %s AND l.id <= %s AND l.agent_id IS NULL AND l.user_agent = a.user_agent',
+                [after, last],
+            )
+
+
+def restore_user_agents(apps, schema_editor):
+    AuditLog = apps.get_model('logs', 'AuditLog')
+    UserAgent = apps.get_model('logs', 'UserAgent')
+    connection = schema_editor.connection
+
+    if connection.vendor != 'postgresql':
+        for agent_id, value in UserAgent.objects.values_list('id', 'user_agent'):
+            AuditLog.objects.filter(agent_id=agent_id).update(user_agent=value)
+        return
+    for after, last in _id_batches(AuditLog):
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(
+                'UPDATE audit_logs l SET user_agent = a.user_agent FROM audit_user_agents a '
+                'WHERE l.id > %s AND l.id <= %s AND l.agent_id = a.id',
+                [after, last],
+            )
+
+
+class Migration(migrations.Migration):
+
+    # Existing logs are updated in batches committed one at a time
+    atomic = False
+
+    dependencies = [
+        ('logs', '0012_user_agents'),
+    ]
+
+    operations = [
+        migrations.RunPython(intern_user_agents, restore_user_agents),
+    ]
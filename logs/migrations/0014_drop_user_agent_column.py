@@ -0,0 +1,32 @@
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logs', '0013_intern_user_agents'),
+    ]
+
+    # Dropping the column does not shrink the table by itself; VACUUM FULL
+    # (or pg_repack) afterwards reclaims the space.
+    operations = [
+        migrations.RemoveIndex(
+            model_name='auditlog',
+            name='audit_logs_search_gin',
+        ),
+        migrations.RemoveField(
+            model_name='auditlog',
+            name='user_agent',
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['agent'], name='audit_logs_agent'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.search.SearchVector(django.db.models.functions.comparison.Cast('details', models.TextField()), config='simple'), name='audit_logs_search_gin'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:17
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logs', '0014_drop_user_agent_column'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditLogExport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ip_address', models.GenericIPAddressField(help_text='IP address the export was requested from')),
+                ('export_format', models.CharField(max_length=10)),
+                ('compress', models.BooleanField(default=False)),
+                ('filters', models.JSONField(default=dict, help_text='Query parameters of the request; shard_bounds holds the dates')),
+                ('descending', models.BooleanField(default=True, help_text='Whether the newest logs come first')),
+                ('shard_bounds', models.JSONField(default=list, help_text='[start, end) ISO timestamps of each shard, in file order')),
+                ('files', models.JSONField(default=list, help_text='[storage name, size] of each written shard, in file order')),
+                ('shards_done', models.PositiveIntegerField(default=0)),
+                ('rows', models.PositiveBigIntegerField(default=0)),
+                ('size', models.PositiveBigIntegerField(default=0, help_text='Bytes of the completed export')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(help_text='User who requested the export', on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'audit_log_exports',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['user', '-created_at'], name='audit_log_e_user_id_6256ff_idx'), models.Index(fields=['created_at'], name='audit_log_e_created_e6700d_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logs', '0015_export_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='auditchaincheckpoint',
+            name='expired_at',
+            field=models.DateTimeField(blank=True, help_text='When retention dropped some of the sealed logs', null=True),
+        ),
+    ]
@@ -0,0 +1,73 @@
+"""
+Hashes the audit logs written before entry hashes existed, so verification
+can treat a missing hash as tampering. Batches are committed one at a time
+and only rows still without a hash are read, so this can be rerun after an
+interruption.
+
+The actor snapshot is hashed too, so logs written before it existed get
+it first (what ``backfill_actor_snapshot`` does): filling it in after
+hashing would make every such log look modified.
+"""
+from django.conf import settings
+from django.db import migrations, transaction
+from django.db.models import Max, Min, OuterRef, Subquery
+
+from logs.chain import HASHED_FIELDS, HASHED_LOOKUPS, entry_hash
+
+# Audit log ids hashed per transaction
+BATCH_SIZE = 5000
+
+
+def backfill_actor_snapshots(apps, schema_editor):
+    AuditLog = apps.get_model('logs', 'AuditLog')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    alias = schema_editor.connection.alias
+
+    pending = AuditLog.objects.using(alias).filter(actor_username__isnull=True, user__isnull=False)
+    bounds = pending.aggregate(first=Min('id'), last=Max('id'))
+    if bounds['first'] is None:
+        return
+    users = User.objects.using(alias).filter(pk=OuterRef('user_id'))
+    for after in range(bounds['first'] - 1, bounds['last'], BATCH_SIZE):
+        pending.filter(id__gt=after, id__lte=after + BATCH_SIZE).update(
+            actor_username=Subquery(users.values('username')[:1]),
+            actor_email=Subquery(users.values('email')[:1]),
+            actor_is_staff=Subquery(users.values('is_staff')[:1]),
+        )
+
+
+def backfill_entry_hashes(apps, schema_editor):
+    AuditLog = apps.get_model('logs', 'AuditLog')
+    alias = schema_editor.connection.alias
+
+    pending = AuditLog.objects.using(alias).filter(entry_hash__isnull=True)
+    bounds = pending.aggregate(first=Min('id'), last=Max('id'))
+    if bounds['first'] is None:
+        return
+    for after in range(bounds['first'] - 1, bounds['last'], BATCH_SIZE):
+        with transaction.atomic(using=alias):
+            rows = (
+                pending.filter(id__gt=after, id__lte=after + BATCH_SIZE)
+                .order_by('id').values_list('id', *HASHED_LOOKUPS)
+            )
+            AuditLog.objects.using(alias).bulk_update(
+                [AuditLog(id=log_id, entry_hash=entry_hash(dict(zip(HASHED_FIELDS, values))))
+                 for log_id, *values in rows],
+                ['entry_hash'],
+            )
+
+
+class Migration(migrations.Migration):
+
+    # Existing logs are updated in batches committed one at a time
+    atomic = False
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('logs', '0016_checkpoint_expiry'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_actor_snapshots, migrations.RunPython.noop),
+        migrations.RunPython(backfill_entry_hashes, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,89 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.contrib.postgres.indexes import GinIndex, HashIndex, OpClass
+from django.contrib.postgres.search import SearchVector
+from django.db.models.fields.json import KeyTextTransform, KeyTransform
+from django.db.models.functions import Cast, Upper
 from django.utils import timezone
 
+# Columns ``?q=`` matches by substring. Each has a pg_trgm index on the
+# same expression Django generates for ``icontains``.
+TRIGRAM_SEARCH_FIELDS = ['actor_username', 'actor_email', 'resource', 'resource_id', 'ip_address']
+
+
+def trigram_search_expression(field):
+    """``UPPER(column)``, or ``UPPER(HOST(column))`` for the IP address"""
+    if field == 'ip_address':
+        return Upper(models.Func(field, function='HOST', output_field=models.TextField()))
+    return Upper(field)
+
+
+# ``details`` keys filtered on often enough to get their own btree index.
+# Numeric keys are indexed as jsonb (ranges such as ``status_code >= 500``),
+# text keys as text with ``text_pattern_ops`` (equality and prefix matches).
+DETAILS_INDEXED_KEYS = {
+    'method': 'text',
+    'path': 'text',
+    'status_code': 'number',
+    'attempted_username': 'text',
+    'alert_type': 'text',
+}
+
+
+# Severities with their own partial index; the others are most of the
+# table and are found quickly enough walking the timestamp index.
+HIGH_SEVERITIES = ['HIGH', 'CRITICAL']
+
+
+def details_key_index(key, kind):
+    if kind == 'number':
+        return models.Index(KeyTransform(key, 'details'), name=f'audit_d_{key}')
+    return models.Index(
+        OpClass(KeyTextTransform(key, 'details'), name='text_pattern_ops'),
+        name=f'audit_d_{key}'
+    )
+
+
+def search_vector():
+    """Full-text document of a log, shared by the GIN index and the queries using it"""
+    return SearchVector(Cast('details', models.TextField()), config='simple')
+
+
+class UserAgent(models.Model):
+    """
+    A distinct user agent string, stored once for all the audit logs sent
+    with it. Rows are added by ``logs.agents`` and never changed.
+    """
+    DEVICE_CHOICES = [
+        ('desktop', 'Desktop'),
+        ('mobile', 'Mobile'),
+        ('tablet', 'Tablet'),
+        ('bot', 'Bot or script'),
+        ('other', 'Other'),
+    ]
+    
+    digest = models.CharField(
+        max_length=32,
+        unique=True,
+        help_text="MD5 of the user agent string"
+    )
+    user_agent = models.TextField(
+        help_text="User agent string"
+    )
+    browser = models.CharField(max_length=50, blank=True)
+    browser_version = models.CharField(max_length=20, blank=True)
+    os = models.CharField(max_length=50, blank=True)
+    os_version = models.CharField(max_length=20, blank=True)
+    device = models.CharField(max_length=10, choices=DEVICE_CHOICES, default='other')
+    first_seen = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        db_table = 'audit_user_agents'
+    
+    def __str__(self):
+        return self.user_agent
+
+
 class AuditLog(models.Model):
     ACTION_CHOICES = [
         ('LOGIN', 'User Login'),
@@ -21,13 +103,39 @@ class AuditLog(models.Model):
         ('CRITICAL', 'Critical'),
     ]
     
+    DEFAULT_SEVERITIES = {
+        'FAILED_LOGIN': 'HIGH',
+        'DELETE': 'MEDIUM',
+        'LOGIN': 'LOW',
+        'LOGOUT': 'LOW',
+    }
+    
     user = models.ForeignKey(
         User, 
         on_delete=models.SET_NULL, 
         null=True, 
         blank=True,
+        # Covered by the (user, -timestamp) index
+        db_index=False,
         help_text="User who performed the action"
     )
+    # Snapshot of the user at write time, so reads need no join and keep
+    # the original identity after a user is renamed or deleted.
+    actor_username = models.CharField(
+        max_length=150,
+        null=True,
+        blank=True,
+        help_text="Username of the user when the action occurred"
+    )
+    actor_email = models.EmailField(
+        null=True,
+        blank=True,
+        help_text="Email of the user when the action occurred"
+    )
+    actor_is_staff = models.BooleanField(
+        default=False,
+        help_text="Whether the user was staff when the action occurred"
+    )
     action = models.CharField(
         max_length=20, 
         choices=ACTION_CHOICES,
@@ -46,14 +154,20 @@ class AuditLog(models.Model):
     ip_address = models.GenericIPAddressField(
         help_text="IP address of the user"
     )
-    user_agent = models.TextField(
-        null=True, 
+    # The string is stored once in UserAgent, see ``user_agent`` below
+    agent = models.ForeignKey(
+        UserAgent,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
         blank=True,
-        help_text="User agent string"
+        related_name='+',
+        # Covered by the audit_logs_agent index
+        db_index=False,
+        help_text="User agent of the request"
     )
     timestamp = models.DateTimeField(
         default=timezone.now,
-        db_index=True,
         help_text="When the action occurred"
     )
     severity = models.CharField(
@@ -73,36 +187,413 @@ class AuditLog(models.Model):
         blank=True,
         help_text="Session ID when action occurred"
     )
+    # Network classification of ip_address when written (see logs.enrichment)
+    ip_network = models.CharField(
+        max_length=20,
+        null=True,
+        blank=True,
+        help_text="Network class of the IP address: internal, vpn, cloud, ... or public"
+    )
+    ip_network_name = models.CharField(
+        max_length=100,
+        null=True,
+        blank=True,
+        help_text="Name of that network, e.g. the cloud provider"
+    )
+    ip_country = models.CharField(
+        max_length=2,
+        null=True,
+        blank=True,
+        help_text="Country code of the IP address"
+    )
+    ip_blocklisted = models.BooleanField(
+        default=False,
+        help_text="Whether the IP address was on the blocklist"
+    )
+    entry_hash = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="HMAC of the entry's content when it was written (see logs.chain)"
+    )
     
     class Meta:
         db_table = 'audit_logs'
         ordering = ['-timestamp']
         indexes = [
+            # The list's ``-timestamp, -id`` order, its keyset pages and date ranges
+            models.Index(fields=['timestamp', 'id'], name='audit_logs_timestamp_id'),
             models.Index(fields=['user', '-timestamp']),
             models.Index(fields=['action', '-timestamp']),
-            models.Index(fields=['ip_address', '-timestamp']),
-            models.Index(fields=['severity', '-timestamp']),
+            # Few rows per record or session: equality lookups, sorted afterwards
+            models.Index(fields=['resource_id'], name='audit_logs_resource_id'),
+            HashIndex(
+                fields=['session_id'], name='audit_logs_session_id',
+                condition=models.Q(session_id__isnull=False)
+            ),
+            # Partial indexes only cost the inserts of the rows they cover
+            models.Index(
+                fields=['timestamp', 'id'], name='audit_logs_high_severity',
+                condition=models.Q(severity__in=HIGH_SEVERITIES)
+            ),
+            models.Index(
+                fields=['timestamp', 'ip_address'], name='audit_logs_failed_login',
+                condition=models.Q(action='FAILED_LOGIN')
+            ),
+            models.Index(
+                fields=['timestamp', 'id'], name='audit_logs_ip_blocklisted',
+                condition=models.Q(ip_blocklisted=True)
+            ),
+            models.Index(fields=['ip_network', '-timestamp'], name='audit_logs_ip_network'),
+            models.Index(fields=['ip_country', '-timestamp'], name='audit_logs_ip_country'),
+            models.Index(fields=['agent'], name='audit_logs_agent'),
+            GinIndex(search_vector(), name='audit_logs_search_gin'),
+            # Serves ``details @> '{...}'`` containment filters
+            GinIndex(fields=['details'], opclasses=['jsonb_path_ops'], name='audit_logs_details_gin'),
+        ] + [
+            details_key_index(key, kind) for key, kind in DETAILS_INDEXED_KEYS.items()
+        ] + [
+            GinIndex(
+                OpClass(trigram_search_expression(field), name='gin_trgm_ops'),
+                name=f'audit_logs_{field}_trgm'
+            )
+            for field in TRIGRAM_SEARCH_FIELDS
         ]
     
+    # User agent string set on an unsaved entry, until it is stored in ``agent``
+    pending_user_agent = None
+    
     def __str__(self):
-        username = self.user.username if self.user else 'Anonymous'
+        username = self.actor_username or 'Anonymous'
         return f"{username} - {self.action} - {self.timestamp}"
     
+    @property
+    def user_agent(self):
+        """User agent string, resolved from ``agent`` through a cache"""
+        if self.pending_user_agent is not None or self.agent_id is None:
+            return self.pending_user_agent
+        if AuditLog.agent.is_cached(self):
+            return self.agent.user_agent
+        from .agents import resolve
+        
+        return resolve((self.agent_id,)).get(self.agent_id)
+    
+    @user_agent.setter
+    def user_agent(self, value):
+        self.pending_user_agent = value
+        self.agent_id = None
+    
+    def compute_entry_hash(self):
+        from .chain import HASHED_FIELDS, entry_hash
+        
+        return entry_hash({field: getattr(self, field) for field in HASHED_FIELDS})
+    
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            from .agents import intern
+            from .enrichment import enrich
+            
+            intern([self])
+            enrich([self])
+            if not self.entry_hash:
+                self.entry_hash = self.compute_entry_hash()
+        super().save(*args, **kwargs)
+    
     @classmethod
-    def log_action(cls, user, action, resource, ip_address, **kwargs):
-        """Convenience method to create audit log entries"""
-        severity_map = {
-            'FAILED_LOGIN': 'HIGH',
-            'DELETE': 'MEDIUM',
-            'LOGIN': 'LOW',
-            'LOGOUT': 'LOW',
-        }
+    def build(cls, user, action, resource, ip_address, **kwargs):
+        """Create an unsaved audit log entry with the default severity applied"""
+        kwargs.setdefault('severity', cls.DEFAULT_SEVERITIES.get(action, 'LOW'))
+        if user is not None and user.is_authenticated:
+            kwargs.setdefault('actor_username', user.get_username())
+            kwargs.setdefault('actor_email', user.email)
+            kwargs.setdefault('actor_is_staff', user.is_staff)
         
-        return cls.objects.create(
+        return cls(
             user=user,
             action=action,
             resource=resource,
             ip_address=ip_address,
-            severity=severity_map.get(action, 'LOW'),
             **kwargs
-        )
\ No newline at end of file
+        )
+    
+    @classmethod
+    def log_action(cls, user, action, resource, ip_address, **kwargs):
+        """
+        Convenience method to create audit log entries.
+        
+        The entry is handed to the writer configured in
+        ``settings.AUDIT_LOG_WRITER``, which may persist it later in a batch.
+        """
+        from .writers import get_audit_writer
+        
+        entry = cls.build(user, action, resource, ip_address, **kwargs)
+        return get_audit_writer().submit(entry)
+    
+    @classmethod
+    async def alog_action(cls, user, action, resource, ip_address, **kwargs):
+        """``log_action`` for async views and middleware"""
+        from .writers import get_audit_writer
+        
+        entry = cls.build(user, action, resource, ip_address, **kwargs)
+        return await get_audit_writer().asubmit(entry)
+
+
+class AuditLogRollup(models.Model):
+    """
+    Pre-aggregated audit log counts per time bucket.
+    
+    Maintained incrementally by ``logs.rollups.update_rollups`` so that
+    statistics and time series never have to scan ``audit_logs``.
+    """
+    GRANULARITY_CHOICES = [
+        ('minute', 'Minute'),
+        ('hour', 'Hour'),
+        ('day', 'Day'),
+    ]
+    
+    granularity = models.CharField(
+        max_length=10,
+        choices=GRANULARITY_CHOICES,
+        help_text="Width of the time bucket"
+    )
+    bucket = models.DateTimeField(
+        help_text="Start of the time bucket"
+    )
+    action = models.CharField(max_length=20, choices=AuditLog.ACTION_CHOICES)
+    severity = models.CharField(max_length=10, choices=AuditLog.SEVERITY_CHOICES)
+    resource = models.CharField(max_length=100)
+    user = models.ForeignKey(
+        User,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        blank=True,
+        related_name='+',
+        help_text="User who performed the actions"
+    )
+    count = models.PositiveBigIntegerField(
+        default=0,
+        help_text="Number of audit logs in the bucket"
+    )
+    
+    class Meta:
+        db_table = 'audit_log_rollups'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['granularity', 'bucket', 'action', 'severity', 'resource', 'user'],
+                name='audit_log_rollups_unique',
+                nulls_distinct=False,
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['granularity', 'bucket']),
+        ]
+    
+    def __str__(self):
+        return f"{self.granularity} {self.bucket} - {self.action} - {self.count}"
+
+
+class AuditLogSketch(models.Model):
+    """
+    A mergeable sketch of the audit logs in one time bucket.
+    
+    Maintained incrementally by ``logs.sketches.update_sketches`` so that
+    distinct counts and top values are estimated without scanning
+    ``audit_logs``.
+    """
+    GRANULARITY_CHOICES = [
+        ('hour', 'Hour'),
+        ('day', 'Day'),
+    ]
+    
+    granularity = models.CharField(
+        max_length=10,
+        choices=GRANULARITY_CHOICES,
+        help_text="Width of the time bucket"
+    )
+    bucket = models.DateTimeField(
+        help_text="Start of the time bucket"
+    )
+    metric = models.CharField(
+        max_length=50,
+        help_text="What the sketch summarizes, e.g. distinct_ip_address"
+    )
+    user = models.ForeignKey(
+        User,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        blank=True,
+        related_name='+',
+        help_text="User the sketch is limited to, if any"
+    )
+    data = models.BinaryField(
+        help_text="Serialized sketch"
+    )
+    
+    class Meta:
+        db_table = 'audit_log_sketches'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['granularity', 'bucket', 'metric', 'user'],
+                name='audit_log_sketches_unique',
+                nulls_distinct=False,
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.granularity} {self.bucket} - {self.metric}"
+
+
+class AuditLogWatermark(models.Model):
+    """
+    High-water mark of the audit log ids already consumed by a background job.
+    
+    ``pending_id`` is the largest id seen on the previous run. Jobs only
+    process up to it, giving in-flight inserts with lower ids time to commit.
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    last_id = models.BigIntegerField(
+        default=0,
+        help_text="Largest audit log id already processed"
+    )
+    pending_id = models.BigIntegerField(
+        default=0,
+        help_text="Largest audit log id seen on the previous run"
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'audit_log_watermarks'
+    
+    def __str__(self):
+        return f"{self.name} @ {self.last_id}"
+
+
+class AuditLogImport(models.Model):
+    """
+    Progress of one ``import_audit_logs`` source file.
+    
+    Saved in the same transaction as each loaded batch, so an interrupted
+    import resumes after the last committed batch without loading any row
+    twice.
+    """
+    source = models.CharField(
+        max_length=500,
+        unique=True,
+        help_text="Absolute path of the imported file"
+    )
+    offset = models.BigIntegerField(
+        default=0,
+        help_text="Bytes of the (decompressed) file already consumed"
+    )
+    line = models.BigIntegerField(
+        default=0,
+        help_text="Lines of the file already consumed"
+    )
+    imported = models.BigIntegerField(default=0)
+    rejected = models.BigIntegerField(default=0)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'audit_log_imports'
+    
+    def __str__(self):
+        return f"{self.source} @ line {self.line}"
+
+
+class AuditLogExport(models.Model):
+    """
+    A background export of audit logs, written in shards by Celery tasks
+    (see ``logs.export_jobs``) and downloaded once completed.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+    
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        help_text="User who requested the export"
+    )
+    ip_address = models.GenericIPAddressField(
+        help_text="IP address the export was requested from"
+    )
+    export_format = models.CharField(max_length=10)
+    compress = models.BooleanField(default=False)
+    filters = models.JSONField(
+        default=dict,
+        help_text="Query parameters of the request; shard_bounds holds the dates"
+    )
+    descending = models.BooleanField(
+        default=True,
+        help_text="Whether the newest logs come first"
+    )
+    shard_bounds = models.JSONField(
+        default=list,
+        help_text="[start, end) ISO timestamps of each shard, in file order"
+    )
+    files = models.JSONField(
+        default=list,
+        help_text="[storage name, size] of each written shard, in file order"
+    )
+    shards_done = models.PositiveIntegerField(default=0)
+    rows = models.PositiveBigIntegerField(default=0)
+    size = models.PositiveBigIntegerField(default=0, help_text="Bytes of the completed export")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        db_table = 'audit_log_exports'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at']),
+            models.Index(fields=['created_at']),
+        ]
+    
+    def __str__(self):
+        return f"Export {self.pk} ({self.export_format}, {self.status})"
+    
+    @property
+    def shards(self):
+        return len(self.shard_bounds)
+
+
+class AuditChainCheckpoint(models.Model):
+    """
+    Merkle root over a contiguous id range of audit logs, chained to the
+    previous checkpoint. Created by ``logs.chain.seal_chain``.
+    """
+    first_id = models.BigIntegerField(help_text="First audit log id covered")
+    last_id = models.BigIntegerField(unique=True, help_text="Last audit log id covered")
+    size = models.PositiveIntegerField(help_text="Number of audit logs sealed")
+    first_timestamp = models.DateTimeField(help_text="Oldest timestamp of the sealed logs")
+    last_timestamp = models.DateTimeField(help_text="Newest timestamp of the sealed logs")
+    merkle_root = models.CharField(max_length=64)
+    previous_hash = models.CharField(max_length=64, help_text="chain_hash of the previous checkpoint")
+    chain_hash = models.CharField(max_length=64, help_text="HMAC over this checkpoint and previous_hash")
+    created_at = models.DateTimeField(auto_now_add=True)
+    expired_at = models.DateTimeField(
+        null=True, blank=True,
+        help_text="When retention dropped some of the sealed logs"
+    )
+    
+    class Meta:
+        db_table = 'audit_chain_checkpoints'
+        ordering = ['last_id']
+        indexes = [
+            models.Index(fields=['last_timestamp']),
+        ]
+    
+    def __str__(self):
+        return f"Checkpoint {self.first_id}-{self.last_id} ({self.size} logs)"
@@ -0,0 +1,215 @@
+import json
+from base64 import b64decode, b64encode
+from datetime import datetime
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import InvalidPage
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination:
+    """
+    Keyset (seek) pagination over the queryset's ordering plus ``id``.
+
+    Each page is fetched with ``WHERE (a, b, id) < (last a, last b, last id)``
+    and ``LIMIT page_size + 1`` instead of ``OFFSET``, so every page costs the
+    same index range scan no matter how deep it is, and no ``COUNT(*)`` is run.
+    The position is handed to the client as an opaque cursor.
+    """
+
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self, page_size):
+        self.page_size = page_size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page_queryset, reverse = self.get_page_queryset(queryset, request)
+        return self.set_page(list(page_queryset), reverse)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        page_queryset, reverse = self.get_page_queryset(queryset, request)
+        return self.set_page([obj async for obj in page_queryset], reverse)
+
+    def get_page_queryset(self, queryset, request):
+        """The unevaluated query for the requested page, plus whether it runs backwards"""
+        self.request = request
+        self.model = queryset.model
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(queryset)
+
+        values, reverse = self.decode_cursor(request)
+        self.has_cursor = values is not None
+
+        ordering = self.ordering
+        if reverse:
+            ordering = [self._invert(field) for field in ordering]
+        queryset = queryset.order_by(*ordering)
+        if values is not None:
+            queryset = queryset.filter(self.seek_filter(ordering, values))
+        return queryset[:self.page_size + 1], reverse
+
+    def set_page(self, results, reverse):
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+
+        if reverse:
+            results.reverse()
+            self.has_next = self.has_cursor
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.has_cursor
+
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_ordering(self, queryset):
+        """Return the queryset's ordering with ``id`` appended as a tie-breaker"""
+        ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+        names = [field.lstrip('-') for field in ordering]
+        if 'id' not in names and 'pk' not in names:
+            descending = bool(ordering) and ordering[-1].startswith('-')
+            ordering.append('-id' if descending else 'id')
+        return ordering
+
+    def seek_filter(self, ordering, values):
+        """
+        Build ``(f1, f2, ...) > (v1, v2, ...)`` honouring each field's direction.
+
+        The expanded ``OR`` is no index condition, so the bound on the first
+        field (``f1 >= v1``) is repeated on its own for the index to seek to;
+        without it every page walks the index from the top.
+        """
+        condition = Q()
+        equal = {}
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        if len(ordering) > 1:
+            first = ordering[0]
+            condition &= Q(**{f"{first.lstrip('-')}__{'lte' if first.startswith('-') else 'gte'}": values[0]})
+        return condition
+
+    def encode_cursor(self, instance, reverse):
+        values = []
+        for field in self.ordering:
+            value = instance
+            for attr in field.lstrip('-').split('__'):
+                value = getattr(value, attr)
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            values.append(value)
+
+        url = remove_query_param(self.base_url, 'page')
+        return replace_query_param(url, self.cursor_query_param, self.encode_values(values, reverse))
+
+    @staticmethod
+    def encode_values(values, reverse):
+        """Opaque cursor for the position given by the ordering fields' values"""
+        payload = json.dumps({'v': values, 'r': reverse}, separators=(',', ':'))
+        return b64encode(payload.encode('utf-8'), altchars=b'-_').decode('ascii')
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+
+        try:
+            payload = json.loads(b64decode(encoded.encode('ascii'), altchars=b'-_'))
+            values = payload['v']
+            reverse = bool(payload.get('r'))
+            if not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError
+            return [
+                self._to_python(field, value)
+                for field, value in zip(self.ordering, values)
+            ], reverse
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def _to_python(self, field, value):
+        name = field.lstrip('-')
+        try:
+            model_field = self.model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return value
+        return model_field.to_python(value)
+
+    @staticmethod
+    def _invert(field):
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+
+class AuditLogPagination(PageNumberPagination):
+    """
+    Page-number pagination by default. Passing ``?pagination=cursor`` (or a
+    ``cursor`` returned by a previous page) switches to keyset pagination,
+    which skips the count and keeps deep pages as fast as the first one.
+    """
+
+    mode_query_param = 'pagination'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if (request.query_params.get(self.mode_query_param) == 'cursor' or
+                KeysetPagination.cursor_query_param in request.query_params):
+            self.keyset = KeysetPagination(self.get_page_size(request))
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """``paginate_queryset`` for async views, with the count and page queries awaited"""
+        self.keyset = None
+        if (request.query_params.get(self.mode_query_param) == 'cursor' or
+                KeysetPagination.cursor_query_param in request.query_params):
+            self.keyset = KeysetPagination(self.get_page_size(request))
+            return await self.keyset.apaginate_queryset(queryset, request, view)
+
+        self.request = request
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        paginator = self.django_paginator_class(queryset, page_size)
+        paginator.count = await queryset.acount()
+        page_number = self.get_page_number(request, paginator)
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            raise NotFound(self.invalid_page_message.format(
+                page_number=page_number, message=str(exc)
+            ))
+        self.page.object_list = [obj async for obj in self.page.object_list]
+
+        if paginator.num_pages > 1 and self.template is not None:
+            self.display_page_controls = True
+        return list(self.page)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
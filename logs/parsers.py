@@ -0,0 +1,36 @@
+import codecs
+import json
+
+from django.conf import settings
+from rest_framework.parsers import BaseParser
+
+
+class InvalidLine:
+    """Placeholder for an NDJSON line that is not valid JSON"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class NDJSONParser(BaseParser):
+    """
+    Newline-delimited JSON: one value per line, blank lines skipped.
+
+    Lines that fail to parse become ``InvalidLine`` items so they can be
+    reported individually instead of rejecting the whole body.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        items = []
+        for line in codecs.getreader(encoding)(stream):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                items.append(InvalidLine(f'Invalid JSON: {e}'))
+        return items
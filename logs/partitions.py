@@ -0,0 +1,254 @@
+"""
+Monthly range partitioning of the ``audit_logs`` table on PostgreSQL.
+
+``audit_logs`` is partitioned by ``timestamp`` into one partition per month
+(``audit_logs_pYYYY_MM``), plus ``audit_logs_legacy`` holding everything
+written before partitioning was enabled and a ``audit_logs_default``
+catch-all. Retention detaches and drops whole partitions instead of
+running ``DELETE``, then forgets the dropped range in the tables derived
+from the logs: rollup and sketch buckets are deleted, and the hash chain
+checkpoints that sealed dropped logs are marked expired.
+
+A month can only be given its own partition while the DEFAULT partition
+holds none of its rows, so ``create_partitions`` moves such rows (logs
+written far ahead of time, or before maintenance caught up) out of the
+DEFAULT partition first.
+"""
+import logging
+import re
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+PARENT_TABLE = 'audit_logs'
+
+_BOUND_RE = re.compile(r"FROM \((?P<lower>[^)]*)\) TO \((?P<upper>[^)]*)\)")
+
+
+def is_supported(using=None):
+    return (using or connection).vendor == 'postgresql'
+
+
+def _quote(name):
+    return connection.ops.quote_name(name)
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+def partition_name(month):
+    return f'{PARENT_TABLE}_p{month:%Y_%m}'
+
+
+def list_partitions(cursor):
+    """Return ``(name, lower, upper)`` for every partition, ``None`` for open bounds"""
+    cursor.execute(
+        """
+        SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = %s
+        ORDER BY child.relname
+        """,
+        [PARENT_TABLE],
+    )
+    partitions = []
+    for name, bound in cursor.fetchall():
+        match = _BOUND_RE.search(bound)
+        if not match:
+            partitions.append((name, None, None))  # DEFAULT partition
+            continue
+        partitions.append((
+            name,
+            _parse_bound(match.group('lower')),
+            _parse_bound(match.group('upper')),
+        ))
+    return partitions
+
+
+def _parse_bound(value):
+    value = value.strip().strip("'")
+    if value in ('MINVALUE', 'MAXVALUE'):
+        return None
+    return datetime.fromisoformat(value).astimezone(dt_timezone.utc)
+
+
+def create_partitions(months_ahead=3, now=None):
+    """
+    Create monthly partitions from the current month up to ``months_ahead``
+    months in the future. Months already covered by a partition are skipped.
+    Returns the names of the partitions that were created.
+    """
+    now = now or datetime.now(dt_timezone.utc)
+    created = []
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        covered_until = None
+        partitions = list_partitions(cursor)
+        for name, lower, upper in partitions:
+            if upper is not None and (covered_until is None or upper > covered_until):
+                covered_until = upper
+
+        default = next((name for name, lower, upper in partitions if lower is None and upper is None), None)
+
+        month = month_start(now)
+        if covered_until is not None and covered_until > month:
+            month = covered_until
+
+        last = add_months(month_start(now), months_ahead)
+        while month <= last:
+            name = partition_name(month)
+            bounds = [month, add_months(month, 1)]
+            moved = default is not None and _default_has_rows(cursor, default, bounds)
+            if moved:
+                # PostgreSQL refuses a partition for rows the DEFAULT partition
+                # holds, so it is detached while they move over
+                cursor.execute(f'ALTER TABLE {_quote(PARENT_TABLE)} DETACH PARTITION {_quote(default)}')
+            cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS {_quote(name)} '
+                f'PARTITION OF {_quote(PARENT_TABLE)} '
+                f'FOR VALUES FROM (%s) TO (%s)',
+                bounds,
+            )
+            if moved:
+                cursor.execute(
+                    f'WITH moved AS (DELETE FROM {_quote(default)} '
+                    f'WHERE "timestamp" >= %s AND "timestamp" < %s RETURNING *) '
+                    f'INSERT INTO {_quote(name)} SELECT * FROM moved',
+                    bounds,
+                )
+                logger.info('Moved %d audit logs from %s to %s', cursor.rowcount, default, name)
+                cursor.execute(f'ALTER TABLE {_quote(PARENT_TABLE)} ATTACH PARTITION {_quote(default)} DEFAULT')
+            created.append(name)
+            month = add_months(month, 1)
+
+    return created
+
+
+def _default_has_rows(cursor, default, bounds):
+    cursor.execute(
+        f'SELECT EXISTS (SELECT 1 FROM {_quote(default)} WHERE "timestamp" >= %s AND "timestamp" < %s)',
+        bounds,
+    )
+    return cursor.fetchone()[0]
+
+
+def forget_range(lower, upper):
+    """
+    Reconcile what was derived from the logs in ``[lower, upper)`` (``lower``
+    None for no bound) once they are gone: delete their rollup and sketch
+    buckets and mark the checkpoints that sealed any of them expired.
+    """
+    from .models import AuditChainCheckpoint, AuditLogRollup, AuditLogSketch
+
+    buckets = {'bucket__lt': upper}
+    checkpoints = {'first_timestamp__lt': upper, 'expired_at__isnull': True}
+    if lower is not None:
+        buckets['bucket__gte'] = lower
+        checkpoints['last_timestamp__gte'] = lower
+    AuditLogRollup.objects.filter(**buckets).delete()
+    AuditLogSketch.objects.filter(**buckets).delete()
+    AuditChainCheckpoint.objects.filter(**checkpoints).update(expired_at=timezone.now())
+
+
+def drop_expired_partitions(retention_months, detach_only=False, dry_run=False, now=None):
+    """
+    Detach (and unless ``detach_only``, drop) every partition whose upper
+    bound is older than ``retention_months`` whole months. This is a catalog
+    operation, so it takes the same time however many rows the partition has;
+    ``forget_range`` then reconciles the rollups, sketches and checkpoints.
+    Returns the names of the affected partitions.
+    """
+    now = now or datetime.now(dt_timezone.utc)
+    cutoff = add_months(month_start(now), -retention_months)
+    expired = []
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        for name, lower, upper in list_partitions(cursor):
+            if upper is None or upper > cutoff:
+                continue
+            expired.append(name)
+            if dry_run:
+                continue
+
+            quoted = _quote(name)
+            cursor.execute(f'ALTER TABLE {_quote(PARENT_TABLE)} DETACH PARTITION {quoted}')
+            if not detach_only:
+                cursor.execute(f'DROP TABLE {quoted}')
+            forget_range(lower, upper)
+            logger.info(
+                '%s audit log partition %s (older than %s)',
+                'Detached' if detach_only else 'Dropped', name, cutoff.date()
+            )
+
+    return expired
+
+
+# Converts the plain audit_logs table into a partitioned one. The existing
+# table is kept as the audit_logs_legacy partition covering everything up
+# to the end of the month of its newest row, so no data is copied.
+PARTITION_TABLE_SQL = r"""
+DO $$
+DECLARE
+    r record;
+    next_id bigint;
+    boundary timestamptz;
+BEGIN
+    SELECT coalesce(max(id), 0) + 1,
+           date_trunc('month', greatest(now(), max("timestamp")) AT TIME ZONE 'UTC')
+               AT TIME ZONE 'UTC' + interval '1 month'
+      INTO next_id, boundary
+      FROM audit_logs;
+
+    ALTER TABLE audit_logs RENAME TO audit_logs_legacy;
+    ALTER TABLE audit_logs_legacy ALTER COLUMN id DROP IDENTITY IF EXISTS;
+    -- The partition key has to be part of every unique constraint.
+    ALTER TABLE audit_logs_legacy DROP CONSTRAINT audit_logs_pkey;
+    ALTER TABLE audit_logs_legacy ADD CONSTRAINT audit_logs_legacy_pkey PRIMARY KEY (id, "timestamp");
+
+    CREATE TABLE audit_logs (LIKE audit_logs_legacy INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+        PARTITION BY RANGE ("timestamp");
+    EXECUTE format(
+        'ALTER TABLE audit_logs ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY (START WITH %s)',
+        next_id
+    );
+    ALTER TABLE audit_logs ADD CONSTRAINT audit_logs_pkey PRIMARY KEY (id, "timestamp");
+
+    FOR r IN
+        SELECT conname, pg_get_constraintdef(oid) AS definition
+          FROM pg_constraint
+         WHERE conrelid = 'audit_logs_legacy'::regclass AND contype = 'f'
+    LOOP
+        EXECUTE format('ALTER TABLE audit_logs_legacy RENAME CONSTRAINT %I TO %I',
+                       r.conname, left(r.conname, 55) || '_legacy');
+        EXECUTE format('ALTER TABLE audit_logs ADD CONSTRAINT %I %s', r.conname, r.definition);
+    END LOOP;
+
+    FOR r IN
+        SELECT index_class.relname AS name, pg_get_indexdef(pg_index.indexrelid) AS definition
+          FROM pg_index
+          JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid
+         WHERE pg_index.indrelid = 'audit_logs_legacy'::regclass AND NOT pg_index.indisprimary
+    LOOP
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', r.name, left(r.name, 55) || '_legacy');
+        EXECUTE regexp_replace(r.definition, ' ON (ONLY )?\S+ USING ', ' ON audit_logs USING ');
+    END LOOP;
+
+    EXECUTE format(
+        'ALTER TABLE audit_logs ATTACH PARTITION audit_logs_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+        boundary
+    );
+    CREATE TABLE audit_logs_default PARTITION OF audit_logs DEFAULT;
+END
+$$;
+"""
@@ -13,7 +13,7 @@ class AuditLogPermission(permissions.BasePermission):
             return False
         
         # Export permission only for admins
-        if view.action == 'export':
+        if view.action in ('export', 'export_jobs', 'export_job', 'export_job_download'):
             return request.user.is_staff
         
         return True
@@ -24,4 +24,4 @@ class AuditLogPermission(permissions.BasePermission):
             return True
         
         # Users can only access their own logs
-        return obj.user == request.user
\ No newline at end of file
+        return obj.user_id == request.user.id
\ No newline at end of file
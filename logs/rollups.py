@@ -0,0 +1,292 @@
+"""
+Incrementally maintained audit log rollups.
+
+``update_rollups`` folds newly written audit logs into per-minute, per-hour
+and per-day counts keyed by action, severity, resource and user. Reads
+combine the rollups with the few logs written since the last run (the
+"tail"), so results are current while their cost depends on the length of
+the requested time range rather than on the size of ``audit_logs``.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Max, Q, Sum
+from django.db.models.functions import Trunc
+
+from .models import AuditLog, AuditLogRollup, AuditLogWatermark
+
+WATERMARK = 'rollups'
+
+MINUTE = timedelta(minutes=1)
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+
+GRANULARITIES = [('day', DAY), ('hour', HOUR), ('minute', MINUTE)]
+
+# Time-series bucket widths, smallest first.
+INTERVALS = [
+    ('1m', MINUTE),
+    ('5m', 5 * MINUTE),
+    ('15m', 15 * MINUTE),
+    ('1h', HOUR),
+    ('6h', 6 * HOUR),
+    ('1d', DAY),
+    ('7d', 7 * DAY),
+]
+
+ROLLUP_DIMENSIONS = ('action', 'severity', 'resource', 'user')
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+# Aggregates a range of ids once at minute resolution and folds the result
+# into hour and day buckets in the same statement.
+_ROLLUP_SQL = """
+WITH minute AS (
+    SELECT date_trunc('minute', "timestamp") AS bucket,
+           action, severity, resource, user_id, count(*) AS n
+      FROM audit_logs
+     WHERE id > %s AND id <= %s
+     GROUP BY 1, 2, 3, 4, 5
+)
+INSERT INTO audit_log_rollups (granularity, bucket, action, severity, resource, user_id, count)
+SELECT 'minute', bucket, action, severity, resource, user_id, n FROM minute
+UNION ALL
+SELECT 'hour', date_trunc('hour', bucket), action, severity, resource, user_id, sum(n)
+  FROM minute GROUP BY 2, 3, 4, 5, 6
+UNION ALL
+SELECT 'day', date_trunc('day', bucket), action, severity, resource, user_id, sum(n)
+  FROM minute GROUP BY 2, 3, 4, 5, 6
+ON CONFLICT (granularity, bucket, action, severity, resource, user_id)
+DO UPDATE SET count = audit_log_rollups.count + EXCLUDED.count
+"""
+
+
+def is_supported():
+    return connection.vendor == 'postgresql'
+
+
+def retention():
+    return {
+        'minute': timedelta(days=settings.AUDIT_ROLLUP_MINUTE_RETENTION_DAYS),
+        'hour': timedelta(days=settings.AUDIT_ROLLUP_HOUR_RETENTION_DAYS),
+    }
+
+
+def update_rollups(batch_size=100000):
+    """
+    Fold audit logs written since the last run into the rollup tables.
+
+    Each batch of ids is aggregated and the watermark advanced in the same
+    transaction, with the watermark row locked so concurrent runs never
+    count the same logs twice. Returns the number of ids covered.
+    """
+    if not is_supported():
+        return 0
+
+    watermark, _ = AuditLogWatermark.objects.get_or_create(name=WATERMARK)
+    target = watermark.pending_id
+    processed = 0
+
+    while True:
+        with transaction.atomic():
+            watermark = AuditLogWatermark.objects.select_for_update().get(name=WATERMARK)
+            if watermark.last_id >= target:
+                break
+            upper = min(watermark.last_id + batch_size, target)
+            with connection.cursor() as cursor:
+                cursor.execute(_ROLLUP_SQL, [watermark.last_id, upper])
+            processed += upper - watermark.last_id
+            watermark.last_id = upper
+            watermark.save(update_fields=['last_id', 'updated_at'])
+
+    with transaction.atomic():
+        watermark = AuditLogWatermark.objects.select_for_update().get(name=WATERMARK)
+        latest = AuditLog.objects.aggregate(latest=Max('id'))['latest'] or 0
+        watermark.pending_id = max(latest, watermark.pending_id)
+        watermark.save(update_fields=['pending_id', 'updated_at'])
+
+    now = datetime.now(dt_timezone.utc)
+    for granularity, keep in retention().items():
+        AuditLogRollup.objects.filter(granularity=granularity, bucket__lt=now - keep).delete()
+
+    return processed
+
+
+def _floor(value, size):
+    if size == DAY:
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if size == HOUR:
+        return value.replace(minute=0, second=0, microsecond=0)
+    if size == MINUTE:
+        return value.replace(second=0, microsecond=0)
+    return _EPOCH + ((value - _EPOCH) // size) * size
+
+
+def _ceil(value, size):
+    floored = _floor(value, size)
+    return floored if floored == value else floored + size
+
+
+def _finest_available(value, now):
+    """Smallest rollup bucket still retained for a point in time"""
+    keep = retention()
+    if value >= now - keep['minute']:
+        return MINUTE
+    if value >= now - keep['hour']:
+        return HOUR
+    return DAY
+
+
+def bucket_filter(start=None, end=None, granularities=GRANULARITIES):
+    """
+    Return a ``Q`` selecting the fewest rollup rows that cover ``[start, end)``:
+    whole days in the middle, then hours and minutes at the edges.
+
+    Bounds are widened to the finest bucket still retained at that time, so
+    results are exact to the minute for recent ranges and to the hour or day
+    for older ones. ``granularities`` (largest first) limits the buckets to
+    those of a table without minute rows.
+    """
+    now = datetime.now(dt_timezone.utc)
+    smallest = granularities[-1][1]
+    if start is not None:
+        start = start.astimezone(dt_timezone.utc)
+        start = _floor(start, max(_finest_available(start, now), smallest))
+    if end is not None:
+        end = end.astimezone(dt_timezone.utc)
+        end = _ceil(end, max(_finest_available(end, now), smallest))
+
+    condition = Q(pk__in=[])
+    pending = [(start, end)]
+    for granularity, size in granularities:
+        remaining = []
+        for lo, hi in pending:
+            inner_lo = None if lo is None else _ceil(lo, size)
+            inner_hi = None if hi is None else _floor(hi, size)
+            if inner_lo is not None and inner_hi is not None and inner_lo >= inner_hi:
+                remaining.append((lo, hi))
+                continue
+
+            bounds = {'granularity': granularity}
+            if inner_lo is not None:
+                bounds['bucket__gte'] = inner_lo
+            if inner_hi is not None:
+                bounds['bucket__lt'] = inner_hi
+            condition |= Q(**bounds)
+
+            if lo is not None and lo < inner_lo:
+                remaining.append((lo, inner_lo))
+            if hi is not None and inner_hi < hi:
+                remaining.append((inner_hi, hi))
+        pending = remaining
+
+    return condition
+
+
+def _tail(start, end, filters):
+    """Audit logs written after the last rollup run"""
+    watermark = AuditLogWatermark.objects.filter(name=WATERMARK).first()
+    last_id = watermark.last_id if watermark else 0
+
+    queryset = AuditLog.objects.filter(id__gt=last_id, **filters)
+    if start is not None:
+        queryset = queryset.filter(timestamp__gte=start)
+    if end is not None:
+        queryset = queryset.filter(timestamp__lt=end)
+    return queryset.order_by()
+
+
+def count_logs(start=None, end=None, **filters):
+    """Number of audit logs in ``[start, end)`` matching ``filters``"""
+    rolled_up = (
+        AuditLogRollup.objects.filter(bucket_filter(start, end), **filters)
+        .aggregate(total=Sum('count'))['total']
+    )
+    return (rolled_up or 0) + _tail(start, end, filters).count()
+
+
+def top_values(dimension, limit, start=None, end=None, **filters):
+    """Most frequent values of one rollup dimension in ``[start, end)``"""
+    counts = {}
+    rolled_up = (
+        AuditLogRollup.objects.filter(bucket_filter(start, end), **filters)
+        .values_list(dimension)
+        .annotate(total=Sum('count'))
+    )
+    tail = _tail(start, end, filters).values_list(dimension).annotate(total=Count('id'))
+    for queryset in (rolled_up, tail):
+        for value, total in queryset:
+            counts[value] = counts.get(value, 0) + total
+
+    ranked = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return [{dimension: value, 'count': total} for value, total in ranked]
+
+
+def choose_interval(start, end, interval=None, max_points=500):
+    """
+    Pick the bucket width for a time series: the requested one (or the
+    smallest) widened until the range fits in ``max_points`` buckets and
+    the rollups it is built from are still retained.
+    """
+    names = [name for name, _ in INTERVALS]
+    index = names.index(interval) if interval in names else 0
+    now = datetime.now(dt_timezone.utc)
+    finest = _finest_available(start, now)
+
+    while index < len(INTERVALS) - 1:
+        _, size = INTERVALS[index]
+        if size >= finest and (end - start) / size <= max_points:
+            break
+        index += 1
+    return INTERVALS[index]
+
+
+def time_series(start, end, interval=None, group_by=None, max_points=500, **filters):
+    """
+    Bucketed counts for ``[start, end)`` built from the coarsest rollup that
+    divides the chosen interval, plus the unaggregated tail.
+
+    Returns ``(interval name, points)`` where every point has ``bucket`` and
+    ``count``, and ``groups`` with per-value counts when ``group_by`` is set.
+    """
+    name, size = choose_interval(start, end, interval, max_points)
+    source, source_size = next(
+        (granularity, step) for granularity, step in GRANULARITIES
+        if step <= size and (size % step).total_seconds() == 0
+    )
+
+    fields = ['bucket'] + ([group_by] if group_by else [])
+    rolled_up = (
+        AuditLogRollup.objects
+        .filter(granularity=source, bucket__gte=_floor(start, source_size), bucket__lt=end, **filters)
+        .values_list(*fields)
+        .annotate(total=Sum('count'))
+    )
+    tail = (
+        _tail(start, end, filters)
+        .annotate(bucket=Trunc('timestamp', source, tzinfo=dt_timezone.utc))
+        .values_list(*fields)
+        .annotate(total=Count('id'))
+    )
+
+    first = _floor(start, size)
+    buckets = {}
+    bucket = first
+    while bucket < end:
+        buckets[bucket] = {'bucket': bucket, 'count': 0}
+        if group_by:
+            buckets[bucket]['groups'] = {}
+        bucket += size
+
+    for queryset in (rolled_up, tail):
+        for row in queryset:
+            point = buckets.get(_floor(row[0], size))
+            if point is None:
+                continue
+            point['count'] += row[-1]
+            if group_by:
+                key = row[1]
+                point['groups'][key] = point['groups'].get(key, 0) + row[-1]
+
+    return name, list(buckets.values())
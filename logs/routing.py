@@ -0,0 +1,185 @@
+"""
+Rules deciding which requests ``AuditMiddleware`` logs, and how.
+
+``AUDIT_ROUTING_RULES`` is a list of dicts tried in order; the first rule
+matching a request decides. A rule matches on any of
+
+- ``url_name`` and ``namespace``: the resolved URL name and namespace,
+  exact or with shell-style wildcards (``'order-*'``)
+- ``methods``: a list of HTTP methods
+- ``status``: response status codes as ``'2xx'``, ``'<400'``,
+  ``'200-299'``, a single code, or a list of those
+
+and leaves out what it does not care about. A matching rule either skips
+the request (``'log': False``) or logs it with
+
+- ``action``: by default from the method (GET is VIEW, POST is CREATE, ...)
+- ``resource``: by default the title-cased segment after ``/api/``
+- ``severity``: by default the action's default severity
+- ``sample_rate``: the share of matching requests logged, 1 (always) by default
+
+Rules are compiled once; the rules that can apply to a URL name and
+method are worked out on its first request and cached, so deciding costs
+a dict lookup and a status comparison or two.
+"""
+import re
+import threading
+from fnmatch import translate
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+
+from .models import AuditLog
+
+METHOD_ACTIONS = {
+    'GET': 'VIEW',
+    'HEAD': 'VIEW',
+    'POST': 'CREATE',
+    'PUT': 'UPDATE',
+    'PATCH': 'UPDATE',
+    'DELETE': 'DELETE',
+}
+
+RULE_KEYS = {
+    'url_name', 'namespace', 'methods', 'status',
+    'log', 'action', 'resource', 'severity', 'sample_rate',
+}
+
+# Bounds the route cache against clients inventing HTTP methods
+MAX_CACHED_ROUTES = 10000
+
+_STATUS_RE = re.compile(r'^(?:(?P<class>[1-5])xx|<(?P<below>\d{3})|(?P<low>\d{3})-(?P<high>\d{3})|(?P<code>\d{3}))$')
+
+
+def parse_status(spec):
+    """Compile a status spec into a list of inclusive ``(low, high)`` ranges"""
+    if isinstance(spec, (list, tuple)):
+        return [status_range for item in spec for status_range in parse_status(item)]
+    if isinstance(spec, int) and not isinstance(spec, bool):
+        return [(spec, spec)]
+    match = _STATUS_RE.match(str(spec).strip().lower())
+    if match is None:
+        raise ValueError(f'invalid status {spec!r}')
+    if match['class']:
+        low = int(match['class']) * 100
+        return [(low, low + 99)]
+    if match['below']:
+        return [(100, int(match['below']) - 1)]
+    if match['low']:
+        return [(int(match['low']), int(match['high']))]
+    return [(int(match['code']), int(match['code']))]
+
+
+def compile_pattern(pattern):
+    if pattern is None:
+        return None
+    return re.compile(translate(pattern)).match
+
+
+class AuditRule:
+    """One compiled entry of ``AUDIT_ROUTING_RULES``"""
+
+    ACTIONS = {value for value, _ in AuditLog.ACTION_CHOICES}
+    SEVERITIES = {value for value, _ in AuditLog.SEVERITY_CHOICES}
+
+    def __init__(self, url_name=None, namespace=None, methods=None, status=None, log=True,
+                 action=None, resource=None, severity=None, sample_rate=1.0):
+        self.url_name = compile_pattern(url_name)
+        self.namespace = compile_pattern(namespace)
+        self.methods = {method.upper() for method in methods} if methods is not None else None
+        self.status = parse_status(status) if status is not None else None
+        self.log = bool(log)
+        if action is not None and action not in self.ACTIONS:
+            raise ValueError(f'unknown action {action!r}')
+        if severity is not None and severity not in self.SEVERITIES:
+            raise ValueError(f'unknown severity {severity!r}')
+        if not 0 <= sample_rate <= 1:
+            raise ValueError('sample_rate must be between 0 and 1')
+        self.action = action
+        self.resource = resource
+        self.severity = severity
+        self.sample_rate = float(sample_rate)
+
+    def matches_route(self, namespace, url_name, method):
+        if self.methods is not None and method not in self.methods:
+            return False
+        if self.url_name is not None and (url_name is None or not self.url_name(url_name)):
+            return False
+        if self.namespace is not None and (namespace is None or not self.namespace(namespace)):
+            return False
+        return True
+
+    def matches_status(self, status_code):
+        if self.status is None:
+            return True
+        for low, high in self.status:
+            if low <= status_code <= high:
+                return True
+        return False
+
+    def get_action(self, method):
+        return self.action or METHOD_ACTIONS.get(method)
+
+
+class AuditRouter:
+    def __init__(self, rules):
+        self.rules = []
+        for index, rule in enumerate(rules):
+            unknown = set(rule) - RULE_KEYS
+            if unknown:
+                raise ImproperlyConfigured(
+                    f'AUDIT_ROUTING_RULES[{index}] has unknown keys: {", ".join(sorted(unknown))}'
+                )
+            try:
+                self.rules.append(AuditRule(**rule))
+            except (TypeError, ValueError) as e:
+                raise ImproperlyConfigured(f'AUDIT_ROUTING_RULES[{index}]: {e}')
+        self._routes = {}
+
+    def get_candidates(self, namespace, url_name, method):
+        key = (namespace, url_name, method)
+        candidates = self._routes.get(key)
+        if candidates is None:
+            if len(self._routes) >= MAX_CACHED_ROUTES:
+                self._routes = {}
+            candidates = self._routes[key] = [
+                rule for rule in self.rules if rule.matches_route(namespace, url_name, method)
+            ]
+        return candidates
+
+    def match(self, request, response):
+        """The first rule matching the request and response, or ``None``"""
+        match = request.resolver_match
+        if match is None:
+            candidates = self.get_candidates(None, None, request.method)
+        else:
+            candidates = self.get_candidates(match.namespace, match.url_name, request.method)
+        status_code = response.status_code
+        for rule in candidates:
+            if rule.matches_status(status_code):
+                return rule
+        return None
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_audit_router():
+    """Return the router compiled from ``AUDIT_ROUTING_RULES``"""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = AuditRouter(getattr(settings, 'AUDIT_ROUTING_RULES', []))
+    return _router
+
+
+def reset_audit_router(**kwargs):
+    global _router
+    if kwargs.get('setting', 'AUDIT_ROUTING_RULES') == 'AUDIT_ROUTING_RULES':
+        _router = None
+
+
+setting_changed.connect(reset_audit_router)
@@ -0,0 +1,266 @@
+"""
+Windowed detection rules evaluated on the stream of written audit logs.
+
+``AUDIT_DETECTION_RULES`` is a list of dicts, each with
+
+- ``name``: identifies the rule in alerts and in the logs it writes
+- ``action``, ``resource``, ``severity``: the events it looks at, as a
+  value or a list of values (any event when left out)
+- ``group_by``: what events are counted per, e.g. ``'ip_address'``,
+  ``'user'``, ``'username'`` or ``'details.<key>'``
+- ``distinct``: optionally a field whose distinct values are counted
+  instead of events, e.g. the IPs a user logs in from
+- ``window``, ``threshold``: fire once the count over the last ``window``
+  seconds reaches ``threshold``
+- ``cooldown``: then stay quiet for that group this many seconds
+  (``window`` by default)
+- ``description``: shown in alert emails
+
+Writers hand every batch they store to ``detect``, so a batch costs one
+pass over its events in memory and one counter store round-trip per kind
+of aggregate, however many rules there are, and no database queries. A
+rule that fires queues ``report_detection``, which raises an alert and
+records a CRITICAL log with resource ``'Security'``; those logs are not
+evaluated again.
+
+Windows are measured from when the events are written, which is at most
+the writer's flush interval after they happened. Event counts use the
+sliding-window counters of ``logs.counters``; distinct counts keep the
+values seen per group over the window.
+"""
+import logging
+import threading
+import time
+from operator import attrgetter
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+
+from . import metrics
+from .counters import get_counter_store
+from .models import AuditLog
+
+logger = logging.getLogger(__name__)
+
+RULE_KEYS = {
+    'name', 'description', 'action', 'resource', 'severity',
+    'group_by', 'distinct', 'window', 'threshold', 'cooldown',
+}
+
+# Fields rules can group by or count, besides details.<key>
+FIELDS = {
+    'user': 'user_id',
+    'username': 'actor_username',
+    'ip_address': 'ip_address',
+    'ip_network': 'ip_network',
+    'ip_country': 'ip_country',
+    'resource': 'resource',
+    'resource_id': 'resource_id',
+    'session_id': 'session_id',
+    'user_agent': 'user_agent',
+}
+
+# Resource of the logs written when a rule fires
+DETECTION_RESOURCE = 'Security'
+
+
+def describe_window(seconds):
+    """Human readable window length, e.g. '1 minute' or '90 seconds'"""
+    if seconds % 3600 == 0:
+        value, unit = seconds // 3600, 'hour'
+    elif seconds % 60 == 0:
+        value, unit = seconds // 60, 'minute'
+    else:
+        value, unit = seconds, 'second'
+    return f"{value} {unit}{'' if value == 1 else 's'}"
+
+
+def compile_field(name):
+    """A function reading the field ``name`` from an ``AuditLog``"""
+    if name.startswith('details.'):
+        key = name[len('details.'):]
+        return lambda entry: (entry.details or {}).get(key)
+    if name not in FIELDS:
+        raise ValueError(f'unknown field {name!r}')
+    return attrgetter(FIELDS[name])
+
+
+def compile_values(value):
+    if value is None:
+        return None
+    return {value} if isinstance(value, str) else set(value)
+
+
+class DetectionRule:
+    """One compiled entry of ``AUDIT_DETECTION_RULES``"""
+
+    ACTIONS = {value for value, _ in AuditLog.ACTION_CHOICES}
+    SEVERITIES = {value for value, _ in AuditLog.SEVERITY_CHOICES}
+
+    def __init__(self, name, group_by, threshold, window=60, cooldown=None, action=None,
+                 resource=None, severity=None, distinct=None, description=None):
+        self.name = name
+        self.description = description or name
+        self.actions = compile_values(action)
+        self.resources = compile_values(resource)
+        self.severities = compile_values(severity)
+        if self.actions is not None and self.actions - self.ACTIONS:
+            raise ValueError(f'unknown action {", ".join(sorted(self.actions - self.ACTIONS))}')
+        if self.severities is not None and self.severities - self.SEVERITIES:
+            raise ValueError(f'unknown severity {", ".join(sorted(self.severities - self.SEVERITIES))}')
+        if threshold <= 0 or window <= 0:
+            raise ValueError('threshold and window must be positive')
+        self.group_by = group_by
+        self.get_group = compile_field(group_by)
+        self.distinct = distinct
+        self.get_distinct = compile_field(distinct) if distinct else None
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown if cooldown is not None else window
+
+        if distinct:
+            self.measure = f'distinct {distinct} values'
+        elif self.actions is not None and len(self.actions) == 1:
+            self.measure = f'{next(iter(self.actions))} events'
+        else:
+            self.measure = 'events'
+
+    def matches(self, entry):
+        if self.resources is not None and entry.resource not in self.resources:
+            return False
+        if self.severities is not None and entry.severity not in self.severities:
+            return False
+        return True
+
+    def counter_key(self, group):
+        return f'detect:{self.name}:{group}'
+
+
+class DetectionEngine:
+    def __init__(self, rules):
+        self.rules = []
+        for index, rule in enumerate(rules):
+            unknown = set(rule) - RULE_KEYS
+            if unknown:
+                raise ImproperlyConfigured(
+                    f'AUDIT_DETECTION_RULES[{index}] has unknown keys: {", ".join(sorted(unknown))}'
+                )
+            try:
+                self.rules.append(DetectionRule(**rule))
+            except (TypeError, ValueError) as e:
+                raise ImproperlyConfigured(f'AUDIT_DETECTION_RULES[{index}]: {e}')
+        # The rules each action is checked against
+        self.by_action = {
+            action: [rule for rule in self.rules if rule.actions is None or action in rule.actions]
+            for action in DetectionRule.ACTIONS
+        }
+
+    def evaluate(self, entries, now=None):
+        """
+        Add ``entries`` to the windows of the rules they match and return
+        an alert dict for every rule and group that reached its threshold
+        """
+        if not self.rules:
+            return []
+        now = time.time() if now is None else now
+
+        # Aggregate the batch first: one update per rule and group
+        groups = {}
+        for entry in entries:
+            if entry.resource == DETECTION_RESOURCE:
+                continue
+            for rule in self.by_action.get(entry.action, ()):
+                if not rule.matches(entry):
+                    continue
+                group = rule.get_group(entry)
+                if group is None or group == '':
+                    continue
+                group = str(group)
+                state = groups.get((rule, group))
+                if state is None:
+                    state = groups[(rule, group)] = [0, set(), entry]
+                state[0] += 1
+                state[2] = entry
+                if rule.get_distinct is not None:
+                    value = rule.get_distinct(entry)
+                    if value is not None and value != '':
+                        state[1].add(str(value))
+        if not groups:
+            return []
+
+        store = get_counter_store()
+        counted = [(key, state) for key, state in groups.items() if key[0].distinct is None]
+        distinct = [(key, state) for key, state in groups.items() if key[0].distinct and state[1]]
+        totals = store.hit_many(
+            [(rule.counter_key(group), rule.window, state[0]) for (rule, group), state in counted],
+            now=now,
+        ) if counted else []
+        totals += store.add_members_many(
+            [(rule.counter_key(group), state[1], rule.window) for (rule, group), state in distinct],
+            now=now,
+        ) if distinct else []
+
+        triggered = []
+        for ((rule, group), state), total in zip(counted + distinct, totals):
+            if total < rule.threshold:
+                continue
+            if not store.add_once(f'{rule.counter_key(group)}:alerted', rule.cooldown):
+                continue
+            entry = state[2]
+            metrics.DETECTIONS.inc(1, rule.name)
+            triggered.append({
+                'rule': rule.name,
+                'description': rule.description,
+                'group': f'{rule.group_by}:{group}',
+                'count': int(round(total)),
+                'measure': rule.measure,
+                'timeframe': describe_window(rule.window),
+                'action': entry.action,
+                'ip_address': entry.ip_address,
+                'username': entry.actor_username or (entry.details or {}).get('attempted_username'),
+            })
+        return triggered
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_detection_engine():
+    """Return the engine compiled from ``AUDIT_DETECTION_RULES``"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = DetectionEngine(getattr(settings, 'AUDIT_DETECTION_RULES', []))
+    return _engine
+
+
+def reset_detection_engine(**kwargs):
+    global _engine
+    if kwargs.get('setting', 'AUDIT_DETECTION_RULES') == 'AUDIT_DETECTION_RULES':
+        _engine = None
+
+
+setting_changed.connect(reset_detection_engine)
+
+
+def detect(entries):
+    """Evaluate the detection rules on stored ``entries`` and report what fired"""
+    from .tasks import report_detection
+
+    started = time.perf_counter()
+    try:
+        triggered = get_detection_engine().evaluate(entries)
+    except Exception:
+        # Detection must never break writing audit logs (or authentication).
+        logger.exception('Detection rules unavailable for %d audit log(s)', len(entries))
+        return
+    finally:
+        metrics.DETECTION_SECONDS.observe(time.perf_counter() - started)
+    for alert in triggered:
+        try:
+            report_detection.delay(**alert)
+        except Exception:
+            logger.exception('Failed to queue detection %s for %s', alert['rule'], alert['group'])
@@ -1,32 +1,71 @@
+import ipaddress
+import time
+from datetime import datetime
+from django.utils import timezone
 from rest_framework import serializers
-from .models import AuditLog
+from rest_framework.reverse import reverse
+from . import metrics
+from .models import AuditLog, AuditLogExport
 
-class AuditLogSerializer(serializers.ModelSerializer):
-    username = serializers.CharField(source='user.username', read_only=True)
-    user_email = serializers.CharField(source='user.email', read_only=True)
+class TimedDataMixin:
+    """Adds the time spent producing ``data`` to the request's metrics"""
+    
+    @property
+    def data(self):
+        started = time.perf_counter()
+        try:
+            return super().data
+        finally:
+            stats = metrics.request_stats()
+            if stats is not None:
+                stats.serialize_seconds += time.perf_counter() - started
+
+class TimedListSerializer(TimedDataMixin, serializers.ListSerializer):
+    pass
+
+class AuditLogSerializer(TimedDataMixin, serializers.ModelSerializer):
+    username = serializers.CharField(source='actor_username', read_only=True)
+    user_email = serializers.CharField(source='actor_email', read_only=True)
+    user_is_staff = serializers.BooleanField(source='actor_is_staff', read_only=True)
+    # Resolved from the UserAgent row, which the viewset selects with the log
+    user_agent = serializers.CharField(read_only=True)
+    browser = serializers.CharField(source='agent.browser', read_only=True, default=None)
+    os = serializers.CharField(source='agent.os', read_only=True, default=None)
+    device = serializers.CharField(source='agent.device', read_only=True, default=None)
     
     class Meta:
         model = AuditLog
         fields = [
-            'id', 'username', 'user_email', 'action', 'resource', 
-            'resource_id', 'ip_address', 'timestamp', 'severity', 
-            'details', 'session_id'
+            'id', 'username', 'user_email', 'user_is_staff', 'action', 'resource', 
+            'resource_id', 'ip_address', 'ip_network', 'ip_network_name',
+            'ip_country', 'ip_blocklisted', 'user_agent', 'browser', 'os', 'device',
+            'timestamp', 'severity', 'details', 'session_id'
         ]
-        read_only_fields = ['id', 'timestamp']
+        read_only_fields = [
+            'id', 'timestamp', 'ip_network', 'ip_network_name', 'ip_country', 'ip_blocklisted'
+        ]
+        list_serializer_class = TimedListSerializer
 
-class AuditLogCreateSerializer(serializers.ModelSerializer):
+class AuditLogCreateSerializer(TimedDataMixin, serializers.ModelSerializer):
     class Meta:
         model = AuditLog
         fields = ['action', 'resource', 'resource_id', 'details']
     
     def create(self, validated_data):
+        return AuditLog.log_action(**self.get_log_kwargs(validated_data))
+    
+    async def asave(self):
+        """``save()`` for async views, handing the entry to the writer without blocking"""
+        self.instance = await AuditLog.alog_action(**self.get_log_kwargs(dict(self.validated_data)))
+        return self.instance
+    
+    def get_log_kwargs(self, validated_data):
         request = self.context['request']
         validated_data['user'] = request.user
         validated_data['ip_address'] = self.get_client_ip(request)
         validated_data['user_agent'] = request.META.get('HTTP_USER_AGENT', '')
         validated_data['session_id'] = request.session.session_key
-        
-        return AuditLog.log_action(**validated_data)
+        return validated_data
     
     def get_client_ip(self, request):
         x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
@@ -34,4 +73,107 @@ class AuditLogCreateSerializer(serializers.ModelSerializer):
             ip = x_forwarded_for.split(',')[0]
         else:
             ip = request.META.get('REMOTE_ADDR')
-        return ip
\ No newline at end of file
+        return ip
+
+class AuditLogBulkItemSerializer(serializers.Serializer):
+    """
+    One event of a bulk upload.
+    
+    Validation is hand-written rather than built from serializer fields:
+    per-field validators would cost more than inserting the row. Staff may
+    also set the fields in ``PROVENANCE_FIELDS`` to forward events that
+    happened elsewhere.
+    """
+    PROVENANCE_FIELDS = (
+        'timestamp', 'ip_address', 'user_agent', 'severity', 'session_id',
+        'username', 'user_email',
+    )
+    ACTIONS = {value for value, _ in AuditLog.ACTION_CHOICES}
+    SEVERITIES = {value for value, _ in AuditLog.SEVERITY_CHOICES}
+    MAX_LENGTHS = {
+        'resource': 100,
+        'resource_id': 50,
+        'session_id': 40,
+        'username': 150,
+        'user_email': 254,
+    }
+    
+    def to_internal_value(self, data):
+        if not isinstance(data, dict):
+            raise serializers.ValidationError({'non_field_errors': ['Expected a JSON object']})
+        
+        errors = {}
+        values = {}
+        allow_provenance = self.context.get('allow_provenance', False)
+        
+        for field in ('action', 'resource'):
+            if not data.get(field):
+                errors[field] = ['This field is required.']
+        if data.get('action') and data['action'] not in self.ACTIONS:
+            errors['action'] = [f'"{data["action"]}" is not a valid choice.']
+        if data.get('severity') is not None and data['severity'] not in self.SEVERITIES:
+            errors['severity'] = [f'"{data["severity"]}" is not a valid choice.']
+        if data.get('details') is not None and not isinstance(data['details'], dict):
+            errors['details'] = ['Expected a JSON object']
+        
+        for field, value in data.items():
+            if value is None:
+                continue
+            if field in self.PROVENANCE_FIELDS and not allow_provenance:
+                errors[field] = ['Only staff users can set this field.']
+                continue
+            if field in ('resource', 'resource_id', 'session_id', 'username', 'user_email', 'user_agent'):
+                if isinstance(value, int) and not isinstance(value, bool) and field == 'resource_id':
+                    value = str(value)
+                if not isinstance(value, str):
+                    errors[field] = ['Not a valid string.']
+                    continue
+                if len(value) > self.MAX_LENGTHS.get(field, len(value)):
+                    errors[field] = [f'Ensure this field has no more than {self.MAX_LENGTHS[field]} characters.']
+                    continue
+            elif field == 'ip_address':
+                try:
+                    value = ipaddress.ip_address(value).compressed
+                except ValueError:
+                    errors[field] = ['Enter a valid IPv4 or IPv6 address.']
+                    continue
+            elif field == 'timestamp':
+                try:
+                    value = datetime.fromisoformat(value)
+                except (TypeError, ValueError):
+                    errors[field] = ['Datetime has wrong format. Use ISO 8601.']
+                    continue
+                if timezone.is_naive(value):
+                    value = timezone.make_aware(value)
+            elif field not in ('action', 'severity', 'details'):
+                continue  # unknown fields are ignored, as elsewhere in the API
+            values[field] = value
+        
+        if errors:
+            raise serializers.ValidationError(errors)
+        return values
+
+class AuditLogExportSerializer(serializers.ModelSerializer):
+    progress = serializers.SerializerMethodField()
+    download_url = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = AuditLogExport
+        fields = [
+            'id', 'status', 'export_format', 'compress', 'filters', 'descending',
+            'shards', 'shards_done', 'progress', 'rows', 'size', 'error',
+            'created_at', 'started_at', 'completed_at', 'download_url',
+        ]
+        read_only_fields = fields
+    
+    def get_progress(self, obj):
+        """Share of the shards written, 0 to 1"""
+        return round(obj.shards_done / obj.shards, 4) if obj.shards else 0
+    
+    def get_download_url(self, obj):
+        if obj.status != 'completed':
+            return None
+        return reverse(
+            'auditlog-export-job-download', kwargs={'job_id': obj.pk},
+            request=self.context.get('request')
+        )
@@ -1,10 +1,13 @@
 from django.contrib.auth.signals import user_logged_in, user_logged_out, user_login_failed
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
+from . import live, metrics, security
+from .alerts import invalidate_alert_recipients
 from .models import AuditLog
-from .tasks import check_failed_login_attempts
 
 @receiver(user_logged_in)
+@metrics.SIGNAL_SECONDS.timed('user_logged_in')
 def log_user_login(sender, request, user, **kwargs):
     """Log successful user login"""
     AuditLog.log_action(
@@ -19,6 +22,7 @@ def log_user_login(sender, request, user, **kwargs):
     )
 
 @receiver(user_logged_out)
+@metrics.SIGNAL_SECONDS.timed('user_logged_out')
 def log_user_logout(sender, request, user, **kwargs):
     """Log user logout"""
     if user:
@@ -33,8 +37,9 @@ def log_user_logout(sender, request, user, **kwargs):
         )
 
 @receiver(user_login_failed)
+@metrics.SIGNAL_SECONDS.timed('user_login_failed')
 def log_failed_login(sender, credentials, request, **kwargs):
-    """Log failed login attempts and trigger alert check"""
+    """Log failed login attempts; the detection rules pick them up once written"""
     username = credentials.get('username', 'Unknown')
     ip_address = get_client_ip(request)
     
@@ -57,9 +62,24 @@ def log_failed_login(sender, credentials, request, **kwargs):
             'reason': 'Invalid credentials'
         }
     )
-    
-    # Trigger async task to check for multiple failed attempts
-    check_failed_login_attempts.delay(ip_address, username)
+
+@receiver(post_save, sender=AuditLog)
+def publish_audit_log(sender, instance, created, **kwargs):
+    """
+    Send logs saved one at a time to the live tail and the detection rules
+    (bulk writes do both themselves)
+    """
+    if created:
+        live.publish([instance])
+        security.detect([instance])
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def refresh_alert_recipients(sender, instance, update_fields=None, **kwargs):
+    """Drop the cached alert recipients when staff users may have changed"""
+    if update_fields and not {'is_staff', 'is_active', 'email'} & set(update_fields):
+        return
+    invalidate_alert_recipients()
 
 def get_client_ip(request):
     """Helper function to get client IP address"""
@@ -0,0 +1,613 @@
+"""
+Incrementally maintained sketches of the audit logs.
+
+``update_sketches`` folds newly written audit logs into per-hour and per-day
+sketches of
+
+- the distinct IP addresses and users, overall and of the IP addresses of
+  each user (HyperLogLog)
+- the most frequent IP addresses, users, resources and user agents
+  (Space-Saving)
+
+A sketch takes bounded memory however many values it has seen, and
+sketches merge, so any range is answered by merging the buckets covering
+it (plus the logs written since the last run) without reading the older
+rows of ``audit_logs``.
+
+Values are hashed by PostgreSQL (``hashtextextended``) while folding, so
+the fold and the tail of recent logs produce identical registers.
+"""
+import heapq
+import json
+import math
+import struct
+import zlib
+from functools import reduce
+from operator import or_
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import connection, transaction
+from django.db.models import Count, Max, Q
+from django.db.models.functions import Trunc
+
+from .models import AuditLog, AuditLogSketch, AuditLogWatermark
+from .rollups import DAY, HOUR, _floor, bucket_filter, is_supported, retention
+
+WATERMARK = 'sketches'
+
+GRANULARITIES = [('day', DAY), ('hour', HOUR)]
+
+# Fields with distinct count sketches, and the SQL hashing each value.
+# Per-user sketches only exist for the IP address.
+DISTINCT_FIELDS = {
+    'ip_address': 'hashtextextended(host(ip_address), 0)',
+    'user': 'hashtextextended(user_id::text, 0)',
+}
+
+PRECISION = 14
+REGISTERS = 1 << PRECISION
+# Hash bits left after the register index; a register stores the position
+# of the first 1 among them, or one more when they are all 0.
+RANK_BITS = 64 - PRECISION
+
+# Relative standard error of an estimate
+STANDARD_ERROR = 1.04 / math.sqrt(REGISTERS)
+
+# Register index and rank of a 64-bit hash, in SQL
+_REGISTER_SQL = f"""
+({{hash}} & {REGISTERS - 1})::integer,
+COALESCE(NULLIF(position(B'1' IN ({{hash}} >> {PRECISION})::bit({RANK_BITS})), 0), {RANK_BITS + 1})
+"""
+
+# Registers of a range of ids, per hour, for every sketch the logs belong to
+_FOLD_SQL = f"""
+WITH hashed AS (
+    SELECT date_trunc('hour', "timestamp") AS bucket, user_id,
+           {DISTINCT_FIELDS['ip_address']} AS ip_hash,
+           {DISTINCT_FIELDS['user']} AS user_hash
+      FROM audit_logs
+     WHERE id > %s AND id <= %s
+), hashes AS (
+    SELECT bucket, 'ip_address' AS field, NULL::integer AS user_id, ip_hash AS hash FROM hashed
+    UNION ALL
+    SELECT bucket, 'ip_address', user_id, ip_hash FROM hashed WHERE user_id IS NOT NULL
+    UNION ALL
+    SELECT bucket, 'user', NULL, user_hash FROM hashed WHERE user_id IS NOT NULL
+)
+SELECT bucket, field, user_id, register, max(rank)
+  FROM (SELECT bucket, field, user_id, {_REGISTER_SQL.format(hash='hash')} FROM hashes) AS r (bucket, field, user_id, register, rank)
+ GROUP BY 1, 2, 3, 4
+"""
+
+# Fields with top value sketches, and the SQL reading each value from
+# ``_TOP_FROM``
+TOP_FIELDS = {
+    'ip_address': 'host(l.ip_address)',
+    'user': 'l.user_id::text',
+    'resource': 'l.resource',
+    'user_agent': "NULLIF(a.user_agent, '')",
+}
+
+# User agent strings are stored once in audit_user_agents
+_TOP_FROM = 'audit_logs l LEFT JOIN audit_user_agents a ON a.id = l.agent_id'
+
+# Counters per top value sketch
+TOP_CAPACITY = 512
+
+# Exact counts per hour and value of a range of ids
+_TOP_FOLD_SQL = f"""
+WITH logs AS (
+    SELECT date_trunc('hour', l."timestamp") AS bucket,
+           {', '.join(f'{expression} AS "{field}"' for field, expression in TOP_FIELDS.items())}
+      FROM {_TOP_FROM}
+     WHERE l.id > %s AND l.id <= %s
+)
+""" + '\nUNION ALL\n'.join(
+    f'SELECT bucket, \'{field}\', "{field}", count(*) FROM logs WHERE "{field}" IS NOT NULL GROUP BY 1, 3'
+    for field in TOP_FIELDS
+)
+
+_SPARSE = b'\x01'
+_DENSE = b'\x02'
+_SPARSE_ENTRY = struct.Struct('>HB')
+
+# The top bit of every byte, for merging dense registers as one integer
+_HIGH_BITS = int.from_bytes(b'\x80' * REGISTERS, 'big')
+
+
+def _max_registers(left, right):
+    """
+    Bytewise maximum of two register arrays. Ranks are below 128, so with
+    each byte of ``left`` offset by 128 a subtraction never borrows across
+    bytes and leaves the top bit set exactly where ``left >= right``.
+    """
+    x = int.from_bytes(left, 'big')
+    y = int.from_bytes(right, 'big')
+    keep = (((x | _HIGH_BITS) - y) & _HIGH_BITS) >> 7
+    keep *= 0xFF
+    return bytearray(((x & keep) | (y & ~keep)).to_bytes(REGISTERS, 'big'))
+
+
+def _sigma(x):
+    if x == 1:
+        return math.inf
+    y = 1.0
+    z = x
+    while True:
+        x *= x
+        previous = z
+        z += x * y
+        y += y
+        if z == previous:
+            return z
+
+
+def _tau(x):
+    if x == 0 or x == 1:
+        return 0.0
+    y = 1.0
+    z = 1 - x
+    while True:
+        x = math.sqrt(x)
+        previous = z
+        y *= 0.5
+        z -= (1 - x) ** 2 * y
+        if z == previous:
+            return z / 3
+
+
+class HyperLogLog:
+    """
+    HyperLogLog sketch with 2**14 registers, fed register updates computed
+    by the database (see ``_REGISTER_SQL``).
+
+    Estimates use Ertl's improved estimator, which stays unbiased from a
+    handful of values to billions without empirical correction tables; the
+    relative standard error is 1.04 / sqrt(2**14), about 0.8%. Sketches with
+    few registers set are kept and stored sparse (3 bytes per register),
+    the others as 16 KiB of compressed registers.
+    """
+
+    # Past this many set registers a dict costs more memory than the array
+    SPARSE_LIMIT = REGISTERS // 64
+
+    __slots__ = ('registers',)
+
+    def __init__(self):
+        self.registers = {}
+
+    def update(self, pairs):
+        """Apply ``(register, rank)`` pairs"""
+        registers = self.registers
+        if isinstance(registers, dict):
+            for index, rank in pairs:
+                if rank > registers.get(index, 0):
+                    registers[index] = rank
+            if len(registers) > self.SPARSE_LIMIT:
+                self._densify()
+        else:
+            for index, rank in pairs:
+                if rank > registers[index]:
+                    registers[index] = rank
+
+    def merge(self, other):
+        if isinstance(other.registers, dict):
+            self.update(other.registers.items())
+        elif isinstance(self.registers, dict):
+            registers = self.registers
+            self.registers = bytearray(other.registers)
+            self.update(registers.items())
+        else:
+            self.registers = _max_registers(self.registers, other.registers)
+
+    def _densify(self):
+        dense = bytearray(REGISTERS)
+        for index, rank in self.registers.items():
+            dense[index] = rank
+        self.registers = dense
+
+    def histogram(self):
+        """Number of registers holding each rank, zero included"""
+        counts = [0] * (RANK_BITS + 2)
+        if isinstance(self.registers, dict):
+            counts[0] = REGISTERS - len(self.registers)
+            for rank in self.registers.values():
+                counts[rank] += 1
+        else:
+            for rank in range(RANK_BITS + 2):
+                counts[rank] = self.registers.count(rank)
+        return counts
+
+    def count(self):
+        """Estimated number of distinct values"""
+        counts = self.histogram()
+        if counts[0] == REGISTERS:
+            return 0
+        z = REGISTERS * _tau(1 - counts[RANK_BITS + 1] / REGISTERS)
+        for rank in range(RANK_BITS, 0, -1):
+            z = 0.5 * (z + counts[rank])
+        z += REGISTERS * _sigma(counts[0] / REGISTERS)
+        return round(REGISTERS * REGISTERS / (2 * math.log(2)) / z)
+
+    def to_bytes(self):
+        registers = self.registers
+        if isinstance(registers, dict):
+            items = sorted(registers.items())
+        else:
+            dense = _DENSE + zlib.compress(registers)
+            if (REGISTERS - registers.count(0)) * _SPARSE_ENTRY.size >= len(dense):
+                return dense
+            items = [(index, rank) for index, rank in enumerate(registers) if rank]
+        return _SPARSE + b''.join(_SPARSE_ENTRY.pack(index, rank) for index, rank in items)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        sketch = cls()
+        if data[:1] == _DENSE:
+            sketch.registers = bytearray(zlib.decompress(data[1:]))
+        else:
+            sketch.update(_SPARSE_ENTRY.iter_unpack(data[1:]))
+        return sketch
+
+
+class SpaceSaving:
+    """
+    Space-Saving summary of the most frequent values, with at most
+    ``TOP_CAPACITY`` counters.
+
+    It is kept in the equivalent Misra-Gries form (a Space-Saving counter
+    is the Misra-Gries count plus the total decrement), which merges with
+    the same guarantee as a single pass: counts are added, and when more
+    than ``capacity`` values remain the (capacity + 1)-th largest count is
+    subtracted from all of them and the values left at zero dropped. For
+    ``N`` logs summarized, every value's true count lies in
+    ``[count, count + error]`` with ``error <= N / (capacity + 1)``, and any
+    value seen more than ``error`` times has a counter. ``error`` is 0, and
+    the counts exact, while there are no more values than counters.
+    """
+
+    __slots__ = ('counts', 'error', 'capacity')
+
+    def __init__(self, capacity=TOP_CAPACITY):
+        self.counts = {}
+        self.error = 0
+        self.capacity = capacity
+
+    def update(self, counts):
+        """Add exact ``(value, count)`` pairs"""
+        totals = self.counts
+        for value, count in counts:
+            totals[value] = totals.get(value, 0) + count
+        self._reduce()
+
+    def merge(self, other):
+        self.error += other.error
+        self.update(other.counts.items())
+
+    def _reduce(self):
+        if len(self.counts) <= self.capacity:
+            return
+        threshold = heapq.nlargest(self.capacity + 1, self.counts.values())[-1]
+        self.counts = {
+            value: count - threshold
+            for value, count in self.counts.items() if count > threshold
+        }
+        self.error += threshold
+
+    def top(self, limit):
+        """The ``limit`` largest ``(value, count)`` pairs"""
+        return heapq.nlargest(limit, self.counts.items(), key=lambda item: item[1])
+
+    def to_bytes(self):
+        return zlib.compress(json.dumps([self.error, sorted(self.counts.items())]).encode())
+
+    @classmethod
+    def from_bytes(cls, data):
+        sketch = cls()
+        sketch.error, counts = json.loads(zlib.decompress(bytes(data)))
+        sketch.counts = dict(counts)
+        return sketch
+
+
+def metric_name(field):
+    return f'distinct_{field}'
+
+
+def top_metric_name(field):
+    return f'top_{field}'
+
+
+def update_sketches(batch_size=100000):
+    """
+    Fold audit logs written since the last run into the sketches, the same
+    way ``logs.rollups.update_rollups`` folds them into the rollups.
+    Returns the number of ids covered.
+    """
+    if not is_supported():
+        return 0
+
+    watermark, _ = AuditLogWatermark.objects.get_or_create(name=WATERMARK)
+    target = watermark.pending_id
+    processed = 0
+
+    while True:
+        with transaction.atomic():
+            watermark = AuditLogWatermark.objects.select_for_update().get(name=WATERMARK)
+            if watermark.last_id >= target:
+                break
+            upper = min(watermark.last_id + batch_size, target)
+            _fold(watermark.last_id, upper)
+            _fold_top(watermark.last_id, upper)
+            processed += upper - watermark.last_id
+            watermark.last_id = upper
+            watermark.save(update_fields=['last_id', 'updated_at'])
+
+    with transaction.atomic():
+        watermark = AuditLogWatermark.objects.select_for_update().get(name=WATERMARK)
+        latest = AuditLog.objects.aggregate(latest=Max('id'))['latest'] or 0
+        watermark.pending_id = max(latest, watermark.pending_id)
+        watermark.save(update_fields=['pending_id', 'updated_at'])
+
+    now = datetime.now(dt_timezone.utc)
+    AuditLogSketch.objects.filter(granularity='hour', bucket__lt=now - retention()['hour']).delete()
+
+    return processed
+
+
+def _fold(after_id, last_id):
+    updates = {}
+    with connection.cursor() as cursor:
+        cursor.execute(_FOLD_SQL, [after_id, last_id])
+        for bucket, field, user_id, index, rank in cursor.fetchall():
+            day = _floor(bucket, DAY)
+            for key in (('hour', bucket, field, user_id), ('day', day, field, user_id)):
+                updates.setdefault(key, []).append((index, rank))
+
+    # Load the stored sketches being updated, one query per bucket
+    users = {}
+    for granularity, bucket, _, user_id in updates:
+        users.setdefault((granularity, bucket), set()).add(user_id)
+    sketches = {}
+    for (granularity, bucket), user_ids in users.items():
+        stored = AuditLogSketch.objects.filter(
+            Q(user__isnull=True) | Q(user_id__in=user_ids - {None}),
+            granularity=granularity, bucket=bucket,
+            metric__in=[metric_name(field) for field in DISTINCT_FIELDS],
+        ).values_list('metric', 'user_id', 'data')
+        for metric, user_id, data in stored:
+            key = (granularity, bucket, metric[len('distinct_'):], user_id)
+            if key in updates:
+                sketches[key] = HyperLogLog.from_bytes(data)
+
+    rows = []
+    for key, pairs in updates.items():
+        sketch = sketches.get(key) or HyperLogLog()
+        sketch.update(pairs)
+        granularity, bucket, field, user_id = key
+        rows.append(AuditLogSketch(
+            granularity=granularity, bucket=bucket, metric=metric_name(field),
+            user_id=user_id, data=sketch.to_bytes(),
+        ))
+    AuditLogSketch.objects.bulk_create(
+        rows, batch_size=1000, update_conflicts=True,
+        unique_fields=['granularity', 'bucket', 'metric', 'user'], update_fields=['data'],
+    )
+
+
+def _fold_top(after_id, last_id):
+    counts = {}
+    with connection.cursor() as cursor:
+        cursor.execute(_TOP_FOLD_SQL, [after_id, last_id])
+        for bucket, field, value, count in cursor.fetchall():
+            day = _floor(bucket, DAY)
+            for key in (('hour', bucket, field), ('day', day, field)):
+                values = counts.setdefault(key, {})
+                values[value] = values.get(value, 0) + count
+    if not counts:
+        return
+
+    buckets = {(granularity, bucket) for granularity, bucket, _ in counts}
+    stored = AuditLogSketch.objects.filter(
+        reduce(or_, (Q(granularity=granularity, bucket=bucket) for granularity, bucket in buckets)),
+        metric__in=[top_metric_name(field) for field in TOP_FIELDS], user__isnull=True,
+    ).values_list('granularity', 'bucket', 'metric', 'data')
+    sketches = {
+        (granularity, bucket, metric[len('top_'):]): SpaceSaving.from_bytes(data)
+        for granularity, bucket, metric, data in stored
+    }
+
+    rows = []
+    for key, values in counts.items():
+        sketch = sketches.get(key) or SpaceSaving()
+        sketch.update(values.items())
+        granularity, bucket, field = key
+        rows.append(AuditLogSketch(
+            granularity=granularity, bucket=bucket, metric=top_metric_name(field),
+            data=sketch.to_bytes(),
+        ))
+    AuditLogSketch.objects.bulk_create(
+        rows, batch_size=1000, update_conflicts=True,
+        unique_fields=['granularity', 'bucket', 'metric', 'user'], update_fields=['data'],
+    )
+
+
+def _tail_registers(field, start, end, user, group_by=None):
+    """
+    Registers of the logs written after the last run, as ``(register, rank)``
+    pairs, or ``{bucket: pairs}`` when grouped by ``'hour'`` or ``'day'``
+    """
+    watermark = AuditLogWatermark.objects.filter(name=WATERMARK).first()
+    conditions = ['id > %s']
+    params = [watermark.last_id if watermark else 0]
+    if field == 'user':
+        conditions.append('user_id IS NOT NULL')
+    if user is not None:
+        conditions.append('user_id = %s')
+        params.append(user)
+    if start is not None:
+        conditions.append('"timestamp" >= %s')
+        params.append(start)
+    if end is not None:
+        conditions.append('"timestamp" < %s')
+        params.append(end)
+
+    bucket = f"date_trunc('{group_by}', \"timestamp\")" if group_by else 'NULL::timestamptz'
+    sql = f"""
+        SELECT bucket, register, max(rank)
+          FROM (SELECT {bucket}, {_REGISTER_SQL.format(hash=DISTINCT_FIELDS[field])}
+                  FROM audit_logs WHERE {' AND '.join(conditions)}) AS r (bucket, register, rank)
+         GROUP BY 1, 2
+    """
+    grouped = {}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        for row_bucket, index, rank in cursor.fetchall():
+            grouped.setdefault(row_bucket, []).append((index, rank))
+    if group_by:
+        return grouped
+    return grouped.get(None, [])
+
+
+def _check(field, user):
+    if field not in DISTINCT_FIELDS:
+        raise ValueError(f'field must be one of {", ".join(DISTINCT_FIELDS)}')
+    if user is not None and field != 'ip_address':
+        raise ValueError('Per-user counts are only kept for ip_address')
+
+
+def _exact(field, start, end, user):
+    queryset = AuditLog.objects.all()
+    if user is not None:
+        queryset = queryset.filter(user_id=user)
+    if start is not None:
+        queryset = queryset.filter(timestamp__gte=start)
+    if end is not None:
+        queryset = queryset.filter(timestamp__lt=end)
+    return queryset.order_by()
+
+
+def distinct_count(field, start=None, end=None, user=None):
+    """
+    Estimated number of distinct ``field`` values (``'ip_address'`` or
+    ``'user'``) among the logs in ``[start, end)``, optionally only those of
+    ``user`` (an id). Bounds are widened to the hour, and to the day once
+    the hourly sketches have been pruned.
+    """
+    _check(field, user)
+    if not is_supported():
+        return _exact(field, start, end, user).aggregate(count=Count(field, distinct=True))['count']
+
+    sketch = HyperLogLog()
+    stored = AuditLogSketch.objects.filter(
+        bucket_filter(start, end, GRANULARITIES), metric=metric_name(field), user_id=user
+    ).values_list('data', flat=True)
+    for data in stored:
+        sketch.merge(HyperLogLog.from_bytes(data))
+    sketch.update(_tail_registers(field, start, end, user))
+    return sketch.count()
+
+
+def distinct_series(field, start, end, granularity='hour', user=None):
+    """
+    Estimated distinct ``field`` values per hour or day bucket of
+    ``[start, end)``, as a list of ``{'bucket', 'count'}`` points
+    """
+    _check(field, user)
+    size = dict(GRANULARITIES)[granularity]
+    first = _floor(start.astimezone(dt_timezone.utc), size)
+    buckets = {}
+    bucket = first
+    while bucket < end:
+        buckets[bucket] = HyperLogLog()
+        bucket += size
+
+    if not is_supported():
+        counts = (
+            _exact(field, first, end, user)
+            .annotate(bucket=Trunc('timestamp', granularity, tzinfo=dt_timezone.utc))
+            .values_list('bucket')
+            .annotate(count=Count(field, distinct=True))
+        )
+        exact = dict(counts)
+        return [{'bucket': bucket, 'count': exact.get(bucket, 0)} for bucket in buckets]
+
+    stored = AuditLogSketch.objects.filter(
+        granularity=granularity, bucket__gte=first, bucket__lt=end,
+        metric=metric_name(field), user_id=user,
+    ).values_list('bucket', 'data')
+    for bucket, data in stored:
+        if bucket in buckets:
+            buckets[bucket].merge(HyperLogLog.from_bytes(data))
+    for bucket, pairs in _tail_registers(field, first, end, user, group_by=granularity).items():
+        if bucket in buckets:
+            buckets[bucket].update(pairs)
+    return [{'bucket': bucket, 'count': sketch.count()} for bucket, sketch in buckets.items()]
+
+
+def _check_top(field):
+    if field not in TOP_FIELDS:
+        raise ValueError(f'field must be one of {", ".join(TOP_FIELDS)}')
+
+
+def field_value(field, value):
+    """A value as stored in a top value sketch, converted back to the field's type"""
+    return int(value) if field == 'user' else value
+
+
+def heavy_hitters(field, start=None, end=None):
+    """
+    Space-Saving summary of the ``field`` values (``'ip_address'``,
+    ``'user'``, ``'resource'`` or ``'user_agent'``) of the logs in
+    ``[start, end)``, with bounds widened like ``distinct_count``. Logs
+    written since the last run are counted exactly and added.
+    """
+    _check_top(field)
+    summary = SpaceSaving()
+    if not is_supported():
+        lookup = 'agent__user_agent' if field == 'user_agent' else field
+        counts = (
+            _exact(field, start, end, None).exclude(**{f'{lookup}__isnull': True})
+            .values_list(lookup).annotate(count=Count('id'))
+        )
+        summary.update((str(value), count) for value, count in counts if value != '')
+        return summary
+
+    stored = AuditLogSketch.objects.filter(
+        bucket_filter(start, end, GRANULARITIES), metric=top_metric_name(field), user__isnull=True,
+    ).values_list('data', flat=True)
+    # Summing every bucket before reducing once loses less than merging pairwise
+    summary.capacity = math.inf
+    for data in stored:
+        summary.merge(SpaceSaving.from_bytes(data))
+
+    watermark = AuditLogWatermark.objects.filter(name=WATERMARK).first()
+    expression = TOP_FIELDS[field]
+    conditions = ['l.id > %s', f'{expression} IS NOT NULL']
+    params = [watermark.last_id if watermark else 0]
+    if start is not None:
+        conditions.append('l."timestamp" >= %s')
+        params.append(start)
+    if end is not None:
+        conditions.append('l."timestamp" < %s')
+        params.append(end)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT {expression}, count(*) FROM {_TOP_FROM} WHERE {" AND ".join(conditions)} GROUP BY 1',
+            params,
+        )
+        summary.update(cursor.fetchall())
+    return summary
+
+
+def top_values(field, limit, start=None, end=None):
+    """
+    Most frequent ``field`` values in ``[start, end)``, like
+    ``logs.rollups.top_values``. Counts are lower bounds, short of the true
+    count by at most the summary's error (see ``SpaceSaving``).
+    """
+    summary = heavy_hitters(field, start, end)
+    return [
+        {field: field_value(field, value), 'count': count}
+        for value, count in summary.top(limit)
+    ]
@@ -0,0 +1,158 @@
+"""
+Synthetic audit logs for benchmarks.
+
+Activity is skewed the way real audit trails are: user and IP popularity
+follow a Zipf distribution (a few accounts and addresses produce most of
+the rows), reads far outnumber writes, and most failed logins come from a
+small set of hostile addresses. Rows are produced in timestamp
+order so ids grow with time, as they do in production. A fixed ``seed``
+makes every run produce the same data.
+"""
+import itertools
+import random
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .models import AuditLog
+
+ACTION_WEIGHTS = {
+    'VIEW': 55,
+    'UPDATE': 15,
+    'CREATE': 12,
+    'LOGIN': 8,
+    'LOGOUT': 5,
+    'FAILED_LOGIN': 3,
+    'DELETE': 1.5,
+    'EXPORT': 0.5,
+}
+
+RESOURCE_WEIGHTS = {
+    'Order': 30,
+    'Product': 20,
+    'Customer': 15,
+    'Invoice': 10,
+    'Report': 8,
+    'Setting': 5,
+    'Document': 7,
+    'Payment': 5,
+}
+
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 14_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Safari/605.1.15',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148',
+    'python-requests/2.31.0',
+    'curl/8.5.0',
+]
+
+METHODS = {'CREATE': 'POST', 'UPDATE': 'PATCH', 'DELETE': 'DELETE', 'VIEW': 'GET'}
+
+STATUS_WEIGHTS = {200: 70, 201: 10, 204: 5, 400: 6, 403: 3, 404: 5, 500: 1}
+
+# Share of failed logins coming from the hostile address pool
+ATTACK_SHARE = 0.7
+
+
+def zipf_weights(count, exponent=1.1):
+    """Cumulative weights of a Zipf distribution over ``count`` ranks"""
+    return list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, count + 1)))
+
+
+class SyntheticLogGenerator:
+    """
+    Builds unsaved ``AuditLog`` instances for ``users`` (a list of ``User``).
+
+    Timestamps are spread evenly over the ``days`` before ``end``, with
+    jitter, in the order the rows are generated.
+    """
+
+    def __init__(self, users, total, days=90, ip_pool=50000, attacker_pool=200,
+                 seed=0, end=None):
+        self.random = random.Random(seed)
+        self.users = users
+        self.total = total
+        self.end = end or timezone.now()
+        self.start = self.end - timedelta(days=days)
+        self.step = (self.end - self.start).total_seconds() / max(total, 1)
+
+        self.user_weights = zipf_weights(len(users))
+        self.ips = [self._random_ip() for _ in range(ip_pool)]
+        self.ip_weights = zipf_weights(ip_pool)
+        self.attacker_ips = [self._random_ip() for _ in range(attacker_pool)]
+        self.actions = list(ACTION_WEIGHTS)
+        self.action_weights = list(itertools.accumulate(ACTION_WEIGHTS.values()))
+        self.resources = list(RESOURCE_WEIGHTS)
+        self.resource_weights = list(itertools.accumulate(RESOURCE_WEIGHTS.values()))
+        self.agent_weights = zipf_weights(len(USER_AGENTS), exponent=1.5)
+        self.statuses = list(STATUS_WEIGHTS)
+        self.status_weights = list(itertools.accumulate(STATUS_WEIGHTS.values()))
+
+    def _random_ip(self):
+        return '.'.join(str(self.random.randint(1, 254)) for _ in range(4))
+
+    def _pick(self, population, cum_weights):
+        return self.random.choices(population, cum_weights=cum_weights)[0]
+
+    def __iter__(self):
+        for index in range(self.total):
+            yield self.build(index)
+
+    def batches(self, size):
+        batch = []
+        for entry in self:
+            batch.append(entry)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def build(self, index):
+        rand = self.random
+        action = self._pick(self.actions, self.action_weights)
+        user = self._pick(self.users, self.user_weights)
+        timestamp = self.start + timedelta(seconds=(index + rand.random()) * self.step)
+        ip_address = self._pick(self.ips, self.ip_weights)
+        resource = self._pick(self.resources, self.resource_weights)
+        resource_id = str(rand.randint(1, 100000))
+        severity = AuditLog.DEFAULT_SEVERITIES.get(action, 'LOW')
+
+        if action == 'FAILED_LOGIN':
+            if rand.random() < ATTACK_SHARE:
+                ip_address = rand.choice(self.attacker_ips)
+                attempted = rand.choice([user.username, 'admin', 'root', 'test'])
+            else:
+                attempted = user.username
+            details = {'attempted_username': attempted, 'reason': 'invalid_credentials'}
+            resource, resource_id = 'User', attempted
+            user = None
+        elif action in ('LOGIN', 'LOGOUT'):
+            details = {'login_method': rand.choice(['api', 'web'])} if action == 'LOGIN' else {}
+            resource, resource_id = 'User', str(user.id)
+        elif action == 'EXPORT':
+            details = {'exported_count': rand.randint(1, 50000), 'format': rand.choice(['csv', 'ndjson'])}
+            resource, resource_id = 'AuditLog', None
+        else:
+            path = f'/api/{resource.lower()}s/{resource_id}/'
+            status_code = self._pick(self.statuses, self.status_weights)
+            details = {'method': METHODS[action], 'path': path, 'status_code': status_code}
+            if status_code >= 500:
+                severity = 'CRITICAL'
+
+        return AuditLog(
+            user=user,
+            actor_username=user.username if user else None,
+            actor_email=user.email if user else None,
+            actor_is_staff=user.is_staff if user else False,
+            action=action,
+            resource=resource,
+            resource_id=resource_id,
+            ip_address=ip_address,
+            user_agent=self._pick(USER_AGENTS, self.agent_weights),
+            timestamp=timestamp,
+            severity=severity,
+            details=details,
+            session_id=f'{rand.getrandbits(128):032x}' if user else None,
+        )
@@ -1,14 +1,17 @@
 from datetime import timedelta
-from django.utils import timezone
-from django.core.mail import send_mail
 from django.conf import settings
+from django.utils import timezone
 from celery import shared_task
 from .models import AuditLog
+from . import alerts, chain, export_jobs, partitions, rollups, security, sketches
 
 @shared_task
 def check_failed_login_attempts(ip_address, username):
     """
     Check for multiple failed login attempts and send email alert
+
+    Kept for callers that still queue it; the audit writers now run the
+    AUDIT_DETECTION_RULES on every batch they store (see logs.security).
     """
     # Check last 1 minute for failed attempts from same IP
     one_minute_ago = timezone.now() - timedelta(minutes=1)
@@ -17,7 +20,7 @@ def check_failed_login_attempts(ip_address, username):
         action='FAILED_LOGIN',
         ip_address=ip_address,
         timestamp__gte=one_minute_ago
-    ).count()
+    ).exclude(resource=security.DETECTION_RESOURCE).count()
     
     if failed_attempts >= 5:
         send_security_alert.delay(
@@ -30,7 +33,7 @@ def check_failed_login_attempts(ip_address, username):
         # Also log this security event
         AuditLog.objects.create(
             action='FAILED_LOGIN',
-            resource='Security',
+            resource=security.DETECTION_RESOURCE,
             ip_address=ip_address,
             severity='CRITICAL',
             details={
@@ -42,46 +45,66 @@ def check_failed_login_attempts(ip_address, username):
         )
 
 @shared_task
-def send_security_alert(ip_address, username, attempts, timeframe):
+def report_detection(rule, description, group, count, measure, timeframe, action,
+                     ip_address, username):
     """
-    Send email alert for security incidents
+    Alert on and record a detection rule firing (see logs.security)
     """
-    subject = f'Security Alert: Multiple Failed Login Attempts'
-    
-    message = f"""
-    Security Alert - Audit Trail System
-    
-    Multiple failed login attempts detected:
+    alerts.dispatch_alert(
+        group,
+        {
+            'rule': rule,
+            'description': description,
+            'count': count,
+            'measure': measure,
+            'timeframe': timeframe,
+            'ip_address': ip_address,
+            'username': username,
+        }
+    )
     
-    IP Address: {ip_address}
-    Username: {username}
-    Attempts: {attempts} failed logins
-    Timeframe: {timeframe}
-    Time: {timezone.now().isoformat()}
-    
-    Please investigate this activity immediately.
-    
-    This is an automated security alert from the Audit Trail System.
+    # Also log this security event
+    AuditLog.objects.create(
+        action=action,
+        resource=security.DETECTION_RESOURCE,
+        ip_address=ip_address,
+        severity='CRITICAL',
+        details={
+            'alert_type': description,
+            'rule': rule,
+            'group': group,
+            'count': count,
+            'timeframe': timeframe,
+            'username': username
+        }
+    )
+
+@shared_task
+def send_security_alert(ip_address, username, attempts, timeframe):
+    """
+    Send email alert for security incidents; the alert joins the digest
+    of its IP address
+    """
+    alerts.dispatch_alert(
+        ip_address,
+        {
+            'description': 'Multiple failed login attempts',
+            'count': attempts,
+            'measure': 'failed logins',
+            'timeframe': timeframe,
+            'ip_address': ip_address,
+            'username': username,
+        }
+    )
+
+@shared_task
+def send_security_alert_digest(group):
+    """
+    Send one email for all alerts queued for a group during the digest window
     """
-    
     try:
-        # Send to all admin users
-        from django.contrib.auth.models import User
-        admin_emails = list(
-            User.objects.filter(is_staff=True, email__isnull=False)
-            .exclude(email='')
-            .values_list('email', flat=True)
-        )
-        
-        if admin_emails:
-            send_mail(
-                subject=subject,
-                message=message,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=admin_emails,
-                fail_silently=False,
-            )
-            
+        count, recipients = alerts.send_digest(group)
+        if count and recipients:
             # Log the alert sending
             AuditLog.objects.create(
                 action='CREATE',
@@ -90,8 +113,9 @@ def send_security_alert(ip_address, username, attempts, timeframe):
                 severity='MEDIUM',
                 details={
                     'alert_sent': True,
-                    'recipients': len(admin_emails),
-                    'reason': f'{attempts} failed logins from {ip_address}'
+                    'recipients': recipients,
+                    'alerts': count,
+                    'reason': f'{count} security alert(s) for {group}'
                 }
             )
     except Exception as e:
@@ -104,6 +128,53 @@ def send_security_alert(ip_address, username, attempts, timeframe):
             details={
                 'alert_sent': False,
                 'error': str(e),
-                'reason': f'{attempts} failed logins from {ip_address}'
+                'reason': f'Security alert digest for {group}'
             }
-        )
\ No newline at end of file
+        )
+
+@shared_task
+def maintain_audit_partitions():
+    """
+    Create upcoming monthly partitions and drop those past retention
+    """
+    if not partitions.is_supported():
+        return
+    
+    partitions.create_partitions(settings.AUDIT_LOG_PARTITIONS_AHEAD)
+    if settings.AUDIT_LOG_RETENTION_MONTHS > 0:
+        partitions.drop_expired_partitions(settings.AUDIT_LOG_RETENTION_MONTHS)
+
+@shared_task
+def update_audit_rollups():
+    """
+    Fold newly written audit logs into the statistics rollup tables
+    """
+    return rollups.update_rollups()
+
+@shared_task
+def seal_audit_chain():
+    """
+    Seal newly written audit logs into hash chain checkpoints
+    """
+    return len(chain.seal_chain())
+
+@shared_task
+def update_audit_sketches():
+    """
+    Fold newly written audit logs into the distinct count and top value sketches
+    """
+    return sketches.update_sketches()
+
+@shared_task
+def export_audit_log_shard(job_id, index):
+    """
+    Write one shard of a background export (see logs.export_jobs)
+    """
+    export_jobs.run_shard(job_id, index)
+
+@shared_task
+def expire_audit_log_exports():
+    """
+    Delete background exports past their retention, with their files
+    """
+    return export_jobs.expire_jobs()
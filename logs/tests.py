@@ -1,3 +1,2124 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import importlib
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from urllib.parse import urlencode
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.core.management import call_command
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, connection
+from django.db.models import Count
+from django.http import Http404, HttpResponse
+from django.test import AsyncClient, AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import resolve
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .benchmarks import LOCAL_SETTINGS
+from . import (
+    alerts, benchmarks, chain, enrichment, export_jobs, importer, live, metrics, partitions, rollups,
+    sketches, tasks,
+)
+from .counters import LocalCounterStore, reset_counter_store
+from .importer import AuditLogImporter
+from .middleware import AuditMiddleware
+from .models import (
+    AuditChainCheckpoint, AuditLog, AuditLogExport, AuditLogImport, AuditLogRollup, AuditLogSketch,
+)
+from .pagination import AuditLogPagination, KeysetPagination
+from .routing import AuditRouter, get_audit_router, parse_status
+from .security import DetectionEngine, describe_window, detect
+from .synthetic import SyntheticLogGenerator
+from .views import AsyncAuditLogView, metrics_view
+from .writers import BufferedAuditWriter, store_entries
+
+# Settings every test runs with: no Redis, SMTP or throttling, and logs
+# written on the calling thread
+TEST_SETTINGS = dict(
+    LOCAL_SETTINGS,
+    AUDIT_LOG_WRITER={'BACKEND': 'logs.writers.SyncAuditWriter'},
+    REST_FRAMEWORK=dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_CLASSES=[]),
+)
+
+# Server-side cursors (``.iterator()``) are logged as their DECLARE statement
+_DECLARE_RE = re.compile(r'^DECLARE .*? CURSOR .*?FOR (?=SELECT )', re.DOTALL)
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def explain(sql):
+    """
+    The JSON plan of ``sql`` with sequential scans disabled: the planner then
+    only falls back to one when no index can serve the query at all, so the
+    check does not depend on how many rows the test tables hold.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SET enable_seqscan = off')
+        try:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}')
+            plan = cursor.fetchone()[0]
+        finally:
+            cursor.execute('RESET enable_seqscan')
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+def seq_scans(sql):
+    """Audit log tables (partitions included) the query reads sequentially"""
+    return sorted({
+        node['Relation Name'] for node in plan_nodes(explain(sql))
+        if node['Node Type'] == 'Seq Scan' and node['Relation Name'].startswith('audit_log')
+    })
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Query plans are checked on PostgreSQL')
+@override_settings(**TEST_SETTINGS)
+class QueryPlanTests(TestCase):
+    """
+    Runs every query shape of ``AuditLogViewSet`` and fails when one of its
+    queries has no index to use on ``audit_logs`` or the rollup tables.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('plans-staff', 'staff@example.com', is_staff=True)
+        cls.user = User.objects.create_user('plans-user', 'user@example.com')
+        cls.log = AuditLog.objects.create(
+            user=cls.user, action='FAILED_LOGIN', resource='User', resource_id='42',
+            ip_address='10.0.0.1', session_id='plans-session', severity='HIGH',
+            details={'method': 'POST', 'path': '/api/auth/login/', 'status_code': 401},
+        )
+        # The first run only notes the latest id, the second seals up to it
+        chain.seal_chain()
+        chain.seal_chain()
+        cls.job = AuditLogExport.objects.create(user=cls.staff, ip_address='10.0.0.1', export_format='csv')
+
+    def shapes(self):
+        now = timezone.now()
+        day_ago = (now - timedelta(days=1)).isoformat()
+        week_ago = (now - timedelta(days=7)).isoformat()
+        cursor = KeysetPagination.encode_values([now.isoformat(), self.log.pk], reverse=False)
+        detail = f'/api/logs/{self.log.pk}/'
+
+        yield 'list', self.staff, '/api/logs/', {}
+        yield 'list.page', self.staff, '/api/logs/', {'page': 1}
+        yield 'list.cursor', self.staff, '/api/logs/', {'cursor': cursor}
+        yield 'list.ascending', self.staff, '/api/logs/', {'ordering': 'timestamp', 'pagination': 'cursor'}
+        yield 'list.own', self.user, '/api/logs/', {}
+        yield 'list.own.cursor', self.user, '/api/logs/', {'cursor': cursor}
+        yield 'filter.action', self.staff, '/api/logs/', {'action': 'DELETE', 'pagination': 'cursor'}
+        yield 'filter.failed_login', self.staff, '/api/logs/', {'action': 'FAILED_LOGIN'}
+        yield 'filter.severity', self.staff, '/api/logs/', {'severity': 'CRITICAL'}
+        yield 'filter.resource_id', self.staff, '/api/logs/', {'resource': 'User', 'resource_id': '42'}
+        yield 'filter.session', self.staff, '/api/logs/', {'session_id': 'plans-session'}
+        yield 'filter.ip_network', self.staff, '/api/logs/', {'ip_network': 'vpn'}
+        yield 'filter.ip_country', self.staff, '/api/logs/', {'ip_country': 'DE', 'pagination': 'cursor'}
+        yield 'filter.ip_blocklisted', self.staff, '/api/logs/', {'ip_blocklisted': 'true'}
+        yield 'filter.date_range', self.staff, '/api/logs/', {'start_date': week_ago, 'end_date': day_ago}
+        yield 'filter.details', self.staff, '/api/logs/', {'details.status_code__gte': 500}
+        yield 'filter.details_prefix', self.staff, '/api/logs/', {'details.path__startswith': '/api/auth'}
+        yield 'filter.details_contains', self.staff, '/api/logs/', {'details.method': 'DELETE'}
+        yield 'search.identifier', self.staff, '/api/logs/', {'q': 'plans-user'}
+        yield 'search.fulltext', self.staff, '/api/logs/', {'q': 'firefox'}
+        yield 'retrieve', self.staff, detail, {}
+        yield 'proof', self.staff, f'{detail}proof/', {}
+        yield 'export', self.staff, '/api/logs/export/', {'start_date': day_ago}
+        yield 'export_jobs', self.staff, '/api/logs/export-jobs/', {}
+        yield 'export_job', self.staff, f'/api/logs/export-jobs/{self.job.pk}/', {}
+        yield 'statistics', self.staff, '/api/logs/statistics/', {}
+        yield 'statistics.range', self.staff, '/api/logs/statistics/', {'start_date': week_ago}
+        yield 'statistics.details', self.staff, '/api/logs/statistics/', {'details.method': 'POST'}
+        yield 'timeseries', self.staff, '/api/logs/timeseries/', {'group_by': 'action'}
+        yield 'distinct', self.staff, '/api/logs/distinct/', {'interval': 'hour'}
+        yield 'distinct.user', self.staff, '/api/logs/distinct/', {'user': self.user.pk}
+        yield 'top', self.staff, '/api/logs/top/', {'field': 'user_agent', 'start_date': week_ago}
+
+    def test_no_sequential_scans(self):
+        for name, user, path, params in self.shapes():
+            with self.subTest(name):
+                client = APIClient()
+                client.force_authenticate(user)
+                with CaptureQueriesContext(connection) as captured:
+                    response = client.get(path, params)
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                self.assertLess(response.status_code, 400, name)
+
+                checked = 0
+                for query in captured.captured_queries:
+                    sql = _DECLARE_RE.sub('', query['sql'])
+                    if not sql.startswith('SELECT') or 'audit_log' not in sql:
+                        continue
+                    checked += 1
+                    self.assertEqual(seq_scans(sql), [], f'{name}: {sql}')
+                self.assertTrue(checked, f'{name} ran no audit log query')
+
+
+def close_response(response):
+    """Close a response as the server would, keeping the test's database connection"""
+    with mock.patch.object(connection, 'close_if_unusable_or_obsolete'):
+        response.close()
+
+
+def make_log(**kwargs):
+    """An unsaved audit log"""
+    kwargs.setdefault('action', 'CREATE')
+    kwargs.setdefault('resource', 'Order')
+    kwargs.setdefault('ip_address', '10.0.0.1')
+    return AuditLog.build(None, **kwargs)
+
+
+class BufferedAuditWriterTests(SimpleTestCase):
+    """Batching and the overflow policies, with the database left out"""
+
+    def setUp(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+        def store(entries):
+            self.release.wait(5)
+            self.batches.append(len(entries))
+
+        for target in ('store_entries', 'dispatch_entries'):
+            patcher = mock.patch(f'logs.writers.{target}', side_effect=store if target == 'store_entries' else None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def writer(self, **options):
+        writer = BufferedAuditWriter(**options)
+        self.addCleanup(writer.close)
+        self.addCleanup(self.release.set)
+        return writer
+
+    def test_batches_by_size_and_on_flush(self):
+        writer = self.writer(batch_size=3, flush_interval=60)
+        for _ in range(7):
+            writer.submit(make_log())
+        writer.flush(timeout=5)
+        self.assertEqual(self.batches, [3, 3, 1])
+        self.assertEqual(writer.stats()['written'], 7)
+
+    def test_writes_after_flush_interval(self):
+        writer = self.writer(batch_size=100, flush_interval=0.05)
+        writer.submit(make_log())
+        for _ in range(100):
+            if self.batches:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.batches, [1])
+
+    def blocked_writer(self, **options):
+        """A writer whose thread is stuck writing one entry, with a full queue of one"""
+        self.release.clear()
+        writer = self.writer(batch_size=1, max_queue_size=1, **options)
+        writer.submit(make_log())
+        while not writer._queue.empty():
+            time.sleep(0.01)
+        writer.submit(make_log())
+        return writer
+
+    def test_drop_policy_discards_when_full(self):
+        writer = self.blocked_writer(overflow_policy='drop')
+        writer.submit(make_log())
+        self.assertEqual(writer.stats()['dropped'], 1)
+
+    def test_block_policy_gives_up_after_timeout(self):
+        writer = self.blocked_writer(overflow_policy='block', block_timeout=0.05)
+        writer.submit(make_log())
+        self.assertEqual(writer.stats()['dropped'], 1)
+        self.release.set()
+        writer.flush(timeout=5)
+        self.assertEqual(writer.stats()['written'], 2)
+
+    def test_block_timeout_is_finite_by_default(self):
+        self.assertIsNotNone(BufferedAuditWriter().block_timeout)
+
+    def test_restarts_a_dead_thread(self):
+        writer = self.writer(batch_size=1)
+        writer.submit(make_log())
+        writer.flush(timeout=5)
+        writer._queue.put(None)  # ends the thread as close() would
+        writer._thread.join(5)
+        writer.submit(make_log())
+        writer.flush(timeout=5)
+        self.assertEqual(self.batches, [1, 1])
+
+
+@override_settings(**TEST_SETTINGS)
+class WriteBatchTests(TestCase):
+    """The row-by-row fallback of ``_write_batch`` only runs when the insert failed"""
+
+    def setUp(self):
+        # The fallback drops broken connections, which would end the test transaction
+        patcher = mock.patch.object(connection, 'close_if_unusable_or_obsolete')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.writer = BufferedAuditWriter()
+        self.addCleanup(self.writer.close)
+
+    def test_dispatch_failure_does_not_retry_stored_rows(self):
+        batch = [make_log(resource_id=str(number)) for number in range(3)]
+        with mock.patch('logs.live.get_live_broker', side_effect=RuntimeError('broker down')), \
+                mock.patch('logs.security.get_detection_engine', side_effect=RuntimeError('rules down')), \
+                self.assertLogs('logs', 'ERROR'):
+            self.writer._write_batch(batch)
+        self.assertEqual(AuditLog.objects.filter(resource='Order').count(), 3)
+        self.assertEqual(self.writer.stats()['written'], 3)
+        self.assertEqual(self.writer.stats()['failed'], 0)
+
+    def test_failed_insert_falls_back_to_rows(self):
+        batch = [make_log(resource_id=str(number)) for number in range(3)]
+        with mock.patch.object(AuditLog.objects, 'bulk_create', side_effect=RuntimeError('insert failed')), \
+                self.assertLogs('logs.writers', 'ERROR'):
+            self.writer._write_batch(batch)
+        self.assertEqual(AuditLog.objects.filter(resource='Order').count(), 3)
+        self.assertEqual(self.writer.stats()['written'], 3)
+
+
+@override_settings(**TEST_SETTINGS)
+class ExportTests(TestCase):
+    """Streaming exports, and their EXPORT log however the stream ends"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('export-staff', is_staff=True)
+        for number in range(5):
+            make_log(resource_id=str(number), details={'number': number}).save()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def export_log(self):
+        return AuditLog.objects.get(action='EXPORT')
+
+    def test_csv(self):
+        response = self.client.get('/api/logs/export/', {'resource': 'Order'})
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0][:2], ['ID', 'Username'])
+        self.assertEqual(sorted(row[5] for row in rows[1:]), ['0', '1', '2', '3', '4'])
+        self.assertEqual(self.export_log().details['exported_count'], 5)
+        self.assertTrue(self.export_log().details['completed'])
+
+    def test_gzip_ndjson(self):
+        response = self.client.get('/api/logs/export/', {'export_format': 'ndjson', 'compress': 'gzip'})
+        lines = gzip.decompress(b''.join(response.streaming_content)).splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(json.loads(lines[0])['resource'], 'Order')
+
+    @mock.patch('logs.exporters.CHUNK_BYTES', 1)
+    def test_aborted_download_is_logged(self):
+        response = self.client.get('/api/logs/export/')
+        next(iter(response.streaming_content))
+        close_response(response)
+        details = self.export_log().details
+        self.assertFalse(details['completed'])
+        self.assertLess(details['exported_count'], 5)
+
+    def test_unread_download_is_logged(self):
+        close_response(self.client.get('/api/logs/export/'))
+        details = self.export_log().details
+        self.assertEqual((details['exported_count'], details['completed']), (0, False))
+
+    def test_staff_only(self):
+        self.client.force_authenticate(User.objects.create_user('export-user'))
+        self.assertEqual(self.client.get('/api/logs/export/').status_code, 403)
+
+
+@override_settings(**TEST_SETTINGS)
+@mock.patch.object(AuditLogPagination, 'page_size', 3)
+class KeysetPaginationTests(TestCase):
+    """Cursor pages cover every log once, in order, across timestamp ties"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('pages-staff', is_staff=True)
+        now = timezone.now()
+        for number in range(8):
+            # Half of the logs share a timestamp, so the id breaks the ties
+            timestamp = now if number % 2 else now - timedelta(minutes=number)
+            make_log(resource='Page', resource_id=str(number), timestamp=timestamp).save()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def walk(self, url, params, link):
+        ids = []
+        pages = 0
+        while url:
+            data = self.client.get(url, params).json()
+            page = [result['id'] for result in data['results']]
+            # Pages come in display order whichever way we walk
+            ids = ids + page if link == 'next' else page + ids
+            url, params = data[link], None
+            pages += 1
+            self.assertLessEqual(pages, 10)
+        return ids, pages
+
+    def expected(self, *ordering):
+        return list(AuditLog.objects.filter(resource='Page').order_by(*ordering).values_list('id', flat=True))
+
+    def test_forward_and_back(self):
+        ids, pages = self.walk('/api/logs/', {'resource': 'Page', 'pagination': 'cursor'}, 'next')
+        self.assertEqual(ids, self.expected('-timestamp', '-id'))
+        self.assertEqual(pages, 3)
+
+        last_page = self.client.get('/api/logs/', {
+            'resource': 'Page',
+            'cursor': KeysetPagination.encode_values([
+                AuditLog.objects.get(pk=ids[-1]).timestamp.isoformat(), ids[-1]
+            ], reverse=True),
+        }).json()
+        self.assertEqual([result['id'] for result in last_page['results']], ids[-4:-1])
+        backwards, _ = self.walk(last_page['previous'], None, 'previous')
+        self.assertEqual(backwards, ids[:-4])
+
+    def test_ascending(self):
+        ids, _ = self.walk('/api/logs/', {'resource': 'Page', 'pagination': 'cursor', 'ordering': 'timestamp'}, 'next')
+        self.assertEqual(ids, self.expected('timestamp', 'id'))
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/logs/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Partitioning needs PostgreSQL')
+@override_settings(**TEST_SETTINGS)
+class PartitionTests(TestCase):
+
+    def partition_of(self, log):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT tableoid::regclass::text FROM audit_logs WHERE id = %s', [log.id])
+            return cursor.fetchone()[0]
+
+    def test_create_moves_default_rows(self):
+        now = timezone.now()
+        month = partitions.add_months(partitions.month_start(now), 6)
+        log = make_log(resource='Future', timestamp=month + timedelta(days=10))
+        log.save()
+        self.assertEqual(self.partition_of(log), 'audit_logs_default')
+
+        created = partitions.create_partitions(months_ahead=6, now=now)
+
+        self.assertIn(partitions.partition_name(month), created)
+        self.assertEqual(self.partition_of(log), partitions.partition_name(month))
+        self.assertEqual(AuditLog.objects.filter(resource='Future').count(), 1)
+
+    def test_drop_forgets_derived_data(self):
+        with connection.cursor() as cursor:
+            bounded = [upper for _, _, upper in partitions.list_partitions(cursor) if upper is not None]
+        boundary = min(bounded)
+        old = make_log(resource='Retention', timestamp=boundary - timedelta(days=40))
+        old.save()
+        new = make_log(resource='Retention', timestamp=boundary + timedelta(days=1))
+        new.save()
+        for log in (old, new):
+            AuditLogRollup.objects.create(
+                granularity='day', bucket=log.timestamp, action='CREATE',
+                severity='LOW', resource='Retention', count=1
+            )
+        chain.seal_chain(max_size=1)
+        chain.seal_chain(max_size=1)
+        first, second = AuditChainCheckpoint.objects.order_by('last_id')
+        with connection.cursor() as cursor:
+            # The test transaction still holds deferred foreign key checks,
+            # which PostgreSQL will not let a dropped table keep pending
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+        dropped = partitions.drop_expired_partitions(1, now=partitions.add_months(boundary, 1))
+
+        self.assertEqual(len(dropped), 1)
+        self.assertEqual(list(AuditLog.objects.filter(resource='Retention')), [new])
+        self.assertEqual(list(AuditLogRollup.objects.values_list('bucket', flat=True)), [new.timestamp])
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertIsNotNone(first.expired_at)
+        self.assertIsNone(second.expired_at)
+        self.assertTrue(chain.verify_range().ok)
+        self.assertIsNotNone(chain.build_proof(new))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Rollups are maintained on PostgreSQL')
+@override_settings(**TEST_SETTINGS)
+class RollupTests(TestCase):
+    """Rollups plus the tail count exactly what a scan of audit_logs counts"""
+
+    ACTIONS = ['CREATE', 'UPDATE', 'DELETE', 'LOGIN_FAILED']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.now = timezone.now().replace(second=0, microsecond=0)
+        for number in range(60):
+            make_log(
+                resource='Rollup', action=cls.ACTIONS[number % 4],
+                timestamp=cls.now - timedelta(minutes=37 * number, seconds=number),
+            ).save()
+        for number in range(6):
+            make_log(resource='Rollup', timestamp=cls.now - timedelta(days=4, hours=number)).save()
+        # The first run only records the newest id, the second folds the logs in
+        rollups.update_rollups()
+        rollups.update_rollups()
+        for number in range(5):
+            make_log(resource='Rollup', action='DELETE', timestamp=cls.now - timedelta(minutes=number)).save()
+
+    def raw(self, start=None, end=None, **filters):
+        queryset = AuditLog.objects.filter(resource='Rollup', **filters)
+        if start is not None:
+            queryset = queryset.filter(timestamp__gte=start)
+        if end is not None:
+            queryset = queryset.filter(timestamp__lt=end)
+        return queryset
+
+    def test_counts(self):
+        self.assertTrue(AuditLogRollup.objects.exists())
+        ranges = [
+            (None, None),
+            (self.now - timedelta(hours=5, minutes=13), self.now),
+            (self.now - timedelta(days=1, minutes=1), self.now - timedelta(hours=2, minutes=7)),
+            (self.now - timedelta(days=5), self.now - timedelta(days=3, hours=22)),
+            (self.now - timedelta(days=5), None),
+        ]
+        for start, end in ranges:
+            for filters in ({}, {'action': 'DELETE'}):
+                with self.subTest(start=start, end=end, **filters):
+                    self.assertEqual(
+                        rollups.count_logs(start, end, resource='Rollup', **filters),
+                        self.raw(start, end, **filters).count(),
+                    )
+
+    def test_top_values(self):
+        start = self.now - timedelta(hours=20)
+        expected = {
+            action: self.raw(start, action=action).count() for action in self.ACTIONS
+        }
+        top = rollups.top_values('action', 4, start, None, resource='Rollup')
+        self.assertEqual({row['action']: row['count'] for row in top}, expected)
+        self.assertEqual([row['count'] for row in top], sorted(expected.values(), reverse=True))
+
+    def test_time_series(self):
+        start = self.now.replace(minute=0) - timedelta(hours=30)
+        end = self.now.replace(minute=0) + timedelta(hours=1)
+        interval, points = rollups.time_series(start, end, '1h', resource='Rollup')
+        self.assertEqual(interval, '1h')
+        self.assertEqual(len(points), 31)
+        for point in points:
+            self.assertEqual(point['count'], self.raw(point['bucket'], point['bucket'] + timedelta(hours=1)).count())
+
+
+@override_settings(**TEST_SETTINGS)
+class DetectionTests(SimpleTestCase):
+    """Failed-login bursts fire once at the threshold, per group and window"""
+
+    RULE = {
+        'name': 'failed-logins-ip', 'action': 'FAILED_LOGIN', 'group_by': 'ip_address',
+        'window': 60, 'threshold': 5, 'cooldown': 300,
+    }
+
+    def setUp(self):
+        self.engine = DetectionEngine([self.RULE])
+        patcher = mock.patch('logs.security.get_counter_store', return_value=LocalCounterStore())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def failures(self, count, ip_address='10.0.0.1'):
+        return [make_log(action='FAILED_LOGIN', resource='User', ip_address=ip_address) for _ in range(count)]
+
+    def test_sliding_window(self):
+        store = LocalCounterStore()
+        self.assertEqual(store.hit('key', 60, 4, now=600), 4)
+        self.assertEqual(store.hit('key', 60, 2, now=630), 6)
+        # Half of the previous bucket still overlaps the window
+        self.assertEqual(store.hit('key', 60, 1, now=690), 4)
+        self.assertEqual(store.hit('key', 60, 1, now=900), 1)
+
+    def test_threshold(self):
+        self.assertEqual(self.engine.evaluate(self.failures(4), now=600), [])
+        alerts = self.engine.evaluate(self.failures(1), now=601)
+        self.assertEqual(len(alerts), 1)
+        self.assertEqual(alerts[0]['group'], 'ip_address:10.0.0.1')
+        self.assertEqual(alerts[0]['count'], 5)
+        self.assertEqual(alerts[0]['timeframe'], '1 minute')
+        # Quiet for the cooldown
+        self.assertEqual(self.engine.evaluate(self.failures(5), now=602), [])
+
+    def test_groups_and_actions(self):
+        entries = self.failures(3) + self.failures(3, '10.0.0.2')
+        entries += [make_log(action='LOGIN', resource='User', ip_address='10.0.0.1') for _ in range(5)]
+        self.assertEqual(self.engine.evaluate(entries, now=600), [])
+
+    def test_window_expires(self):
+        self.assertEqual(self.engine.evaluate(self.failures(4), now=600), [])
+        self.assertEqual(self.engine.evaluate(self.failures(4), now=800), [])
+
+    def test_detect_queues_report(self):
+        with override_settings(AUDIT_DETECTION_RULES=[self.RULE]), \
+                mock.patch('logs.tasks.report_detection.delay') as delay:
+            detect(self.failures(5, '10.0.0.3'))
+        delay.assert_called_once()
+        self.assertEqual(delay.call_args.kwargs['ip_address'], '10.0.0.3')
+
+    def test_store_errors_are_logged(self):
+        with override_settings(AUDIT_DETECTION_RULES=[self.RULE]), \
+                mock.patch('logs.security.get_counter_store', side_effect=ConnectionError), \
+                self.assertLogs('logs.security', 'ERROR'):
+            detect(self.failures(5))
+
+
+@override_settings(**TEST_SETTINGS, AUDIT_ALERT_MAX_DIGESTS_PER_WINDOW=2)
+class AlertDigestTests(TestCase):
+    """Alerts are coalesced per group, with a bounded number of digests"""
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_user('alerts-staff', 'security@example.com', is_staff=True)
+
+    def setUp(self):
+        reset_counter_store()
+        cache.clear()
+        patcher = mock.patch('logs.tasks.send_security_alert_digest.apply_async')
+        self.schedule = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def alert(self, group, count=5):
+        alerts.dispatch_alert(group, {
+            'description': 'Failed logins from one IP', 'count': count, 'measure': 'events',
+            'timeframe': '1 minute', 'ip_address': group, 'username': 'alice',
+        })
+
+    def scheduled(self):
+        return [call.kwargs['args'][0] for call in self.schedule.call_args_list]
+
+    def test_one_digest_per_group(self):
+        for count in range(3):
+            self.alert('10.0.0.1', count)
+        self.assertEqual(self.scheduled(), ['10.0.0.1'])
+
+        tasks.send_security_alert_digest('10.0.0.1')
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['security@example.com'])
+        self.assertIn('3 security alert(s) raised for 10.0.0.1', mail.outbox[0].body)
+        log = AuditLog.objects.get(resource='SecurityAlert')
+        self.assertTrue(log.details['alert_sent'])
+        self.assertEqual(log.details['alerts'], 3)
+        self.assertEqual(alerts.get_alert_stats()['digests_sent'], 1)
+
+    def test_overflow_digest(self):
+        for number in range(5):
+            self.alert(f'10.0.1.{number}')
+        self.assertEqual(self.scheduled(), ['10.0.1.0', '10.0.1.1', alerts.OVERFLOW_GROUP])
+
+        tasks.send_security_alert_digest(alerts.OVERFLOW_GROUP)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('group 10.0.1.4', mail.outbox[0].body)
+
+    def test_legacy_alert_task(self):
+        tasks.send_security_alert('10.0.2.1', 'alice', 7, '1 minute')
+        self.assertEqual(self.scheduled(), ['10.0.2.1'])
+        tasks.send_security_alert_digest('10.0.2.1')
+        self.assertIn('7 failed logins in 1 minute', mail.outbox[0].body)
+
+    @override_settings(AUDIT_DETECTION_RULES=[])
+    def test_legacy_login_check(self):
+        for number in range(4):
+            make_log(action='FAILED_LOGIN', resource='Authentication', ip_address='10.0.3.1').save()
+        make_log(action='FAILED_LOGIN', resource='Authentication', ip_address='10.0.3.2').save()
+        make_log(
+            action='FAILED_LOGIN', resource='Authentication', ip_address='10.0.3.1',
+            timestamp=timezone.now() - timedelta(minutes=2),
+        ).save()
+        with mock.patch('logs.tasks.send_security_alert.delay') as send:
+            tasks.check_failed_login_attempts('10.0.3.1', 'alice')
+            send.assert_not_called()
+            make_log(action='FAILED_LOGIN', resource='Authentication', ip_address='10.0.3.1').save()
+            tasks.check_failed_login_attempts('10.0.3.1', 'alice')
+            send.assert_called_once_with(ip_address='10.0.3.1', username='alice', attempts=5, timeframe='1 minute')
+        log = AuditLog.objects.get(resource='Security')
+        self.assertEqual((log.severity, log.details['attempts']), ('CRITICAL', 5))
+        # The security log itself does not count towards the next check
+        with mock.patch('logs.tasks.send_security_alert.delay') as send:
+            tasks.check_failed_login_attempts('10.0.3.1', 'alice')
+        self.assertEqual(send.call_args.kwargs['attempts'], 5)
+
+
+@override_settings(**TEST_SETTINGS)
+class ActorSnapshotTests(TestCase):
+    """Logs keep who acted without joining auth_user, even once the user is gone"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('snapshot-staff', 'staff@example.com', is_staff=True)
+        cls.actor = User.objects.create_user('snapshot-actor', 'actor@example.com')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def test_snapshot_survives_user_deletion(self):
+        AuditLog.build(self.actor, 'UPDATE', 'Snapshot', '10.0.0.1').save()
+        self.actor.delete()
+
+        with CaptureQueriesContext(connection) as captured:
+            data = self.client.get('/api/logs/', {'resource': 'Snapshot'}).json()
+        self.assertEqual(data['results'][0]['username'], 'snapshot-actor')
+        self.assertEqual(data['results'][0]['user_email'], 'actor@example.com')
+        self.assertFalse(data['results'][0]['user_is_staff'])
+        self.assertFalse(any(
+            'auth_user' in query['sql'] and 'audit_logs' in query['sql'] for query in captured.captured_queries
+        ))
+
+    def test_backfill(self):
+        legacy = AuditLog.objects.create(user=self.staff, action='UPDATE', resource='Snapshot', ip_address='10.0.0.1')
+        AuditLog.objects.filter(pk=legacy.pk).update(actor_username=None, actor_email=None)
+
+        call_command('backfill_actor_snapshot', batch_size=1, stdout=mock.Mock())
+
+        legacy.refresh_from_db()
+        self.assertEqual(
+            (legacy.actor_username, legacy.actor_email, legacy.actor_is_staff),
+            ('snapshot-staff', 'staff@example.com', True),
+        )
+
+
+@override_settings(**TEST_SETTINGS)
+class SearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('search-staff', is_staff=True)
+        cls.invoice = make_log(
+            resource='Invoice', resource_id='INV-2048', actor_username='carol', ip_address='192.0.2.7',
+            details={'note': 'quarterly refund approved'},
+        )
+        cls.invoice.save()
+        cls.order = make_log(
+            resource='Order', resource_id='ORD-1', actor_username='dave',
+            details={'note': 'refund for carol'},
+        )
+        cls.order.save()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def search(self, query, param='q'):
+        data = self.client.get('/api/logs/', {param: query}).json()
+        return [result['id'] for result in data['results']]
+
+    def test_identifiers(self):
+        self.assertEqual(self.search('INV-20'), [self.invoice.id])
+        self.assertEqual(self.search('192.0.2'), [self.invoice.id])
+        self.assertEqual(self.search('dave', param='search'), [self.order.id])
+
+    def test_every_term_matches(self):
+        self.assertEqual(self.search('carol INV'), [self.invoice.id])
+        self.assertEqual(self.search('dave INV'), [])
+
+    def test_full_text(self):
+        self.assertEqual(self.search('quarterly'), [self.invoice.id])
+        self.assertEqual(self.search('refund -quarterly'), [self.order.id])
+
+    def test_identifier_matches_rank_first(self):
+        # Both mention carol, but only the invoice has her as the actor
+        self.assertEqual(self.search('carol'), [self.invoice.id, self.order.id])
+
+    def test_nul_bytes(self):
+        self.assertEqual(self.search('INV\x00-2048'), [self.invoice.id])
+
+
+@override_settings(**TEST_SETTINGS)
+class DetailsFilterTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('details-staff', is_staff=True)
+        cls.logs = {}
+        for name, details in [
+            ('ok', {'status_code': 200, 'method': 'GET', 'path': '/api/orders/1'}),
+            ('missing', {'status_code': '404', 'method': 'PUT', 'path': '/api/users/1'}),
+            ('error', {'status_code': 503, 'method': 'DELETE', 'request': {'method': 'DELETE'}}),
+        ]:
+            log = make_log(resource='Details', details=details)
+            log.save()
+            cls.logs[name] = log.id
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def matching(self, **params):
+        response = self.client.get('/api/logs/', dict(params, resource='Details'))
+        if response.status_code != 200:
+            return response.status_code
+        ids = {result['id'] for result in response.json()['results']}
+        return sorted(name for name, log_id in self.logs.items() if log_id in ids)
+
+    def test_equality(self):
+        self.assertEqual(self.matching(**{'details.method': 'PUT'}), ['missing'])
+        # Typed values also match their string form
+        self.assertEqual(self.matching(**{'details.status_code': '404'}), ['missing'])
+        self.assertEqual(self.matching(**{'details.request.method': 'DELETE'}), ['error'])
+        self.assertEqual(self.matching(details='{"method": "GET"}'), ['ok'])
+
+    def test_lookups(self):
+        self.assertEqual(self.matching(**{'details.method__in': 'GET,DELETE'}), ['error', 'ok'])
+        self.assertEqual(self.matching(**{'details.status_code__gte': '500'}), ['error'])
+        self.assertEqual(self.matching(**{'details.path__startswith': '/api/orders'}), ['ok'])
+        self.assertEqual(self.matching(**{'details.path__isnull': 'true'}), ['error'])
+
+    def test_invalid(self):
+        self.assertEqual(self.matching(**{'details.status_code__regex': '5'}), 400)
+        self.assertEqual(self.matching(**{"details.a'b": '1'}), 400)
+        self.assertEqual(self.matching(details='[1]'), 400)
+
+
+@override_settings(**TEST_SETTINGS)
+class ChainTests(TestCase):
+    """Edits, deletions and removed hashes are all caught by verification"""
+
+    def setUp(self):
+        self.logs = []
+        for number in range(6):
+            log = make_log(resource='Chain', resource_id=str(number))
+            log.save()
+            self.logs.append(log)
+        # The first run only records the newest id, the second seals
+        chain.seal_chain(max_size=4)
+        chain.seal_chain(max_size=4)
+
+    def errors(self):
+        return chain.verify_range().errors
+
+    def test_untouched(self):
+        self.assertEqual(AuditChainCheckpoint.objects.count(), 2)
+        self.assertEqual(self.errors(), [])
+
+    def test_modified(self):
+        AuditLog.objects.filter(pk=self.logs[1].pk).update(resource='Other')
+        errors = self.errors()
+        self.assertIn(f'Audit log {self.logs[1].id} was modified', errors)
+        self.assertTrue(any('Merkle root does not match' in error for error in errors))
+
+    def test_deleted(self):
+        AuditLog.objects.filter(pk=self.logs[5].pk).delete()
+        self.assertTrue(any('sealed 2 logs, found 1' in error for error in self.errors()))
+
+    def test_checkpoint_removed(self):
+        AuditChainCheckpoint.objects.order_by('last_id').first().delete()
+        self.assertTrue(any('does not follow' in error for error in self.errors()))
+
+    def test_hash_removed(self):
+        AuditLog.objects.filter(pk=self.logs[0].pk).update(entry_hash=None, resource='Other')
+        self.assertIn(f'Audit log {self.logs[0].id} has no entry hash', self.errors())
+
+    def test_unhashed_logs_are_not_certified(self):
+        log = make_log(resource='Chain')
+        log.save()
+        AuditLog.objects.filter(pk=log.pk).update(entry_hash=None)
+        self.assertIn(f'Audit log {log.id} has no entry hash', self.errors())
+
+        with self.assertLogs('logs.chain', 'ERROR'):
+            chain.seal_chain()
+            chain.seal_chain()
+        errors = self.errors()
+        self.assertIn(f'Audit log {log.id} has no entry hash', errors)
+        self.assertTrue(any('Merkle root does not match' in error for error in errors))
+
+    def test_proof(self):
+        log = self.logs[2]
+        proof = chain.build_proof(log)
+        self.assertTrue(chain.verify_inclusion(
+            bytes.fromhex(proof['leaf_hash']), proof['leaf_index'], proof['tree_size'],
+            [bytes.fromhex(node) for node in proof['audit_path']],
+            bytes.fromhex(proof['checkpoint']['merkle_root']),
+        ))
+
+    def test_backfill_migration(self):
+        migration = importlib.import_module('logs.migrations.0017_backfill_entry_hash')
+        AuditLog.objects.filter(resource='Chain').update(entry_hash=None)
+        migration.backfill_entry_hashes(apps, mock.Mock(connection=connection))
+        self.assertEqual(self.errors(), [])
+
+    def test_backfill_migration_with_actor_snapshot(self):
+        migration = importlib.import_module('logs.migrations.0017_backfill_entry_hash')
+        staff = User.objects.create_user('chain-staff', 'chain@example.com', is_staff=True)
+        legacy = AuditLog.objects.create(user=staff, action='UPDATE', resource='Chain', ip_address='10.0.0.1')
+        AuditLog.objects.filter(pk=legacy.pk).update(
+            actor_username=None, actor_email=None, actor_is_staff=False, entry_hash=None,
+        )
+        schema_editor = mock.Mock(connection=connection)
+        for operation in migration.Migration.operations:
+            operation.code(apps, schema_editor)
+        # Nothing left for the command to change behind the hashes' back
+        call_command('backfill_actor_snapshot', stdout=mock.Mock())
+        chain.seal_chain()
+        chain.seal_chain()
+
+        legacy.refresh_from_db()
+        self.assertEqual(
+            (legacy.actor_username, legacy.actor_email, legacy.actor_is_staff),
+            ('chain-staff', 'chain@example.com', True),
+        )
+        self.assertEqual(self.errors(), [])
+
+
+@override_settings(**TEST_SETTINGS)
+class LiveTailTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('live-staff', is_staff=True)
+
+    async def next_chunk(self, content):
+        return (await asyncio.wait_for(anext(content), timeout=5)).decode()
+
+    async def test_stream(self):
+        client = AsyncClient()
+        earlier = make_log(resource='Live')
+        await sync_to_async(earlier.save)()
+
+        response = await client.get(
+            '/api/logs/live/', {'resource': 'Live'}, headers={
+                'Authorization': f'Bearer {AccessToken.for_user(self.staff)}',
+                'Last-Event-ID': str(earlier.id - 1),
+            },
+        )
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = aiter(response.streaming_content)
+        self.assertEqual(await self.next_chunk(content), 'retry: 3000\n\n')
+        # Replayed, then live
+        self.assertIn(f'id: {earlier.id}\n', await self.next_chunk(content))
+        await sync_to_async(make_log(resource='Other').save)()
+        later = make_log(resource='Live')
+        await sync_to_async(later.save)()
+        self.assertIn(f'id: {later.id}\n', await self.next_chunk(content))
+        await content.aclose()
+
+    async def test_anonymous(self):
+        response = await AsyncClient().get('/api/logs/live/')
+        self.assertEqual(response.status_code, 401)
+
+    def test_wsgi(self):
+        self.assertEqual(self.client.get('/api/logs/live/').status_code, 501)
+
+    def test_hub_per_loop(self):
+        broker = mock.Mock()
+        with mock.patch('logs.live.get_live_broker', return_value=broker):
+            first = asyncio.run(self.get_hub())
+            second = asyncio.run(self.get_hub())
+        self.assertIsNot(first, second)
+        broker.unlisten.assert_called_once_with(first)
+        self.assertEqual(broker.listen.call_count, 2)
+        live.reset_live_broker()
+
+    async def get_hub(self):
+        return live.get_hub()
+
+    @skipUnless(connection.vendor == 'postgresql', 'LISTEN needs PostgreSQL')
+    def test_listener_closed(self):
+        broker = live.PostgresBroker()
+
+        async def listen():
+            hub = live.LiveTailHub(asyncio.get_running_loop())
+            broker.listen(hub)
+            return hub, broker._listener
+
+        hub, listener = asyncio.run(listen())
+        self.assertFalse(listener.closed)
+        broker.unlisten(hub)
+        self.assertTrue(listener.closed)
+
+
+@override_settings(**TEST_SETTINGS, AUDIT_BULK_INGEST_CHUNK_SIZE=4, AUDIT_BULK_INGEST_MAX_ITEMS=20)
+class BulkIngestTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('bulk-staff', is_staff=True)
+        cls.member = User.objects.create_user('bulk-member')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def post(self, items, mode='partial'):
+        return self.client.post(f'/api/logs/bulk/?mode={mode}', items, format='json')
+
+    def events(self, count, resource='Bulk'):
+        return [{'action': 'CREATE', 'resource': resource, 'resource_id': str(number)} for number in range(count)]
+
+    def stored(self):
+        return sorted(AuditLog.objects.filter(resource__startswith='Bulk').values_list('resource_id', flat=True), key=int)
+
+    def test_partial(self):
+        items = self.events(6)
+        items[2] = {'action': 'NOPE', 'resource': 'Bulk'}
+        items[4] = {'resource': 'Bulk'}
+        response = self.post(items)
+        self.assertEqual(response.status_code, 207)
+        data = response.json()
+        self.assertEqual((data['received'], data['inserted'], data['failed']), (6, 4, 2))
+        self.assertEqual([error['index'] for error in data['errors']], [2, 4])
+        self.assertEqual(self.stored(), ['0', '1', '3', '5'])
+
+    def test_atomic(self):
+        items = self.events(6)
+        items[3] = {'action': 'CREATE'}
+        response = self.post(items, mode='atomic')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stored(), [])
+        self.assertEqual(self.post(self.events(6), mode='atomic').status_code, 201)
+        self.assertEqual(len(self.stored()), 6)
+
+    def reject_bad(self, entries):
+        if any(entry.resource == 'BulkBad' for entry in entries):
+            raise DatabaseError('rejected')
+        return store_entries(entries)
+
+    def test_database_rejections_are_isolated(self):
+        items = self.events(8)
+        items[5]['resource'] = 'BulkBad'
+        with mock.patch('logs.ingest.store_entries', side_effect=self.reject_bad), \
+                mock.patch('logs.ingest.dispatch_entries') as dispatch, \
+                self.captureOnCommitCallbacks(execute=True):
+            data = self.post(items).json()
+        # Only the stored chunks are dispatched
+        self.assertEqual(
+            sorted(entry.resource_id for call in dispatch.call_args_list for entry in call.args[0]),
+            ['0', '1', '2', '3', '4', '6', '7'],
+        )
+        self.assertEqual(data['inserted'], 7)
+        self.assertEqual(data['errors'], [{'index': 5, 'errors': {'non_field_errors': ['Rejected by the database']}}])
+        self.assertEqual(self.stored(), ['0', '1', '2', '3', '4', '6', '7'])
+
+    @override_settings(AUDIT_BULK_INGEST_CHUNK_SIZE=2)
+    def test_rolled_back_atomic_ingest_dispatches_nothing(self):
+        reset_counter_store()
+        items = [dict(event, action='DELETE') for event in self.events(6)]
+        items[5]['resource'] = 'BulkBad'
+        rule = {'name': 'bulk-deletes', 'action': 'DELETE', 'group_by': 'user', 'threshold': 2}
+        with override_settings(AUDIT_DETECTION_RULES=[rule]), \
+                mock.patch('logs.ingest.store_entries', side_effect=self.reject_bad), \
+                mock.patch('logs.tasks.report_detection.delay') as report, \
+                mock.patch('logs.live.publish') as publish, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.post(items, mode='atomic')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stored(), [])
+        report.assert_not_called()
+        publish.assert_not_called()
+
+        with override_settings(AUDIT_DETECTION_RULES=[rule]), \
+                mock.patch('logs.tasks.report_detection.delay') as report, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.post(items[:5], mode='atomic').status_code, 201)
+        report.assert_called_once()
+
+    def test_ndjson(self):
+        body = '{"action": "CREATE", "resource": "Bulk", "resource_id": "0"}\nnot json\n'
+        response = self.client.post('/api/logs/bulk/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(response.json()['errors'][0]['index'], 1)
+
+    def test_provenance_is_staff_only(self):
+        self.client.force_authenticate(self.member)
+        items = [dict(self.events(1)[0], ip_address='192.0.2.1')]
+        self.assertEqual(self.post(items).status_code, 400)
+
+    def test_limits(self):
+        self.assertEqual(self.post(self.events(21)).status_code, 413)
+        self.assertEqual(self.post({'action': 'CREATE'}).status_code, 400)
+        self.assertEqual(self.post(self.events(1), mode='sometimes').status_code, 400)
+
+
+@override_settings(**TEST_SETTINGS)
+class AsyncViewTests(TestCase):
+    """The async views answer like the viewset they stand in for"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('async-staff', is_staff=True)
+        cls.member = User.objects.create_user('async-member')
+        cls.own = AuditLog.build(cls.member, 'UPDATE', 'Async', '10.0.0.1')
+        cls.own.save()
+        cls.other = make_log(resource='Async')
+        cls.other.save()
+
+    def request(self, method, path, user, **kwargs):
+        headers = {'Authorization': f'Bearer {AccessToken.for_user(user)}'}
+        request = getattr(AsyncRequestFactory(), method)(path, headers=headers, **kwargs)
+        request.session = SessionStore()
+        return request
+
+    async def call(self, request, **kwargs):
+        response = await AsyncAuditLogView.as_view()(request, **kwargs)
+        return response.status_code, json.loads(response.content)
+
+    @sync_to_async
+    def sync_get(self, path, user, params=None):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.get(path, params).json()
+
+    async def test_list(self):
+        for user in (self.staff, self.member):
+            status_code, data = await self.call(self.request('get', '/api/logs/', user, data={'resource': 'Async'}))
+            self.assertEqual(status_code, 200)
+            self.assertEqual(data, await self.sync_get('/api/logs/', user, {'resource': 'Async'}))
+        self.assertEqual([result['id'] for result in data['results']], [self.own.id])
+
+    async def test_retrieve(self):
+        request = self.request('get', f'/api/logs/{self.own.id}/', self.member)
+        status_code, data = await self.call(request, pk=self.own.id)
+        self.assertEqual((status_code, data['username']), (200, 'async-member'))
+        request = self.request('get', f'/api/logs/{self.other.id}/', self.member)
+        self.assertEqual((await self.call(request, pk=self.other.id))[0], 404)
+
+    async def test_create(self):
+        request = self.request(
+            'post', '/api/logs/', self.member,
+            data={'action': 'DELETE', 'resource': 'AsyncCreated'}, content_type='application/json',
+        )
+        status_code, _ = await self.call(request)
+        self.assertEqual(status_code, 201)
+        log = await AuditLog.objects.aget(resource='AsyncCreated')
+        self.assertEqual(log.actor_username, 'async-member')
+
+    async def test_anonymous(self):
+        request = AsyncRequestFactory().get('/api/logs/')
+        self.assertEqual((await self.call(request))[0], 401)
+
+    @override_settings(AUDIT_ROUTING_RULES=[{'methods': ['POST'], 'status': '<400'}])
+    async def test_middleware(self):
+        response = await AsyncClient().post(
+            '/api/logs/', {'action': 'DELETE', 'resource': 'AsyncMiddleware'},
+            content_type='application/json',
+            headers={'Authorization': f'Bearer {AccessToken.for_user(self.member)}'},
+        )
+        self.assertEqual(response.status_code, 201)
+        logged = await AuditLog.objects.filter(details__path='/api/logs/').aget()
+        self.assertEqual((logged.action, logged.actor_username), ('CREATE', 'async-member'))
+
+
+class SyntheticDataTests(SimpleTestCase):
+
+    def generator(self, seed=0, total=2000):
+        users = [User(id=number, username=f'synthetic_{number}', email='') for number in range(1, 51)]
+        return SyntheticLogGenerator(users, total, days=10, ip_pool=500, seed=seed, end=timezone.now())
+
+    def rows(self, generator):
+        return [(entry.action, entry.actor_username, entry.ip_address, entry.details) for entry in generator]
+
+    def test_seeded(self):
+        self.assertEqual(self.rows(self.generator(seed=1)), self.rows(self.generator(seed=1)))
+        self.assertNotEqual(self.rows(self.generator(seed=1)), self.rows(self.generator(seed=2)))
+
+    def test_timestamps_in_order(self):
+        generator = self.generator()
+        timestamps = [entry.timestamp for entry in generator]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertGreaterEqual(timestamps[0], generator.start)
+        self.assertLessEqual(timestamps[-1], generator.end)
+
+    def test_skewed(self):
+        entries = list(self.generator())
+        users = [entry.actor_username for entry in entries if entry.actor_username]
+        # The most active of 50 users acts far more than an even share
+        self.assertGreater(users.count('synthetic_1'), 5 * len(users) / 50)
+        actions = [entry.action for entry in entries]
+        self.assertGreater(actions.count('VIEW'), actions.count('DELETE') * 10)
+        self.assertFalse(any(entry.user for entry in entries if entry.action == 'FAILED_LOGIN'))
+
+    def test_batches(self):
+        self.assertEqual([len(batch) for batch in self.generator(total=25).batches(10)], [10, 10, 5])
+
+
+class BenchmarkResultTests(SimpleTestCase):
+
+    def result(self, p95_ms, queries):
+        return {'p50_ms': 1.0, 'p95_ms': p95_ms, 'p99_ms': p95_ms, 'queries': queries}
+
+    def test_summarize(self):
+        summary = benchmarks.summarize([index / 1000 for index in range(100, 0, -1)], 3)
+        self.assertEqual((summary['p50_ms'], summary['p95_ms'], summary['p99_ms']), (50.0, 95.0, 99.0))
+        self.assertEqual(summary['queries'], 3)
+
+    def test_compare(self):
+        baseline = {'scenarios': {
+            'list': self.result(10.0, 2), 'detail': self.result(10.0, 2), 'search': self.result(10.0, 2),
+        }}
+        results = {'scenarios': {
+            'list': self.result(11.0, 2), 'detail': self.result(13.0, 2), 'search': self.result(9.0, 3),
+            'new': self.result(50.0, 9),
+        }}
+        self.assertEqual(benchmarks.compare(results, baseline, 20.0), ['detail: p95 10.0ms -> 13.0ms', 'search: 2 -> 3 queries'])
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Seeding uses COPY')
+@override_settings(**TEST_SETTINGS)
+class SeedCommandTests(TestCase):
+
+    def test_seed(self):
+        call_command('seed_audit_logs', rows=300, users=10, ips=20, days=3, batch_size=128, stdout=mock.Mock())
+        self.assertEqual(User.objects.filter(username__startswith='bench_user_').count(), 10)
+        self.assertEqual(AuditLog.objects.count(), 300)
+        self.assertEqual(rollups.count_logs(), 300)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Importing uses COPY')
+@override_settings(**TEST_SETTINGS)
+class ImportTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('importer', 'importer@example.com', 'password')
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.timestamp = (timezone.now() - timedelta(hours=1)).isoformat()
+
+    def record(self, index, **kwargs):
+        return dict({
+            'action': 'VIEW', 'resource': 'Order', 'resource_id': str(index),
+            'ip_address': '10.0.0.1', 'timestamp': self.timestamp,
+        }, **kwargs)
+
+    def write_jsonl(self, name, lines):
+        path = os.path.join(self.directory.name, name)
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(path, 'wt') as handle:
+            for line in lines:
+                handle.write((line if isinstance(line, str) else json.dumps(line)) + '\n')
+        return path
+
+    def test_jsonl_with_rejects(self):
+        path = self.write_jsonl('logs.jsonl', [
+            self.record(1, user='importer'),
+            self.record(2, timestamp=None),
+            '{not json',
+            '',
+            self.record(3, ip_address=None),
+        ])
+        rejects = io.StringIO()
+        progress = AuditLogImporter(path, mapping={'user': 'username'}, rejects=rejects).run()
+        self.assertEqual((progress.imported, progress.rejected, progress.line), (1, 3, 5))
+        self.assertIsNotNone(progress.completed_at)
+        log = AuditLog.objects.get()
+        self.assertEqual((log.user, log.actor_username, log.actor_email), (self.user, 'importer', 'importer@example.com'))
+        self.assertEqual([json.loads(line)['line'] for line in rejects.getvalue().splitlines()], [2, 3, 5])
+
+    def test_default_ip(self):
+        path = self.write_jsonl('logs.jsonl', [self.record(1, ip_address=None)])
+        progress = AuditLogImporter(path, default_ip='192.0.2.1').run()
+        self.assertEqual(progress.imported, 1)
+        self.assertEqual(AuditLog.objects.get().ip_address, '192.0.2.1')
+
+    def test_gzipped_csv(self):
+        path = os.path.join(self.directory.name, 'logs.csv.gz')
+        with gzip.open(path, 'wt', newline='') as handle:
+            writer = csv.writer(handle)
+            writer.writerow(['user', 'action', 'resource', 'ip_address', 'timestamp', 'details'])
+            writer.writerow(['importer', 'DELETE', 'Order', '10.0.0.2', self.timestamp, '{"status": "paid"}'])
+            writer.writerow(['', 'VIEW', 'Order', '10.0.0.3', self.timestamp, ''])
+            writer.writerow(['', 'VIEW', 'Order', '10.0.0.4', self.timestamp, '{broken'])
+        progress = AuditLogImporter(path, mapping={'user': 'username'}, rejects=io.StringIO()).run()
+        self.assertEqual((progress.imported, progress.rejected), (2, 1))
+        log = AuditLog.objects.get(ip_address='10.0.0.2')
+        self.assertEqual((log.user, log.details, log.severity), (self.user, {'status': 'paid'}, 'MEDIUM'))
+        self.assertFalse(AuditLog.objects.filter(ip_address='10.0.0.4').exists())
+
+    def test_resume_after_interruption(self):
+        path = self.write_jsonl('logs.jsonl', [self.record(index) for index in range(10)])
+
+        def interrupt(progress):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            AuditLogImporter(path, batch_size=4).run(on_batch=interrupt)
+        progress = AuditLogImport.objects.get()
+        self.assertEqual((progress.line, progress.imported, progress.completed_at), (4, 4, None))
+        self.assertEqual(AuditLog.objects.count(), 4)
+
+        importer = AuditLogImporter(path, batch_size=4)
+        progress = importer.run()
+        self.assertEqual((importer.loaded, progress.imported, progress.line), (6, 10, 10))
+        self.assertEqual(
+            sorted(AuditLog.objects.values_list('resource_id', flat=True)),
+            sorted(str(index) for index in range(10)),
+        )
+        # A finished file loads nothing more unless restarted from the beginning
+        importer = AuditLogImporter(path, batch_size=4)
+        importer.run()
+        self.assertEqual(importer.loaded, 0)
+        importer = AuditLogImporter(path, batch_size=4)
+        self.assertEqual(importer.run(from_start=True).imported, 10)
+        self.assertEqual(AuditLog.objects.count(), 20)
+
+    def test_database_rejection_isolated(self):
+        path = self.write_jsonl('logs.jsonl', [
+            self.record(index, resource='Refused' if index == 5 else 'Order') for index in range(8)
+        ])
+        copy_entries = importer.copy_entries
+
+        def refuse(entries):
+            if any(entry.resource == 'Refused' for entry in entries):
+                raise DatabaseError('refused')
+            return copy_entries(entries)
+
+        rejects = io.StringIO()
+        with mock.patch('logs.importer.copy_entries', side_effect=refuse):
+            progress = AuditLogImporter(path, rejects=rejects).run()
+        self.assertEqual((progress.imported, progress.rejected), (7, 1))
+        self.assertEqual(AuditLog.objects.count(), 7)
+        rejection = json.loads(rejects.getvalue())
+        self.assertEqual(rejection['line'], 6)
+        self.assertIn('refused', rejection['errors']['non_field_errors'][0])
+
+    def test_command_dry_run(self):
+        path = self.write_jsonl('logs.jsonl', [self.record(1), self.record(2, action='UNKNOWN')])
+        stdout = io.StringIO()
+        rejects = os.path.join(self.directory.name, 'rejects.jsonl')
+        call_command('import_audit_logs', path, '--dry-run', '--rejects', rejects, stdout=stdout)
+        self.assertIn('Validated', stdout.getvalue())
+        self.assertIn('1 rows, 1 rejected', stdout.getvalue())
+        with open(rejects) as handle:
+            self.assertEqual(json.loads(handle.read())['line'], 2)
+        self.assertFalse(AuditLog.objects.exists())
+        self.assertFalse(AuditLogImport.objects.exists())
+
+
+@override_settings(**TEST_SETTINGS, AUDIT_METRICS_TOKEN='scrape-token')
+class MetricsEndpointTests(TestCase):
+
+    def setUp(self):
+        reset_counter_store()
+        self.factory = RequestFactory()
+        patcher = mock.patch('logs.metrics.celery_queue_lengths', return_value=[('{queue="celery"}', 3)])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def scrape(self, user=None, **headers):
+        request = self.factory.get('/metrics', headers=headers)
+        request.user = user or AnonymousUser()
+        return metrics_view(request)
+
+    def test_token(self):
+        response = self.scrape(Authorization='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE audit_http_request_seconds histogram', response.content)
+        for authorization in ('', 'Bearer wrong-token', 'scrape-token'):
+            response = self.scrape(Authorization=authorization)
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(response['WWW-Authenticate'], 'Bearer')
+
+    def test_staff(self):
+        staff = User.objects.create_user('staff', password='password', is_staff=True)
+        user = User.objects.create_user('user', password='password')
+        self.assertEqual(self.scrape(staff).status_code, 200)
+        self.assertEqual(self.scrape(user).status_code, 401)
+
+    @override_settings(AUDIT_METRICS_TOKEN='')
+    def test_closed_without_token(self):
+        staff = User.objects.create_user('staff', password='password', is_staff=True)
+        self.assertEqual(self.scrape().status_code, 401)
+        self.assertEqual(self.scrape(Authorization='Bearer ').status_code, 401)
+        self.assertEqual(self.scrape(staff).status_code, 200)
+
+    @override_settings(AUDIT_METRICS_ENABLED=False)
+    def test_disabled(self):
+        with self.assertRaises(Http404):
+            self.scrape(Authorization='Bearer scrape-token')
+
+    def test_requests_recorded(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('user', password='password'))
+        client.get('/api/logs/')
+        metrics.REGISTRY.flush()
+        content = self.client.get('/metrics', headers={'Authorization': 'Bearer scrape-token'}).content.decode()
+        self.assertIn('audit_http_request_seconds_count{endpoint="auditlog-list",method="GET",status="2xx"} 1\n', content)
+        self.assertIn('audit_celery_queue_length{queue="celery"} 3\n', content)
+
+
+@override_settings(**TEST_SETTINGS)
+class RoutingTests(TestCase):
+
+    def request(self, method, path, status=200):
+        request = RequestFactory().generic(method, path)
+        request.resolver_match = resolve(path)
+        return request, HttpResponse(status=status)
+
+    def test_parse_status(self):
+        self.assertEqual(parse_status('2xx'), [(200, 299)])
+        self.assertEqual(parse_status('<400'), [(100, 399)])
+        self.assertEqual(parse_status('400-403'), [(400, 403)])
+        self.assertEqual(parse_status(['404', 500]), [(404, 404), (500, 500)])
+        for spec in ('6xx', '<4', 'ok', True):
+            with self.assertRaises(ValueError):
+                parse_status(spec)
+
+    def test_invalid_rules(self):
+        for rule in (
+            {'url_name': 'auditlog-*', 'sampling': 0.5},
+            {'status': 'ok'},
+            {'action': 'READ'},
+            {'severity': 'SEVERE'},
+            {'sample_rate': 2},
+        ):
+            with self.subTest(rule=rule), self.assertRaises(ImproperlyConfigured):
+                AuditRouter([rule])
+
+    def test_first_match_wins(self):
+        router = AuditRouter([
+            {'url_name': 'auditlog-*', 'methods': ['DELETE'], 'log': False},
+            {'url_name': 'auditlog-*', 'status': '2xx', 'severity': 'HIGH'},
+            {'namespace': 'admin', 'log': False},
+            {'methods': ['post'], 'action': 'EXPORT', 'resource': 'Session'},
+        ])
+        self.assertFalse(router.match(*self.request('DELETE', '/api/logs/1/')).log)
+        self.assertEqual(router.match(*self.request('GET', '/api/logs/1/')).severity, 'HIGH')
+        self.assertIsNone(router.match(*self.request('GET', '/api/logs/1/', status=404)))
+        self.assertFalse(router.match(*self.request('GET', '/admin/')).log)
+        rule = router.match(*self.request('POST', '/api/auth/login/'))
+        self.assertEqual((rule.get_action('POST'), rule.resource), ('EXPORT', 'Session'))
+        self.assertIsNone(router.match(*self.request('PUT', '/api/auth/login/')))
+        self.assertEqual(set(router._routes), {
+            ('', 'auditlog-detail', 'DELETE'), ('', 'auditlog-detail', 'GET'),
+            ('admin', 'index', 'GET'), ('', 'login', 'POST'), ('', 'login', 'PUT'),
+        })
+
+    def test_recompiled_on_setting_change(self):
+        router = get_audit_router()
+        with self.settings(AUDIT_ROUTING_RULES=[{'log': False}]):
+            self.assertIsNot(get_audit_router(), router)
+            self.assertEqual(len(get_audit_router().rules), 1)
+
+    @override_settings(AUDIT_ROUTING_RULES=[
+        {'methods': ['GET'], 'status': '2xx', 'sample_rate': 0.25},
+        {'methods': ['POST'], 'status': '<400'},
+    ])
+    def test_sampling(self):
+        middleware = AuditMiddleware(lambda request: None)
+        request, response = self.request('GET', '/api/logs/')
+        with mock.patch('logs.middleware.random.random', return_value=0.3):
+            self.assertIsNone(middleware.get_rule(request, response))
+        with mock.patch('logs.middleware.random.random', return_value=0.2):
+            rule = middleware.get_rule(request, response)
+        request.session = SessionStore()
+        entry = middleware.build_entry(request, response, User.objects.create_user('sampled'), rule)
+        self.assertEqual((entry.action, entry.resource, entry.details['sample_rate']), ('VIEW', 'Logs', 0.25))
+
+        request, response = self.request('POST', '/api/logs/', status=201)
+        with mock.patch('logs.middleware.random.random') as sample:
+            rule = middleware.get_rule(request, response)
+        sample.assert_not_called()
+        request.session = SessionStore()
+        entry = middleware.build_entry(request, response, User.objects.create_user('unsampled'), rule)
+        self.assertNotIn('sample_rate', entry.details)
+        # Paths outside /api/ have no resource to log under
+        self.assertIsNone(middleware.get_rule(*self.request('POST', '/admin/login/')))
+
+
+def hll_pairs(values):
+    """``(register, rank)`` pairs of 64-bit hashes, as ``sketches._REGISTER_SQL`` computes them"""
+    for value in values:
+        rest = value >> sketches.PRECISION
+        yield value & (sketches.REGISTERS - 1), sketches.RANK_BITS - rest.bit_length() + 1
+
+
+class HyperLogLogTests(SimpleTestCase):
+
+    def sketch(self, values):
+        sketch = sketches.HyperLogLog()
+        sketch.update(hll_pairs(values))
+        return sketch
+
+    def hashes(self, count, seed=0):
+        generator = random.Random(seed)
+        return [generator.getrandbits(64) for _ in range(count)]
+
+    def test_estimates(self):
+        self.assertEqual(sketches.HyperLogLog().count(), 0)
+        for count in (1, 10, 200, 5000, 100000):
+            with self.subTest(count=count):
+                hashes = self.hashes(count)
+                # Duplicates do not count twice
+                estimate = self.sketch(hashes + hashes[:count // 2]).count()
+                self.assertLessEqual(abs(estimate - count), 4 * sketches.STANDARD_ERROR * count + 1)
+
+    def test_sparse_then_dense(self):
+        sketch = self.sketch(self.hashes(100))
+        self.assertIsInstance(sketch.registers, dict)
+        self.assertLess(len(sketch.to_bytes()), 400)
+        sketch.update(hll_pairs(self.hashes(2000, seed=1)))
+        self.assertIsInstance(sketch.registers, bytearray)
+
+    def test_round_trip(self):
+        for count in (0, 100, 50000):
+            with self.subTest(count=count):
+                sketch = self.sketch(self.hashes(count))
+                restored = sketches.HyperLogLog.from_bytes(sketch.to_bytes())
+                self.assertEqual(restored.histogram(), sketch.histogram())
+                self.assertEqual(restored.count(), sketch.count())
+
+    def test_merge_is_union(self):
+        for left, right in ((50, 80), (50, 20000), (20000, 50), (20000, 30000)):
+            with self.subTest(left=left, right=right):
+                first, second = self.hashes(left, seed=1), self.hashes(right, seed=2)
+                merged = self.sketch(first)
+                merged.merge(self.sketch(second))
+                self.assertEqual(merged.histogram(), self.sketch(first + second).histogram())
+
+    def test_max_registers(self):
+        generator = random.Random(0)
+        left = bytearray(generator.randrange(sketches.RANK_BITS + 2) for _ in range(sketches.REGISTERS))
+        right = bytearray(generator.randrange(sketches.RANK_BITS + 2) for _ in range(sketches.REGISTERS))
+        self.assertEqual(sketches._max_registers(left, right), bytearray(map(max, left, right)))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Sketches are folded by PostgreSQL')
+class DistinctCountTests(TestCase):
+    """Sketches plus the tail estimate what an exact distinct count counts"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.now = timezone.now().replace(minute=30, second=0, microsecond=0)
+        cls.users = [User.objects.create_user(f'distinct_{number}') for number in range(12)]
+        for number in range(300):
+            AuditLog.build(
+                cls.users[number % 12] if number % 5 else None, 'CREATE', 'Order',
+                f'10.1.{number % 7}.{number % 41}', timestamp=cls.now - timedelta(minutes=23 * number),
+            ).save()
+        sketches.update_sketches()
+        sketches.update_sketches()
+        for number in range(10):
+            AuditLog.build(cls.users[0], 'CREATE', 'Order', f'10.2.0.{number}', timestamp=cls.now).save()
+
+    def exact(self, field, start=None, end=None, **filters):
+        queryset = AuditLog.objects.filter(**filters)
+        if start is not None:
+            queryset = queryset.filter(timestamp__gte=start)
+        if end is not None:
+            queryset = queryset.filter(timestamp__lt=end)
+        return queryset.values(field).exclude(**{f'{field}__isnull': True}).distinct().count()
+
+    def assertClose(self, estimate, exact):
+        self.assertLessEqual(abs(estimate - exact), 0.02 * exact + 1)
+
+    def test_counts(self):
+        self.assertTrue(AuditLogSketch.objects.filter(metric='distinct_ip_address').exists())
+        for start in (None, self.now - timedelta(hours=10), self.now - timedelta(days=3)):
+            for field in ('ip_address', 'user'):
+                with self.subTest(field=field, start=start):
+                    self.assertClose(sketches.distinct_count(field, start), self.exact(field, start))
+
+    def test_per_user(self):
+        user = self.users[0]
+        self.assertClose(
+            sketches.distinct_count('ip_address', user=user.id), self.exact('ip_address', user=user),
+        )
+        with self.assertRaises(ValueError):
+            sketches.distinct_count('user', user=user.id)
+
+    def test_series(self):
+        start = self.now.replace(minute=0) - timedelta(hours=12)
+        end = self.now.replace(minute=0) + timedelta(hours=1)
+        points = sketches.distinct_series('ip_address', start, end)
+        self.assertEqual(len(points), 13)
+        for point in points:
+            self.assertClose(
+                point['count'], self.exact('ip_address', point['bucket'], point['bucket'] + timedelta(hours=1)),
+            )
+
+
+class SpaceSavingTests(SimpleTestCase):
+
+    def stream(self, count, seed=0):
+        generator = random.Random(seed)
+        # Zipf-like: value n is seen about 1/n as often as value 1
+        return [f'value-{int(1 / (1 - generator.random() * 0.999))}' for _ in range(count)]
+
+    def exact(self, values):
+        counts = {}
+        for value in values:
+            counts[value] = counts.get(value, 0) + 1
+        return counts
+
+    def assertBounds(self, summary, exact, total):
+        self.assertLessEqual(summary.error, total / (summary.capacity + 1))
+        for value, count in exact.items():
+            estimate = summary.counts.get(value, 0)
+            self.assertLessEqual(estimate, count)
+            self.assertLessEqual(count, estimate + summary.error)
+            if count > summary.error:
+                self.assertIn(value, summary.counts)
+
+    def test_exact_under_capacity(self):
+        summary = sketches.SpaceSaving(capacity=10)
+        summary.update([('a', 5), ('b', 3)])
+        summary.update([('a', 1), ('c', 7)])
+        self.assertEqual(summary.error, 0)
+        self.assertEqual(summary.top(2), [('c', 7), ('a', 6)])
+
+    def test_bounds(self):
+        values = self.stream(20000)
+        summary = sketches.SpaceSaving(capacity=20)
+        for start in range(0, len(values), 500):
+            summary.update(self.exact(values[start:start + 500]).items())
+        self.assertGreater(summary.error, 0)
+        self.assertLessEqual(len(summary.counts), 20)
+        self.assertBounds(summary, self.exact(values), len(values))
+        self.assertEqual(summary.top(1)[0][0], 'value-1')
+
+    def test_merge(self):
+        parts = [self.stream(5000, seed) for seed in range(4)]
+        merged = sketches.SpaceSaving(capacity=20)
+        for part in parts:
+            summary = sketches.SpaceSaving(capacity=20)
+            summary.update(self.exact(part).items())
+            merged.merge(summary)
+        values = [value for part in parts for value in part]
+        self.assertBounds(merged, self.exact(values), len(values))
+
+    def test_round_trip(self):
+        summary = sketches.SpaceSaving(capacity=5)
+        summary.update(self.exact(self.stream(1000)).items())
+        restored = sketches.SpaceSaving.from_bytes(summary.to_bytes())
+        self.assertEqual((restored.counts, restored.error), (summary.counts, summary.error))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Sketches are folded by PostgreSQL')
+class TopValueSketchTests(TestCase):
+    """With fewer values than counters, sketches plus the tail count exactly"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.now = timezone.now().replace(minute=30, second=0, microsecond=0)
+        cls.user = User.objects.create_user('top-values')
+        for number in range(200):
+            AuditLog.build(
+                cls.user if number % 3 else None, 'CREATE', f'Resource{number % 9 * number % 13}',
+                f'10.3.0.{number % 17 * number % 11}', user_agent=f'agent/{number % 4}' if number % 6 else '',
+                timestamp=cls.now - timedelta(minutes=31 * number),
+            ).save()
+        sketches.update_sketches()
+        sketches.update_sketches()
+        for number in range(5):
+            make_log(resource='Resource0', ip_address='10.3.0.99', timestamp=cls.now).save()
+
+    def test_top_values(self):
+        lookups = {
+            'ip_address': 'ip_address', 'user': 'user', 'resource': 'resource', 'user_agent': 'agent__user_agent',
+        }
+        self.assertTrue(AuditLogSketch.objects.filter(metric='top_resource').exists())
+        # Bounds are widened to the hour
+        for start in (None, self.now.replace(minute=0) - timedelta(hours=30)):
+            for field, lookup in lookups.items():
+                with self.subTest(field=field, start=start):
+                    queryset = AuditLog.objects.exclude(**{f'{lookup}__isnull': True})
+                    if start is not None:
+                        queryset = queryset.filter(timestamp__gte=start)
+                    expected = {
+                        str(value) if field == 'ip_address' else value: count
+                        for value, count in queryset.values_list(lookup).annotate(count=Count('id'))
+                        if value != ''
+                    }
+                    top = sketches.top_values(field, 100, start)
+                    self.assertEqual({row[field]: row['count'] for row in top}, expected)
+                    self.assertEqual([row['count'] for row in top], sorted(expected.values(), reverse=True))
+                    self.assertEqual(sketches.heavy_hitters(field, start).error, 0)
+
+    def test_invalid_field(self):
+        with self.assertRaises(ValueError):
+            sketches.top_values('action', 10)
+
+
+class DetectionRuleTests(SimpleTestCase):
+    """The rule options: filters, details groups, distinct counts and validation"""
+
+    def setUp(self):
+        patcher = mock.patch('logs.security.get_counter_store', return_value=LocalCounterStore())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_details_group(self):
+        engine = DetectionEngine([{
+            'name': 'failed-logins-username', 'action': 'FAILED_LOGIN',
+            'group_by': 'details.attempted_username', 'window': 300, 'threshold': 3,
+        }])
+        entries = [
+            make_log(action='FAILED_LOGIN', resource='User', ip_address=f'10.0.4.{number}',
+                     details={'attempted_username': 'alice'})
+            for number in range(3)
+        ]
+        entries += [make_log(action='FAILED_LOGIN', resource='User', details={}) for _ in range(3)]
+        alerts = engine.evaluate(entries, now=600)
+        self.assertEqual(len(alerts), 1)
+        self.assertEqual(alerts[0]['group'], 'details.attempted_username:alice')
+        self.assertEqual((alerts[0]['username'], alerts[0]['ip_address']), ('alice', '10.0.4.2'))
+        self.assertEqual(alerts[0]['timeframe'], '5 minutes')
+
+    def test_distinct(self):
+        engine = DetectionEngine([{
+            'name': 'login-ip-spread', 'action': 'LOGIN', 'group_by': 'user',
+            'distinct': 'ip_address', 'window': 3600, 'threshold': 3,
+        }])
+        user = User(id=7, username='spread')
+
+        def logins(*ip_addresses):
+            return [AuditLog.build(user, 'LOGIN', 'User', ip_address) for ip_address in ip_addresses]
+
+        self.assertEqual(engine.evaluate(logins('10.0.5.1', '10.0.5.1', '10.0.5.2'), now=600), [])
+        # Repeated addresses count once
+        self.assertEqual(engine.evaluate(logins('10.0.5.2', '10.0.5.1'), now=700), [])
+        alerts = engine.evaluate(logins('10.0.5.3'), now=800)
+        self.assertEqual([(alert['group'], alert['count']) for alert in alerts], [('user:7', 3)])
+        self.assertEqual(alerts[0]['measure'], 'distinct ip_address values')
+
+        # Addresses older than the window are forgotten
+        user.id = 8
+        self.assertEqual(engine.evaluate(logins('10.0.5.1', '10.0.5.2'), now=600), [])
+        self.assertEqual(engine.evaluate(logins('10.0.5.3'), now=4300), [])
+
+    def test_filters(self):
+        engine = DetectionEngine([{
+            'name': 'critical-deletes', 'action': ['DELETE', 'UPDATE'], 'resource': 'Order',
+            'severity': ['HIGH', 'CRITICAL'], 'group_by': 'ip_address', 'threshold': 2,
+        }])
+        ignored = [
+            make_log(action='DELETE', severity='LOW'),
+            make_log(action='DELETE', resource='Invoice', severity='HIGH'),
+            make_log(action='CREATE', severity='HIGH'),
+            make_log(action='DELETE', resource='Security', severity='HIGH'),
+        ]
+        self.assertEqual(engine.evaluate(ignored, now=600), [])
+        alerts = engine.evaluate(
+            [make_log(action='UPDATE', severity='HIGH'), make_log(action='DELETE', severity='CRITICAL')], now=601,
+        )
+        self.assertEqual(len(alerts), 1)
+        self.assertEqual((alerts[0]['measure'], alerts[0]['action']), ('events', 'DELETE'))
+
+    def test_invalid_rules(self):
+        valid = {'name': 'rule', 'group_by': 'ip_address', 'threshold': 1}
+        for change in (
+            {'windows': 60},
+            {'action': 'READ'},
+            {'severity': ['HIGH', 'SEVERE']},
+            {'group_by': 'password'},
+            {'distinct': 'password'},
+            {'threshold': 0},
+            {'window': -1},
+            {'name': None, 'group_by': None},
+        ):
+            rule = {key: value for key, value in dict(valid, **change).items() if value is not None}
+            with self.subTest(change=change), self.assertRaises(ImproperlyConfigured):
+                DetectionEngine([rule])
+
+    def test_describe_window(self):
+        self.assertEqual(
+            [describe_window(seconds) for seconds in (1, 90, 60, 300, 3600, 7200)],
+            ['1 second', '90 seconds', '1 minute', '5 minutes', '1 hour', '2 hours'],
+        )
+
+
+class IPEnrichmentTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.write(enrichment.NETWORKS_FILE, [
+            '# cidr,class,name', '203.0.113.0/24,cloud,Example Cloud', '203.0.113.128/25,vpn,',
+            '10.8.0.0/16,VPN,Office VPN', '2001:db8::/32,cloud,Example Cloud', 'not-a-network,cloud',
+        ])
+        self.write(enrichment.BLOCKLIST_FILE, ['198.51.100.7/32', '', '2001:db8:bad::/48'])
+        self.write(enrichment.COUNTRIES_FILE, [
+            '198.51.100.0,198.51.100.255,nl', '203.0.113.0/24,us', '2001:db8::/32,de',
+            '198.51.100.9,198.51.100.1,fr',
+        ])
+
+    def write(self, name, lines):
+        with open(os.path.join(self.directory.name, name), 'w') as handle:
+            handle.write('\n'.join(lines) + '\n')
+
+    def enricher(self):
+        with self.assertLogs('logs.enrichment', 'WARNING') as logged:
+            enricher = enrichment.IPEnricher(self.directory.name, 100)
+        self.assertEqual(len(logged.records), 2)
+        return enricher
+
+    def test_parse_ip(self):
+        self.assertEqual(enrichment.parse_ip('10.0.0.1'), (4, 0x0A000001))
+        self.assertEqual(enrichment.parse_ip('::ffff:10.0.0.1'), (4, 0x0A000001))
+        self.assertEqual(enrichment.parse_ip('fe80::1%eth0'), (6, (0xFE80 << 112) + 1))
+        for value in ('10.0.0.256', 'example.com', '', None):
+            self.assertIsNone(enrichment.parse_ip(value))
+
+    def test_lookup(self):
+        lookup = self.enricher().lookup
+        IPInfo = enrichment.IPInfo
+        self.assertEqual(lookup('203.0.113.5'), IPInfo('cloud', 'Example Cloud', 'US', False))
+        # The most specific network wins
+        self.assertEqual(lookup('203.0.113.200'), IPInfo('vpn', None, 'US', False))
+        self.assertEqual(lookup('10.8.1.1'), IPInfo('vpn', 'Office VPN', None, False))
+        self.assertEqual(lookup('10.9.1.1'), IPInfo('internal', None, None, False))
+        self.assertEqual(lookup('198.51.100.7'), IPInfo('public', None, 'NL', True))
+        self.assertEqual(lookup('198.51.100.8'), IPInfo('public', None, 'NL', False))
+        self.assertEqual(lookup('2001:db8:bad::1'), IPInfo('cloud', 'Example Cloud', 'DE', True))
+        self.assertEqual(lookup('::1'), IPInfo('internal', None, None, False))
+        self.assertIsNone(lookup('unknown'))
+
+    def test_interval_index(self):
+        generator = random.Random(0)
+        ranges = []
+        index = enrichment.IntervalIndex()
+        for number in range(200):
+            first = generator.randrange(1000)
+            last = first + generator.choice([0, 3, 50, 400])
+            ranges.append((first, last, number))
+            index.add(4, first, last, number)
+        index.build()
+        for address in range(1500):
+            # The range starting last wins, then the shortest, then the one added last
+            covering = [item for item in ranges if item[0] <= address <= item[1]]
+            expected = max(covering, key=lambda item: (item[0], -item[1], item[2]))[2] if covering else None
+            self.assertEqual(index.get(4, address), expected, address)
+
+    def test_enrich(self):
+        enricher = self.enricher()
+        tagged = make_log(ip_address='203.0.113.5', ip_network='internal', ip_country='ZZ')
+        entries = [make_log(ip_address='203.0.113.5'), make_log(ip_address='198.51.100.7'), tagged]
+        enricher.enrich(entries)
+        self.assertEqual(
+            [(entry.ip_network, entry.ip_country, entry.ip_blocklisted) for entry in entries],
+            [('cloud', 'US', False), ('public', 'NL', True), ('internal', 'ZZ', False)],
+        )
+
+    def test_missing_files(self):
+        enricher = enrichment.IPEnricher(os.path.join(self.directory.name, 'missing'), 100)
+        self.assertEqual(enricher.lookup('203.0.113.5'), enrichment.IPInfo('public', None, None, False))
+
+    def test_reload(self):
+        with self.settings(AUDIT_IP_DATA_DIR=self.directory.name, AUDIT_IP_DATA_CHECK_INTERVAL=0), \
+                self.assertLogs('logs.enrichment', 'INFO'):
+            self.assertEqual(enrichment.get_ip_enricher().lookup('192.0.2.1').network, 'public')
+            self.write(enrichment.NETWORKS_FILE, ['192.0.2.0/24,partner,Partner'])
+            old = enrichment.get_ip_enricher()
+            for _ in range(100):
+                if enrichment.get_ip_enricher() is not old:
+                    break
+                time.sleep(0.02)
+            self.assertEqual(enrichment.get_ip_enricher().lookup('192.0.2.1').network, 'partner')
+
+    def test_failure_does_not_raise(self):
+        with mock.patch('logs.enrichment.get_ip_enricher', side_effect=OSError('unreadable')), \
+                self.assertLogs('logs.enrichment', 'ERROR'):
+            enrichment.enrich([make_log()])
+
+
+@override_settings(**TEST_SETTINGS)
+class UserAgentSearchTests(TestCase):
+    """Search terms match the interned user agent as well as the identifiers"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('agent-search-staff', is_staff=True)
+        cls.firefox = make_log(actor_username='erin', user_agent='Mozilla/5.0 (X11; Linux) Firefox/131.0')
+        cls.firefox.save()
+        cls.curl = make_log(actor_username='frank', user_agent='curl/8.5.0')
+        cls.curl.save()
+        cls.plain = make_log(actor_username='grace', user_agent='')
+        cls.plain.save()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def search(self, query):
+        data = self.client.get('/api/logs/', {'q': query}).json()
+        return sorted(result['id'] for result in data['results'])
+
+    def test_terms_match_agent_or_identifiers(self):
+        self.assertEqual(self.search('firefox'), [self.firefox.id])
+        self.assertEqual(self.search('erin firefox'), [self.firefox.id])
+        self.assertEqual(self.search('frank Linux'), [])
+        self.assertEqual(self.search('curl 8.5'), [self.curl.id])
+        self.assertEqual(self.search('no-such-agent'), [])
+
+    def test_agents_looked_up_by_id(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.search('erin firefox')
+        searches = [query['sql'] for query in queries if 'FROM "audit_logs"' in query['sql']]
+        self.assertTrue(searches)
+        for sql in searches:
+            self.assertNotIn('IN (SELECT', sql)
+            self.assertIn(f'"agent_id" IN ({self.firefox.agent_id})', sql)
+
+    async def test_async_view(self):
+        request = AsyncRequestFactory().get(
+            '/api/logs/', {'q': 'erin firefox'},
+            headers={'Authorization': f'Bearer {AccessToken.for_user(self.staff)}'},
+        )
+        response = await AsyncAuditLogView.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['id'] for result in json.loads(response.content)['results']], [self.firefox.id])
+
+        request = AsyncRequestFactory().get(
+            f'/api/logs/{self.curl.id}/', {'q': 'curl'},
+            headers={'Authorization': f'Bearer {AccessToken.for_user(self.staff)}'},
+        )
+        response = await AsyncAuditLogView.as_view()(request, pk=self.curl.id)
+        self.assertEqual(response.status_code, 200)
+
+    def test_common_terms_joined(self):
+        with mock.patch('logs.filters.SEARCH_MAX_USER_AGENTS', 1):
+            self.assertEqual(self.search('/'), [self.firefox.id, self.curl.id])
+            self.assertEqual(self.search('frank /'), [self.curl.id])
+
+
+class ExportRangeTests(SimpleTestCase):
+
+    def test_parse_range(self):
+        cases = {
+            None: None,
+            '': None,
+            'bytes=0-99': (0, 99),
+            'bytes=10-': (10, 999),
+            'bytes=990-2000': (990, 999),
+            'bytes=-100': (900, 999),
+            'bytes=-5000': (0, 999),
+            'bytes=-': None,
+            'bytes=0-9,20-29': None,
+            'items=0-9': None,
+        }
+        for header, expected in cases.items():
+            with self.subTest(header=header):
+                self.assertEqual(export_jobs.parse_range(header, 1000), expected)
+        for header in ('bytes=1000-', 'bytes=20-10'):
+            with self.subTest(header=header), self.assertRaises(export_jobs.RangeNotSatisfiable):
+                export_jobs.parse_range(header, 1000)
+
+    def test_split_range(self):
+        start = timezone.now()
+        self.assertEqual(
+            export_jobs.split_range(start, start + timedelta(hours=5), 2, 10),
+            [(start, start + timedelta(hours=2)), (start + timedelta(hours=2), start + timedelta(hours=4)),
+             (start + timedelta(hours=4), start + timedelta(hours=5))],
+        )
+        # Widened to stay within max_shards
+        self.assertEqual(len(export_jobs.split_range(start, start + timedelta(hours=100), 1, 4)), 4)
+        self.assertEqual(export_jobs.split_range(start, start, 1, 4), [(start, start)])
+
+
+@override_settings(
+    **TEST_SETTINGS, AUDIT_EXPORT_SHARD_HOURS=2,
+    STORAGES=dict(settings.STORAGES, audit_exports={'BACKEND': 'django.core.files.storage.InMemoryStorage'}),
+)
+class ExportJobTests(TestCase):
+    """Sharded background exports and resumable downloads"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('export-jobs-staff', is_staff=True)
+        now = timezone.now()
+        for number in range(7):
+            make_log(resource_id=str(number), timestamp=now - timedelta(hours=number, minutes=1)).save()
+
+    def setUp(self):
+        reset_counter_store()
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def start(self, **params):
+        with mock.patch('logs.tasks.export_audit_log_shard.delay', side_effect=export_jobs.run_shard), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/api/logs/export-jobs/?{urlencode(params)}')
+        self.assertEqual(response.status_code, 202)
+        return AuditLogExport.objects.get(pk=response.json()['id'])
+
+    def download(self, job, **headers):
+        response = self.client.get(f'/api/logs/export-jobs/{job.pk}/download/', headers=headers)
+        content = b''.join(response.streaming_content) if response.status_code in (200, 206) else None
+        return response, content
+
+    def test_csv_job(self):
+        job = self.start(resource='Order', ordering='timestamp')
+        self.assertEqual((job.status, job.rows, job.shards_done), ('completed', 7, job.shards))
+        self.assertGreater(job.shards, 3)
+        response, content = self.download(job)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(int(response['Content-Length']), len(content))
+        rows = list(csv.reader(content.decode().splitlines()))
+        # One header, the shards in order
+        self.assertEqual(rows[0][:2], ['ID', 'Username'])
+        self.assertEqual([row[5] for row in rows[1:]], ['6', '5', '4', '3', '2', '1', '0'])
+        log = AuditLog.objects.get(action='EXPORT')
+        self.assertEqual((log.details['export_job'], log.details['exported_count']), (job.pk, 7))
+
+    def test_gzip_job(self):
+        job = self.start(export_format='ndjson', compress='gzip')
+        response, content = self.download(job)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        lines = gzip.decompress(content).splitlines()
+        self.assertEqual([json.loads(line)['resource_id'] for line in lines], [str(number) for number in range(7)])
+
+    def test_ranges(self):
+        job = self.start()
+        _, content = self.download(job)
+        # Ranges spanning shard files
+        for header, expected in (
+            ('bytes=10-', content[10:]),
+            ('bytes=0-0', content[:1]),
+            (f'bytes={job.files[0][1] - 3}-{job.files[0][1] + 3}', content[job.files[0][1] - 3:job.files[0][1] + 4]),
+            ('bytes=-20', content[-20:]),
+        ):
+            with self.subTest(header=header):
+                response, partial = self.download(job, Range=header)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(partial, expected)
+                self.assertEqual(response['Content-Length'], str(len(expected)))
+        response, partial = self.download(job, Range='bytes=10-', **{'If-Range': response['ETag']})
+        self.assertEqual((response.status_code, partial), (206, content[10:]))
+        # A changed export is sent whole
+        response, partial = self.download(job, Range='bytes=10-', **{'If-Range': '"stale"'})
+        self.assertEqual((response.status_code, partial), (200, content))
+        response, _ = self.download(job, Range=f'bytes={len(content)}-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, f'bytes */{len(content)}'))
+
+    def test_own_completed_jobs_only(self):
+        with mock.patch('logs.tasks.export_audit_log_shard.delay'):
+            response = self.client.post('/api/logs/export-jobs/')
+        job = AuditLogExport.objects.get(pk=response.json()['id'])
+        self.assertEqual(job.status, 'pending')
+        self.assertEqual(self.download(job)[0].status_code, 409)
+        self.client.force_authenticate(User.objects.create_user('other-staff', is_staff=True))
+        self.assertEqual(self.download(job)[0].status_code, 404)
+
+    def test_retried_shard_and_revoked_user(self):
+        job = self.start()
+        files = list(job.files)
+        export_jobs.run_shard(job.pk, 0)
+        job.refresh_from_db()
+        self.assertEqual((job.files, job.rows), (files, 7))
+
+        with mock.patch('logs.tasks.export_audit_log_shard.delay'):
+            response = self.client.post('/api/logs/export-jobs/')
+        User.objects.filter(pk=self.staff.pk).update(is_staff=False)
+        export_jobs.run_shard(response.json()['id'], 0)
+        failed = AuditLogExport.objects.get(pk=response.json()['id'])
+        self.assertEqual((failed.status, failed.files[0]), ('failed', None))
+
+    def test_expire(self):
+        job = self.start()
+        storage = export_jobs.get_storage()
+        self.assertTrue(all(storage.exists(name) for name, _ in job.files))
+        AuditLogExport.objects.filter(pk=job.pk).update(created_at=timezone.now() - timedelta(days=2))
+        self.assertEqual(export_jobs.expire_jobs(), 1)
+        self.assertFalse(any(storage.exists(name) for name, _ in job.files))
+        self.assertFalse(AuditLogExport.objects.exists())
+
+
+@override_settings(**TEST_SETTINGS)
+class StatisticsTests(TestCase):
+    """Top actions and IPs rank over the requested range, not just the last week"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('statistics-staff', is_staff=True)
+        now = timezone.now()
+        for _ in range(4):
+            make_log(ip_address='10.6.0.1', timestamp=now - timedelta(days=20), details={'method': 'POST'}).save()
+        for _ in range(2):
+            make_log(ip_address='10.6.0.2', timestamp=now - timedelta(hours=1), details={'method': 'POST'}).save()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def top_ips(self, **params):
+        data = self.client.get('/api/logs/statistics/', params).json()
+        return [(row['ip_address'], row['count']) for row in data['top_ips']]
+
+    def test_top_ips(self):
+        for params in ({}, {'details.method': 'POST'}):
+            with self.subTest(**params):
+                self.assertEqual(self.top_ips(**params), [('10.6.0.1', 4), ('10.6.0.2', 2)])
+                start = (timezone.now() - timedelta(days=2)).isoformat()
+                self.assertEqual(self.top_ips(start_date=start, **params), [('10.6.0.2', 2)])
+
+
+@override_settings(**TEST_SETTINGS)
+class MetricsFlushTests(SimpleTestCase):
+    """Increments reach the counter store from a background thread, never from the caller"""
+
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+        self.registry.flush_interval = 60
+        self.addCleanup(self.registry._stopped.set)
+        self.histogram = metrics.Histogram('test_seconds', 'Test', registry=self.registry)
+        self.store = mock.Mock()
+        self.flushed_by = []
+        self.flushed = threading.Event()
+
+        def incr_fields(key, deltas):
+            self.flushed_by.append(threading.current_thread())
+            self.flushed.set()
+
+        self.store.incr_fields.side_effect = incr_fields
+
+    def test_observe_does_not_flush(self):
+        with mock.patch('logs.metrics.get_counter_store', return_value=self.store), \
+                mock.patch('logs.metrics.atexit.register') as register:
+            self.histogram.observe(0.2)
+            self.store.incr_fields.assert_not_called()
+            self.assertTrue(self.registry._flusher.is_alive())
+            register.assert_called_once_with(self.registry.stop)
+
+            self.registry.stop()
+        self.assertEqual(self.store.incr_fields.call_count, 1)
+        self.assertEqual(self.store.incr_fields.call_args.args[1]['test_seconds_count'], 1)
+
+    def test_flushes_in_background(self):
+        self.registry.flush_interval = 0.01
+        with mock.patch('logs.metrics.get_counter_store', return_value=self.store), \
+                mock.patch('logs.metrics.atexit.register'):
+            self.histogram.observe(0.2)
+            self.assertTrue(self.flushed.wait(5))
+        self.assertIs(self.flushed_by[0], self.registry._flusher)
+
+    def test_no_exit_flush_with_local_store(self):
+        reset_counter_store()
+        with mock.patch('logs.metrics.atexit.register') as register:
+            self.histogram.observe(0.2)
+        register.assert_not_called()
+
+    def test_store_errors_logged_without_traceback(self):
+        self.store.incr_fields.side_effect = ConnectionError('Connection refused')
+        with mock.patch('logs.metrics.get_counter_store', return_value=self.store), \
+                mock.patch('logs.metrics.atexit.register'), \
+                self.assertLogs('logs.metrics', 'WARNING') as logs:
+            self.histogram.observe(0.2)
+            self.registry.stop()
+        self.assertEqual(logs.records[0].getMessage(), 'Could not flush 3 metric series: Connection refused')
+        self.assertIsNone(logs.records[0].exc_info)
@@ -1,10 +1,20 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import AuditLogViewSet
+from .views import AsyncAuditLogView, AuditLogViewSet, live_tail, metrics_view
 
 router = DefaultRouter()
 router.register(r'logs', AuditLogViewSet, basename='auditlog')
 
 urlpatterns = [
+    path('api/logs/live/', live_tail, name='auditlog-live'),
+    path('metrics', metrics_view, name='metrics'),
     path('api/', include(router.urls)),
-]
\ No newline at end of file
+]
+
+if settings.AUDIT_ASYNC_VIEWS:
+    # Served ahead of the router's list and detail routes
+    urlpatterns[1:1] = [
+        path('api/logs/', AsyncAuditLogView.as_view(), name='auditlog-list-async'),
+        path('api/logs/<int:pk>/', AsyncAuditLogView.as_view(), name='auditlog-detail-async'),
+    ]
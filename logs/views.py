@@ -1,142 +1,823 @@
-import csv
+import asyncio
+import hmac
+import json
 from datetime import datetime, timedelta
-from django.http import HttpResponse
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpRequest, HttpResponse, JsonResponse, QueryDict, StreamingHttpResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from django.db.models import Q, Count
 from django.utils import timezone
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import APIException
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import filters
 
-from .models import AuditLog
-from .serializers import AuditLogSerializer, AuditLogCreateSerializer
+from . import chain, export_jobs, ingest, live, metrics, rollups, sketches
+from .exporters import EXPORT_FORMATS, ExportCounter, stream_export
+from .filters import AuditLogOrderingFilter, AuditLogSearchFilter, DetailsFilterBackend
+from .models import TRIGRAM_SEARCH_FIELDS, AuditLog, AuditLogExport
+from .pagination import AuditLogPagination
+from .parsers import NDJSONParser
+from .serializers import AuditLogSerializer, AuditLogCreateSerializer, AuditLogExportSerializer
 from .permissions import AuditLogPermission
 
 class AuditLogViewSet(viewsets.ModelViewSet):
     serializer_class = AuditLogSerializer
     permission_classes = [IsAuthenticated, AuditLogPermission]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
-    filterset_fields = ['action', 'severity', 'resource']
-    search_fields = ['user__username', 'resource', 'ip_address']
+    pagination_class = AuditLogPagination
+    filter_backends = [
+        DjangoFilterBackend, DetailsFilterBackend, AuditLogSearchFilter, AuditLogOrderingFilter
+    ]
+    filterset_fields = [
+        'action', 'severity', 'resource', 'resource_id', 'session_id',
+        'ip_network', 'ip_country', 'ip_blocklisted',
+    ]
+    search_fields = TRIGRAM_SEARCH_FIELDS
     ordering_fields = ['timestamp', 'severity']
     ordering = ['-timestamp']
+    timeseries_dimensions = ['action', 'severity', 'resource']
     
     def get_queryset(self):
-        queryset = AuditLog.objects.select_related('user')
+        # Usernames and emails come from the actor snapshot, no user join
+        queryset = AuditLog.objects.all()
         
         # Admins see all logs, users see only their own
         if not self.request.user.is_staff:
             queryset = queryset.filter(user=self.request.user)
         
-        # Date range filtering
-        start_date = self.request.query_params.get('start_date')
-        end_date = self.request.query_params.get('end_date')
+        # Date range filtering (lets PostgreSQL prune timestamp partitions)
+        start_date, end_date = self.get_date_range()
         
         if start_date:
-            try:
-                start_date = datetime.fromisoformat(start_date)
-                queryset = queryset.filter(timestamp__gte=start_date)
-            except ValueError:
-                pass
+            queryset = queryset.filter(timestamp__gte=start_date)
         
         if end_date:
-            try:
-                end_date = datetime.fromisoformat(end_date)
-                queryset = queryset.filter(timestamp__lte=end_date)
-            except ValueError:
-                pass
+            queryset = queryset.filter(timestamp__lte=end_date)
+        
+        if self.action in ('list', 'retrieve'):
+            # The serializer shows the user agent string and what was parsed from it
+            queryset = queryset.select_related('agent')
         
         return queryset
     
+    def get_date_range(self):
+        """Parse the start_date/end_date query params into aware datetimes"""
+        dates = []
+        for param in ('start_date', 'end_date'):
+            value = self.request.query_params.get(param)
+            try:
+                value = datetime.fromisoformat(value) if value else None
+            except ValueError:
+                value = None
+            if value and timezone.is_naive(value):
+                value = timezone.make_aware(value)
+            dates.append(value)
+        return tuple(dates)
+    
     def get_serializer_class(self):
         if self.action == 'create':
             return AuditLogCreateSerializer
         return AuditLogSerializer
     
+    async def adispatch(self, request, *args, **kwargs):
+        """
+        ``dispatch()`` for the async handlers below (``a`` + action name).
+        
+        Authentication, permissions and throttling run in one thread hop;
+        the handlers await their queries and leave the event loop free.
+        """
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            response = await getattr(self, f'a{self.action}')(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+    
+    async def alist(self, request, *args, **kwargs):
+        # Filters may query while building (the search looks up user agents)
+        queryset = await sync_to_async(self.filter_queryset)(self.get_queryset())
+        page = await self.paginator.apaginate_queryset(queryset, request, view=self)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        
+        serializer = self.get_serializer([obj async for obj in queryset], many=True)
+        return Response(serializer.data)
+    
+    async def aretrieve(self, request, *args, **kwargs):
+        instance = await self.aget_object()
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
+    
+    async def acreate(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        await serializer.asave()
+        headers = self.get_success_headers(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+    
+    async def aget_object(self):
+        queryset = await sync_to_async(self.filter_queryset)(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            obj = await queryset.aget(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        except (AuditLog.DoesNotExist, TypeError, ValueError, ValidationError):
+            raise Http404
+        
+        self.check_object_permissions(self.request, obj)
+        return obj
+    
     @action(detail=False, methods=['get'])
     def export(self, request):
-        """Export logs to CSV - Admin only"""
+        """
+        Stream logs as CSV or NDJSON - Admin only
+        
+        Query params:
+        - export_format: csv (default) or ndjson
+        - compress: gzip to compress the stream on the fly
+        """
         if not request.user.is_staff:
             return Response(
                 {'error': 'Only administrators can export logs'}, 
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = f'attachment; filename="audit_logs_{timezone.now().date()}.csv"'
+        export_format = request.query_params.get('export_format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            return Response(
+                {'error': f'Unsupported export format: {export_format}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        compress = request.query_params.get('compress') == 'gzip'
         
-        writer = csv.writer(response)
-        writer.writerow([
-            'ID', 'Username', 'Email', 'Action', 'Resource', 'Resource ID',
-            'IP Address', 'Timestamp', 'Severity', 'Details'
-        ])
+        content_type, extension = EXPORT_FORMATS[export_format]
+        filename = f'audit_logs_{timezone.now().date()}.{extension}'
+        if compress:
+            content_type = 'application/gzip'
+            filename += '.gz'
         
         queryset = self.filter_queryset(self.get_queryset())
-        for log in queryset:
-            writer.writerow([
-                log.id,
-                log.user.username if log.user else 'Anonymous',
-                log.user.email if log.user else '',
-                log.action,
-                log.resource,
-                log.resource_id or '',
-                log.ip_address,
-                log.timestamp.isoformat(),
-                log.severity,
-                str(log.details)
-            ])
-        
-        # Log the export action
-        AuditLog.log_action(
+        user = request.user
+        ip_address = self.get_client_ip(request)
+        filters = request.query_params.dict()
+        
+        def log_export(exported_count, completed):
+            # Log the export once the stream ends, also when it was cut short
+            AuditLog.log_action(
+                user=user,
+                action='EXPORT',
+                resource='AuditLog',
+                ip_address=ip_address,
+                details={
+                    'exported_count': exported_count,
+                    'completed': completed,
+                    'format': export_format,
+                    'filters': filters,
+                }
+            )
+        
+        response = StreamingHttpResponse(
+            stream_export(
+                queryset, export_format, ExportCounter(),
+                compress=compress, on_close=log_export
+            ),
+            content_type=content_type
+        )
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+    
+    # Query params of the list that do not select logs
+    JOB_PARAMS = ('export_format', 'compress', 'ordering', 'page', 'cursor', 'pagination', 'format')
+    
+    @classmethod
+    def filtered_queryset(cls, user, params):
+        """
+        The list of ``user`` filtered by ``params`` (``{name: [values]}``
+        query params), outside of a request, for background exports
+        """
+        http_request = HttpRequest()
+        http_request.method = 'GET'
+        http_request.GET = QueryDict(mutable=True)
+        for key, values in params.items():
+            http_request.GET.setlist(key, values)
+        request = Request(http_request)
+        request.user = user
+        view = cls(request=request, action='export', args=(), kwargs={}, format_kwarg=None)
+        return view.filter_queryset(view.get_queryset())
+    
+    @action(detail=False, methods=['get', 'post'], url_path='export-jobs')
+    def export_jobs(self, request):
+        """
+        Background exports - Admin only
+        
+        GET lists your exports, newest first. POST starts one for the
+        filters of the list (query params, as for export) and answers 202
+        with the job; poll its status and download it once completed.
+        
+        Query params of POST:
+        - export_format: csv (default), ndjson or parquet (with pyarrow)
+        - compress: gzip to compress CSV and NDJSON
+        - ordering: -timestamp (default) or timestamp
+        """
+        if request.method == 'GET':
+            jobs = AuditLogExport.objects.filter(user=request.user)
+            page = self.paginate_queryset(jobs)
+            serializer = AuditLogExportSerializer(page, many=True, context=self.get_serializer_context())
+            return self.get_paginated_response(serializer.data)
+        
+        formats = export_jobs.job_formats()
+        export_format = request.query_params.get('export_format', 'csv')
+        if export_format not in formats:
+            return Response(
+                {'error': f'Unsupported export format: {export_format}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        ordering = request.query_params.get('ordering', '-timestamp')
+        if ordering not in ('timestamp', '-timestamp'):
+            return Response(
+                {'error': 'ordering must be timestamp or -timestamp'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        start_date, end_date = self.get_date_range()
+        job = export_jobs.create_job(
             user=request.user,
-            action='EXPORT',
-            resource='AuditLog',
             ip_address=self.get_client_ip(request),
-            details={'exported_count': queryset.count()}
+            queryset=self.filter_queryset(self.get_queryset()),
+            params={
+                key: request.query_params.getlist(key)
+                for key in request.query_params if key not in self.JOB_PARAMS
+            },
+            start=start_date,
+            end=end_date,
+            export_format=export_format,
+            compress=request.query_params.get('compress') == 'gzip',
+            descending=ordering == '-timestamp',
         )
+        serializer = AuditLogExportSerializer(job, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+    
+    def get_export_job(self, job_id):
+        """An export of the requesting user"""
+        try:
+            return AuditLogExport.objects.get(pk=job_id, user=self.request.user)
+        except AuditLogExport.DoesNotExist:
+            raise Http404
+    
+    @action(detail=False, methods=['get'], url_path=r'export-jobs/(?P<job_id>\d+)')
+    def export_job(self, request, job_id=None):
+        """Status and progress of a background export - Admin only"""
+        job = self.get_export_job(job_id)
+        return Response(AuditLogExportSerializer(job, context=self.get_serializer_context()).data)
+    
+    @action(detail=False, methods=['get'], url_path=r'export-jobs/(?P<job_id>\d+)/download')
+    def export_job_download(self, request, job_id=None):
+        """
+        Download a completed background export - Admin only
+        
+        Supports a single byte Range (with If-Range) so an interrupted
+        download can resume where it stopped.
+        """
+        job = self.get_export_job(job_id)
+        if job.status != export_jobs.COMPLETED:
+            return Response(
+                {'error': f'The export is {job.status}'},
+                status=status.HTTP_409_CONFLICT
+            )
         
+        etag = f'"{job.pk}-{job.size}-{int(job.completed_at.timestamp())}"'
+        byte_range = None
+        if_range = request.headers.get('If-Range')
+        if not if_range or if_range == etag:
+            try:
+                byte_range = export_jobs.parse_range(request.headers.get('Range'), job.size)
+            except export_jobs.RangeNotSatisfiable:
+                response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+                response['Content-Range'] = f'bytes */{job.size}'
+                return response
+        first, last = byte_range or (0, job.size - 1)
+        
+        response = StreamingHttpResponse(
+            export_jobs.iter_range(job, first, last),
+            content_type=export_jobs.content_type(job),
+            status=status.HTTP_206_PARTIAL_CONTENT if byte_range else status.HTTP_200_OK,
+        )
+        if byte_range:
+            response['Content-Range'] = f'bytes {first}-{last}/{job.size}'
+        response['Content-Length'] = str(last - first + 1)
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = etag
+        response['Content-Disposition'] = f'attachment; filename="{export_jobs.filename(job)}"'
         return response
     
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser, NDJSONParser])
+    def bulk(self, request):
+        """
+        Store many events in one request
+        
+        Body: a JSON array of events or NDJSON (application/x-ndjson), each
+        with the fields of a single create. Staff may also set timestamp,
+        ip_address, user_agent, severity, session_id, username and user_email.
+        
+        Query params:
+        - mode: partial (default) stores the valid events and reports the
+          others; atomic stores nothing unless every event is stored
+        """
+        items = request.data
+        if not isinstance(items, list):
+            return Response(
+                {'error': 'Expected a JSON array or NDJSON body'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(items) > settings.AUDIT_BULK_INGEST_MAX_ITEMS:
+            return Response(
+                {'error': f'At most {settings.AUDIT_BULK_INGEST_MAX_ITEMS} events per request'},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+        mode = request.query_params.get('mode', settings.AUDIT_BULK_INGEST_MODE)
+        if mode not in ingest.MODES:
+            return Response(
+                {'error': f'mode must be one of {", ".join(ingest.MODES)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        result = ingest.ingest(
+            items,
+            user=request.user,
+            ip_address=self.get_client_ip(request),
+            mode=mode,
+            allow_provenance=request.user.is_staff,
+        )
+        if not result.errors:
+            response_status = status.HTTP_201_CREATED
+        elif result.inserted:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response(result.as_dict(), status=response_status)
+    
     @action(detail=False, methods=['get'])
     def statistics(self, request):
-        """Get log statistics - Admin only"""
+        """
+        Get log statistics - Admin only
+        
+        Accepts start_date/end_date and the details.<key> filters of the list
+        """
         if not request.user.is_staff:
             return Response(
                 {'error': 'Only administrators can view statistics'}, 
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        queryset = self.get_queryset()
+        start_date, end_date = self.get_date_range()
         now = timezone.now()
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        week_ago = now - timedelta(days=7)
+        
+        def since(value):
+            return max(value, start_date) if start_date else value
         
+        def distinct(queryset, field, start):
+            return queryset.filter(timestamp__gte=start).aggregate(
+                count=Count(field, distinct=True)
+            )['count']
+        
+        if DetailsFilterBackend.has_filters(request):
+            # details are not a rollup dimension; count the matching logs
+            # directly, through the details indexes
+            queryset = DetailsFilterBackend().filter_queryset(
+                request, self.get_queryset(), self
+            ).order_by()
+            return Response({
+                'total_logs': queryset.count(),
+                'logs_today': queryset.filter(timestamp__gte=since(today)).count(),
+                'logs_this_week': queryset.filter(timestamp__gte=since(week_ago)).count(),
+                'failed_logins_today': queryset.filter(
+                    action='FAILED_LOGIN', timestamp__gte=since(today)
+                ).count(),
+                'unique_ips_today': distinct(queryset, 'ip_address', since(today)),
+                'unique_ips_this_week': distinct(queryset, 'ip_address', since(week_ago)),
+                'unique_users_today': distinct(queryset, 'user', since(today)),
+                'unique_users_this_week': distinct(queryset, 'user', since(week_ago)),
+                'top_actions': list(
+                    queryset.values('action')
+                    .annotate(count=Count('id'))
+                    .order_by('-count')[:5]
+                ),
+                'top_ips': list(
+                    queryset.values('ip_address')
+                    .annotate(count=Count('id'))
+                    .order_by('-count')[:10]
+                )
+            })
+        
+        # Counts come from the rollup tables; see logs.rollups
         stats = {
-            'total_logs': queryset.count(),
-            'logs_today': queryset.filter(timestamp__date=now.date()).count(),
-            'logs_this_week': queryset.filter(timestamp__gte=now - timedelta(days=7)).count(),
-            'failed_logins_today': queryset.filter(
-                action='FAILED_LOGIN',
-                timestamp__date=now.date()
-            ).count(),
-            'top_actions': list(
-                queryset.values('action')
-                .annotate(count=Count('action'))
-                .order_by('-count')[:5]
+            'total_logs': rollups.count_logs(start_date, end_date),
+            'logs_today': rollups.count_logs(since(today), end_date),
+            'logs_this_week': rollups.count_logs(since(week_ago), end_date),
+            'failed_logins_today': rollups.count_logs(
+                since(today), end_date, action='FAILED_LOGIN'
             ),
-            'top_ips': list(
-                queryset.values('ip_address')
-                .annotate(count=Count('ip_address'))
-                .order_by('-count')[:10]
-            )
+            # Estimated from the distinct count sketches; see logs.sketches
+            'unique_ips_today': sketches.distinct_count('ip_address', since(today), end_date),
+            'unique_ips_this_week': sketches.distinct_count('ip_address', since(week_ago), end_date),
+            'unique_users_today': sketches.distinct_count('user', since(today), end_date),
+            'unique_users_this_week': sketches.distinct_count('user', since(week_ago), end_date),
+            'top_actions': rollups.top_values('action', 5, start_date, end_date),
+            # Ranked from the top value sketches; see logs.sketches
+            'top_ips': sketches.top_values('ip_address', 10, start_date, end_date),
         }
         
         return Response(stats)
     
+    @action(detail=False, methods=['get'])
+    def timeseries(self, request):
+        """
+        Get bucketed log counts for charts - Admin only
+        
+        Query params:
+        - start_date/end_date: defaults to the last 24 hours
+        - interval: 1m, 5m, 15m, 1h, 6h, 1d or 7d (widened to fit max_points)
+        - max_points: maximum number of buckets, default 500
+        - group_by: action, severity or resource
+        - action/severity/resource: only count matching logs
+        """
+        if not request.user.is_staff:
+            return Response(
+                {'error': 'Only administrators can view statistics'}, 
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        start_date, end_date = self.get_date_range()
+        end_date = end_date or timezone.now()
+        start_date = start_date or end_date - timedelta(days=1)
+        if start_date >= end_date:
+            return Response(
+                {'error': 'start_date must be before end_date'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        group_by = request.query_params.get('group_by')
+        if group_by and group_by not in self.timeseries_dimensions:
+            return Response(
+                {'error': f'group_by must be one of {", ".join(self.timeseries_dimensions)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            max_points = min(max(int(request.query_params.get('max_points', 500)), 1), 5000)
+        except ValueError:
+            max_points = 500
+        
+        filters = {
+            field: request.query_params[field]
+            for field in self.timeseries_dimensions
+            if request.query_params.get(field)
+        }
+        interval, points = rollups.time_series(
+            start_date, end_date,
+            interval=request.query_params.get('interval'),
+            group_by=group_by,
+            max_points=max_points,
+            **filters
+        )
+        
+        return Response({
+            'interval': interval,
+            'start_date': start_date,
+            'end_date': end_date,
+            'points': points,
+        })
+    
+    @action(detail=False, methods=['get'])
+    def distinct(self, request):
+        """
+        Estimated number of distinct IPs or users - Admin only
+        
+        Query params:
+        - field: ip_address (default) or user
+        - start_date/end_date: defaults to the last 24 hours
+        - interval: hour or day, to also get one estimate per bucket
+        - user: a user id, to count the IPs of one user
+        """
+        if not request.user.is_staff:
+            return Response(
+                {'error': 'Only administrators can view statistics'}, 
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        start_date, end_date = self.get_date_range()
+        end_date = end_date or timezone.now()
+        start_date = start_date or end_date - timedelta(days=1)
+        if start_date >= end_date:
+            return Response(
+                {'error': 'start_date must be before end_date'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        field = request.query_params.get('field', 'ip_address')
+        interval = request.query_params.get('interval')
+        if interval and interval not in dict(sketches.GRANULARITIES):
+            return Response(
+                {'error': f'interval must be one of {", ".join(dict(sketches.GRANULARITIES))}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        user = request.query_params.get('user')
+        if user is not None and not user.isdigit():
+            return Response(
+                {'error': 'user must be a user id'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        user = int(user) if user is not None else None
+        
+        try:
+            data = {
+                'field': field,
+                'start_date': start_date,
+                'end_date': end_date,
+                'count': sketches.distinct_count(field, start_date, end_date, user=user),
+                'standard_error': sketches.STANDARD_ERROR,
+            }
+            if interval:
+                data['points'] = sketches.distinct_series(
+                    field, start_date, end_date, granularity=interval, user=user
+                )
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(data)
+    
+    @action(detail=False, methods=['get'])
+    def top(self, request):
+        """
+        Most frequent IPs, users, resources or user agents - Admin only
+        
+        Query params:
+        - field: ip_address (default), user, resource or user_agent
+        - start_date/end_date: defaults to the last 24 hours
+        - limit: number of values, default 10
+        
+        Counts are lower bounds: each true count is at most count + error.
+        """
+        if not request.user.is_staff:
+            return Response(
+                {'error': 'Only administrators can view statistics'}, 
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        start_date, end_date = self.get_date_range()
+        end_date = end_date or timezone.now()
+        start_date = start_date or end_date - timedelta(days=1)
+        if start_date >= end_date:
+            return Response(
+                {'error': 'start_date must be before end_date'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 100)
+        except ValueError:
+            limit = 10
+        
+        field = request.query_params.get('field', 'ip_address')
+        try:
+            summary = sketches.heavy_hitters(field, start_date, end_date)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        return Response({
+            'field': field,
+            'start_date': start_date,
+            'end_date': end_date,
+            'error': summary.error,
+            'values': [
+                {field: sketches.field_value(field, value), 'count': count}
+                for value, count in summary.top(limit)
+            ],
+        })
+    
+    @action(detail=True, methods=['get'])
+    def proof(self, request, pk=None):
+        """
+        Inclusion proof that this log is part of a sealed checkpoint
+        
+        Recompute the root from leaf_hash and audit_path as described in
+        logs.chain and compare it with checkpoint.merkle_root.
+        """
+        proof = chain.build_proof(self.get_object())
+        if proof is None:
+            return Response(
+                {'error': 'This log has not been sealed into a checkpoint yet'},
+                status=status.HTTP_409_CONFLICT
+            )
+        return Response(proof)
+    
     def get_client_ip(self, request):
         x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
         if x_forwarded_for:
             ip = x_forwarded_for.split(',')[0]
         else:
             ip = request.META.get('REMOTE_ADDR')
-        return ip
\ No newline at end of file
+        return ip
+
+
+class AsyncAuditLogView(View):
+    """
+    Async list, retrieve and create of audit logs for ASGI deployments
+    (``AUDIT_ASYNC_VIEWS``). The viewset's async handlers serve JSON
+    clients; other methods and the browsable API go to the regular views.
+    """
+    list_view = staticmethod(AuditLogViewSet.as_view({'get': 'list', 'post': 'create'}))
+    detail_view = staticmethod(AuditLogViewSet.as_view({
+        'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy'
+    }))
+    
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Token authenticated like the DRF views, which are CSRF exempt too
+        return csrf_exempt(super().as_view(**initkwargs))
+    
+    async def get(self, request, pk=None):
+        if self.wants_browsable_api(request):
+            return await self.fallback(request, pk)
+        return await self.run(request, 'list' if pk is None else 'retrieve', pk)
+    
+    async def post(self, request, pk=None):
+        if pk is not None or self.wants_browsable_api(request):
+            return await self.fallback(request, pk)
+        return await self.run(request, 'create', pk)
+    
+    async def put(self, request, pk=None):
+        return await self.fallback(request, pk)
+    
+    patch = delete = options = put
+    
+    def wants_browsable_api(self, request):
+        return 'text/html' in request.headers.get('Accept', '') or 'format' in request.GET
+    
+    async def run(self, request, action, pk):
+        viewset = AuditLogViewSet()
+        viewset.action_map = {request.method.lower(): action}
+        viewset.renderer_classes = [JSONRenderer]
+        kwargs = {} if pk is None else {'pk': pk}
+        response = await viewset.adispatch(request, **kwargs)
+        # Rendered here: Django would otherwise render a DRF response in a thread
+        response.render()
+        return HttpResponse(response.content, status=response.status_code, headers=response.headers)
+    
+    async def fallback(self, request, pk):
+        if pk is None:
+            return await sync_to_async(self.list_view)(request)
+        return await sync_to_async(self.detail_view)(request, pk=pk)
+
+
+LIVE_TAIL_FILTERS = {
+    # query param: event field
+    'action': 'action',
+    'severity': 'severity',
+    'resource': 'resource',
+    'username': 'username',
+    'user_id': 'user_id',
+    'ip_network': 'ip_network',
+    'ip_country': 'ip_country',
+}
+
+
+@sync_to_async
+def _authenticate(request):
+    """Run the API's authentication classes, falling back to the session"""
+    drf_request = Request(
+        request,
+        authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+    )
+    try:
+        user = drf_request.user
+    except APIException:
+        return None
+    if not user.is_authenticated:
+        user = request.user
+    return user if user.is_authenticated else None
+
+
+@sync_to_async
+def _replay(filters, after_id, limit):
+    """Logs written after ``after_id`` that the client missed while reconnecting"""
+    queryset = AuditLog.objects.filter(id__gt=after_id).order_by('id')
+    for field in LIVE_TAIL_FILTERS.values():
+        if field in filters:
+            lookup = 'actor_username' if field == 'username' else field
+            queryset = queryset.filter(**{f'{lookup}__in': filters[field]})
+    return [live.serialize_event(entry) for entry in queryset[:limit]]
+
+
+def _sse(event):
+    return f"id: {event['id']}\nevent: audit_log\ndata: {json.dumps(event, default=str)}\n\n"
+
+
+async def live_tail(request):
+    """
+    Stream new audit logs as server-sent events
+    
+    Query params (comma separated lists):
+    - action, severity, resource, username, user_id, ip_network, ip_country
+    
+    Regular users only receive their own logs. Reconnecting clients send
+    Last-Event-ID (or ?last_event_id=) and get the logs they missed first.
+    """
+    if not isinstance(request, ASGIRequest):
+        # Under WSGI the stream would hold a worker thread for as long as
+        # the client stays connected
+        return JsonResponse(
+            {'detail': 'The live tail is only served under ASGI (e.g. uvicorn).'}, status=501
+        )
+    
+    user = await _authenticate(request)
+    if user is None:
+        return JsonResponse(
+            {'detail': 'Authentication credentials were not provided.'}, status=401
+        )
+    
+    filters = {}
+    for param, field in LIVE_TAIL_FILTERS.items():
+        values = [value for value in request.GET.get(param, '').split(',') if value]
+        if values:
+            filters[field] = set(values)
+    try:
+        if 'user_id' in filters:
+            filters['user_id'] = {int(value) for value in filters['user_id']}
+        last_event_id = int(
+            request.headers.get('Last-Event-ID') or request.GET.get('last_event_id') or 0
+        )
+    except ValueError:
+        return JsonResponse({'error': 'user_id and Last-Event-ID must be integers'}, status=400)
+    
+    # Same rule as AuditLogPermission: users only see their own logs
+    if not user.is_staff:
+        filters['user_id'] = {user.id}
+    
+    hub = live.get_hub()
+    subscription = hub.subscribe(filters)
+    heartbeat = settings.AUDIT_LIVE_TAIL_HEARTBEAT
+    
+    async def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            last_id = last_event_id
+            if last_event_id:
+                for event in await _replay(filters, last_event_id, settings.AUDIT_LIVE_TAIL_REPLAY_LIMIT):
+                    last_id = max(last_id, event['id'])
+                    yield _sse(event)
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.get(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    yield ': keep-alive\n\n'
+                    continue
+                if subscription.lagged:
+                    subscription.lagged = False
+                    yield 'event: lagged\ndata: {}\n\n'
+                if event.get('id') is not None and event['id'] <= last_id:
+                    continue  # already sent by the replay
+                yield _sse(event)
+        finally:
+            hub.unsubscribe(subscription)
+    
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def metrics_view(request):
+    """
+    Metrics in the Prometheus text format, for scrapers sending
+    AUDIT_METRICS_TOKEN as a bearer token and for signed-in staff. Without
+    a token configured only staff can read them.
+    """
+    if not metrics.REGISTRY.enabled:
+        raise Http404
+    token = settings.AUDIT_METRICS_TOKEN
+    scraper = bool(token) and hmac.compare_digest(
+        request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()
+    )
+    if not scraper and not request.user.is_staff:
+        return HttpResponse(status=401, headers={'WWW-Authenticate': 'Bearer'})
+    return HttpResponse(metrics.render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,389 @@
+import atexit
+import io
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def store_entries(entries):
+    """
+    Tag and hash ``entries`` and insert them with one ``bulk_create``.
+    Raises if the insert fails, in which case no entry was stored.
+    """
+    from . import agents, enrichment
+    from .models import AuditLog
+
+    agents.intern(entries)
+    enrichment.enrich(entries)
+    for entry in entries:
+        if not entry.entry_hash:
+            entry.entry_hash = entry.compute_entry_hash()
+    AuditLog.objects.bulk_create(entries)
+    return entries
+
+
+def dispatch_entries(entries):
+    """
+    Publish stored ``entries`` to the live tail and run the detection rules
+    on them. Never raises: the entries are stored whatever happens here.
+    """
+    from . import live, security
+
+    try:
+        live.publish(entries)
+        security.detect(entries)
+    except Exception:
+        logger.exception('Dispatching %d stored audit log(s) failed', len(entries))
+
+
+def insert_entries(entries):
+    """
+    ``store_entries`` then ``dispatch_entries``; raises if the insert fails
+    """
+    store_entries(entries)
+    dispatch_entries(entries)
+    return entries
+
+
+COPY_CHUNK_SIZE = 1000
+
+
+def _copy_text(value):
+    """Encode one value for ``COPY ... FROM STDIN`` in text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    value = value.isoformat() if isinstance(value, datetime) else str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_entries(entries):
+    """
+    Tag and hash ``entries`` and load them with PostgreSQL ``COPY``.
+
+    Much faster than ``insert_entries`` for large loads, but ids are not set
+    on the instances, nothing is published to the live tail and no
+    detection rule sees the entries. Meant for seeding and offline imports.
+    """
+    from .agents import intern
+    from .enrichment import enrich
+    from .models import AuditLog
+
+    fields = [field for field in AuditLog._meta.concrete_fields if not field.primary_key]
+    encoders = []
+    for field in fields:
+        if field.get_internal_type() == 'JSONField':
+            encoders.append(lambda value, encoder=field.encoder: json.dumps(value, cls=encoder))
+        else:
+            encoders.append(field.get_prep_value)
+
+    buffer = io.StringIO()
+    count = 0
+    entries = iter(entries)
+    # User agents are interned per chunk, to store new ones in one query
+    while chunk := list(itertools.islice(entries, COPY_CHUNK_SIZE)):
+        intern(chunk)
+        enrich(chunk)
+        for entry in chunk:
+            count += 1
+            if not entry.entry_hash:
+                entry.entry_hash = entry.compute_entry_hash()
+            buffer.write('\t'.join(
+                _copy_text(encode(getattr(entry, field.attname)))
+                for field, encode in zip(fields, encoders)
+            ))
+            buffer.write('\n')
+    buffer.seek(0)
+
+    quote_name = connection.ops.quote_name
+    columns = ', '.join(quote_name(field.column) for field in fields)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f'COPY {quote_name(AuditLog._meta.db_table)} ({columns}) FROM STDIN', buffer
+        )
+    return count
+
+
+class BaseAuditWriter:
+    """
+    Base class for audit log writers.
+
+    A writer receives unsaved ``AuditLog`` instances from
+    ``AuditLog.log_action`` and is responsible for persisting them.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+        self._counters = {
+            'submitted': 0,
+            'written': 0,
+            'dropped': 0,
+            'failed': 0,
+            'batches': 0,
+        }
+        self._counters_lock = threading.Lock()
+
+    def submit(self, entry):
+        raise NotImplementedError
+
+    async def asubmit(self, entry):
+        """``submit`` for async callers; runs it in a thread unless overridden"""
+        return await sync_to_async(self.submit)(entry)
+
+    def flush(self, timeout=None):
+        """Block until everything submitted so far has been written"""
+
+    def close(self):
+        """Flush pending entries and release resources"""
+        self.flush()
+
+    def stats(self):
+        with self._counters_lock:
+            return dict(self._counters)
+
+    def _incr(self, name, amount=1):
+        with self._counters_lock:
+            self._counters[name] += amount
+        if name != 'batches':
+            metrics.WRITER_ENTRIES.inc(amount, name)
+
+    def _observe_batch(self, batch, elapsed):
+        metrics.WRITE_SECONDS.observe(elapsed)
+        metrics.WRITE_BATCH_SIZE.observe(len(batch))
+        lag = (timezone.now() - min(entry.timestamp for entry in batch)).total_seconds()
+        metrics.WRITE_LAG_SECONDS.observe(lag)
+        metrics.log_event(
+            'audit_write', writer=type(self).__name__, entries=len(batch),
+            duration_ms=round(elapsed * 1000, 3), lag_ms=round(lag * 1000, 3),
+        )
+
+    def _write_batch(self, batch):
+        """Insert a batch with one query, falling back to row inserts on error"""
+        started = time.perf_counter()
+        try:
+            store_entries(batch)
+        except Exception:
+            # Nothing was stored, so every entry can be retried
+            logger.exception('Bulk insert of %d audit logs failed, retrying one by one', len(batch))
+            connection.close_if_unusable_or_obsolete()
+            for entry in batch:
+                try:
+                    # Saved one at a time, entries are dispatched by the post_save signal
+                    entry.save(force_insert=True)
+                    self._incr('written')
+                except Exception:
+                    logger.exception('Dropping audit log %s', entry)
+                    self._incr('failed')
+        else:
+            self._incr('written', len(batch))
+            dispatch_entries(batch)
+        self._incr('batches')
+        self._observe_batch(batch, time.perf_counter() - started)
+
+
+class SyncAuditWriter(BaseAuditWriter):
+    """Writes every entry immediately on the calling thread"""
+
+    def submit(self, entry):
+        self._incr('submitted')
+        started = time.perf_counter()
+        entry.save(force_insert=True)
+        self._incr('written')
+        self._incr('batches')
+        self._observe_batch([entry], time.perf_counter() - started)
+        return entry
+
+    async def asubmit(self, entry):
+        self._incr('submitted')
+        started = time.perf_counter()
+        await entry.asave(force_insert=True)
+        self._incr('written')
+        self._incr('batches')
+        self._observe_batch([entry], time.perf_counter() - started)
+        return entry
+
+
+class BufferedAuditWriter(BaseAuditWriter):
+    """
+    Queues entries in memory and writes them from a background thread
+    with ``bulk_create``, either once ``batch_size`` entries are waiting
+    or once the oldest entry is ``flush_interval`` seconds old.
+
+    When the queue is full, ``overflow_policy`` decides what happens:
+    - ``block``: wait for space (up to ``block_timeout`` seconds, then drop)
+    - ``drop``: discard the new entry immediately
+
+    ``block_timeout`` is finite by default, so a stalled database or writer
+    thread cannot hold request threads forever. A writer thread that died
+    is restarted on the next submit.
+    """
+
+    POLICIES = ('block', 'drop')
+
+    def __init__(self, batch_size=500, flush_interval=1.0, max_queue_size=10000,
+                 overflow_policy='block', block_timeout=5.0, **options):
+        super().__init__(**options)
+        if overflow_policy not in self.POLICIES:
+            raise ValueError(f'Unknown overflow policy: {overflow_policy}')
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def submit(self, entry):
+        self._ensure_started()
+        self._incr('submitted')
+
+        try:
+            if self.overflow_policy == 'block':
+                self._queue.put(entry, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(entry)
+        except queue.Full:
+            logger.warning('Audit log queue full, dropping %s entry', entry.action)
+            self._incr('dropped')
+
+        return entry
+
+    async def asubmit(self, entry):
+        # Enqueueing never blocks while there is room, so only a full queue
+        # needs a thread to apply the overflow policy.
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            return await sync_to_async(self.submit, thread_sensitive=False)(entry)
+        self._incr('submitted')
+        return entry
+
+    def flush(self, timeout=None):
+        if self._closed or self._pid != os.getpid():
+            return
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+        self._pid = None
+
+    def stats(self):
+        stats = super().stats()
+        stats['queue_depth'] = self._queue.qsize() if self._queue is not None else 0
+        return stats
+
+    def _ensure_started(self):
+        # Threads do not survive fork(), so each worker process gets its own.
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                if self._thread.is_alive():
+                    return
+                # Keep the queue, so entries waiting in it are still written
+                logger.error('Audit log writer thread died, restarting it')
+            else:
+                self._queue = queue.Queue(maxsize=self.max_queue_size)
+            self._thread = threading.Thread(
+                target=self._run, name='audit-log-writer', daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+            self._closed = False
+
+    def _run(self):
+        batch = []
+        waiters = []
+        deadline = None
+        stopping = False
+
+        while not stopping:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            if item is None:
+                stopping = True
+            elif isinstance(item, threading.Event):
+                waiters.append(item)
+            elif item is not False:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            expired = deadline is not None and time.monotonic() >= deadline
+            if batch and (stopping or waiters or expired or len(batch) >= self.batch_size):
+                self._write_batch(batch)
+                batch = []
+                deadline = None
+
+            for waiter in waiters:
+                waiter.set()
+            waiters = []
+
+        connection.close()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_audit_writer():
+    """Return the process-wide writer configured by ``AUDIT_LOG_WRITER``"""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                config = getattr(settings, 'AUDIT_LOG_WRITER', {})
+                backend = import_string(config.get('BACKEND', 'logs.writers.SyncAuditWriter'))
+                _writer = backend(**config.get('OPTIONS', {}))
+    return _writer
+
+
+def reset_audit_writer(**kwargs):
+    global _writer
+    if kwargs.get('setting', 'AUDIT_LOG_WRITER') != 'AUDIT_LOG_WRITER':
+        return
+    with _writer_lock:
+        if _writer is not None:
+            _writer.close()
+        _writer = None
+
+
+setting_changed.connect(reset_audit_writer)